@@ -1,33 +1,199 @@
 """
 WPEX Orchestrator — Audit Log API
-Audit logging middleware and read endpoints.
+Audit logging and read endpoints.
+
+Events go through a bounded in-process queue; a background writer inserts
+them in bulk every AUDIT_BATCH_SIZE events or AUDIT_FLUSH_MS, whichever
+comes first. When the queue is full or the database is down, events are
+appended to AUDIT_OVERFLOW_FILE and loaded back once inserts succeed again.
+The file may be shared by several processes (uvicorn workers, replicas on
+one node), so every access holds a flock on AUDIT_OVERFLOW_FILE.lock.
 """
+import os
 import json
+import time
+import fcntl
+import queue
+import logging
+import threading
+from datetime import datetime
 from fastapi import APIRouter, Depends, Request, Query
 from typing import Optional, Callable
 from functools import wraps
+from contextlib import contextmanager
+from psycopg2.extras import execute_values
 
-from database import get_db
+from database import get_db, get_request_db
 from auth import get_current_user
 
 router = APIRouter(prefix="/api/audit", tags=["audit"])
+logger = logging.getLogger("audit")
+
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "200"))
+AUDIT_FLUSH_MS = int(os.getenv("AUDIT_FLUSH_MS", "500"))
+AUDIT_OVERFLOW_FILE = os.getenv("AUDIT_OVERFLOW_FILE", "/var/lib/wpex/audit-overflow.jsonl")
+AUDIT_OVERFLOW_RETRY = float(os.getenv("AUDIT_OVERFLOW_RETRY", "30"))   # reload overflowed events every (s)
+
+_queue = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+_overflow_lock = threading.Lock()
+_writer = {"thread": None, "stop": threading.Event(), "overflow_checked": 0.0}
+_stats = {"enqueued": 0, "written": 0, "batches": 0, "overflowed": 0, "reloaded": 0, "dropped": 0,
+          "flush_errors": 0, "writer_errors": 0, "last_flush_ms": None, "max_flush_ms": 0.0, "last_error": None}
 
 
 def log_audit_event(user_id: int, action: str, entity_type: str = None,
-                    entity_id: int = None, details: dict = None, ip_address: str = None):
-    """Write an audit log entry."""
+                    entity_id: int = None, details: dict = None, ip_address: str = None,
+                    db=None):
+    """Queue an audit log entry; never raises.
+
+    With a request-scoped ``db`` the event is queued only once the caller's
+    transaction commits, so a rolled-back change leaves no audit row.
+    """
+    row = (user_id, action, entity_type, entity_id,
+           json.dumps(details) if details else None, ip_address, datetime.now().isoformat())
+    if db is not None:
+        db.after_commit(lambda: _enqueue(row))
+    else:
+        _enqueue(row)
+
+
+def _enqueue(row):
+    try:
+        _queue.put_nowait(row)
+        _stats["enqueued"] += 1
+    except queue.Full:
+        _overflow([row])
+
+
+@contextmanager
+def _overflow_locked():
+    """Exclusive use of the overflow file, across threads and processes."""
+    with _overflow_lock:
+        os.makedirs(os.path.dirname(AUDIT_OVERFLOW_FILE) or ".", exist_ok=True)
+        # A separate lock file: the overflow file itself is removed after a reload
+        with open(AUDIT_OVERFLOW_FILE + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+
+def _overflow(rows):
+    """Park events on local disk; they are loaded back once the DB accepts them."""
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO audit_log (user_id, action, entity_type, entity_id, details, ip_address)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """, (user_id, action, entity_type, entity_id,
-              json.dumps(details) if details else None, ip_address))
+        with _overflow_locked():
+            with open(AUDIT_OVERFLOW_FILE, "a") as f:
+                f.writelines(json.dumps(row) + "\n" for row in rows)
+        _stats["overflowed"] += len(rows)
+    except OSError as e:
+        _stats["dropped"] += len(rows)
+        logger.error(f"Audit overflow write failed, {len(rows)} events lost: {e}")
+
+
+def _insert(rows):
+    with get_db() as conn:
+        execute_values(conn.cursor(), """
+            INSERT INTO audit_log (user_id, action, entity_type, entity_id, details, ip_address, created_at)
+            VALUES %s
+        """, rows, page_size=AUDIT_BATCH_SIZE)
         conn.commit()
-        conn.close()
-    except:
-        pass
+
+
+def _flush(rows) -> bool:
+    started = time.monotonic()
+    try:
+        _insert(rows)
+    except Exception as e:
+        _stats["flush_errors"] += 1
+        _stats["last_error"] = str(e)
+        logger.error(f"Audit flush of {len(rows)} events failed, overflowing to disk: {e}")
+        _overflow(rows)
+        return False
+    elapsed = round((time.monotonic() - started) * 1000, 1)
+    _stats.update(written=_stats["written"] + len(rows), batches=_stats["batches"] + 1,
+                  last_flush_ms=elapsed, max_flush_ms=max(_stats["max_flush_ms"], elapsed))
+    return True
+
+
+def _reload_overflow():
+    """Insert events parked on disk, oldest first; keeps the file if the DB still refuses."""
+    with _overflow_locked():
+        try:
+            with open(AUDIT_OVERFLOW_FILE) as f:
+                rows = [tuple(json.loads(line)) for line in f if line.strip()]
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Audit overflow file unreadable: {e}")
+            return
+        if not rows:
+            return
+        try:
+            for i in range(0, len(rows), AUDIT_BATCH_SIZE):
+                _insert(rows[i:i + AUDIT_BATCH_SIZE])
+        except Exception as e:
+            # Rewrite what's left so the inserted batches aren't loaded twice
+            with open(AUDIT_OVERFLOW_FILE, "w") as f:
+                f.writelines(json.dumps(row) + "\n" for row in rows[i:])
+            _stats["reloaded"] += i
+            logger.warning(f"Audit overflow reload paused, {len(rows) - i} events still on disk: {e}")
+            return
+        os.remove(AUDIT_OVERFLOW_FILE)
+        _stats["reloaded"] += len(rows)
+    logger.info(f"Reloaded {len(rows)} overflowed audit events")
+
+
+def _drain(limit: int, timeout: float) -> list:
+    """Up to *limit* queued events, waiting at most *timeout* seconds for the first ones."""
+    rows, deadline = [], time.monotonic() + timeout
+    while len(rows) < limit:
+        remaining = deadline - time.monotonic()
+        try:
+            rows.append(_queue.get(timeout=remaining) if remaining > 0 else _queue.get_nowait())
+        except queue.Empty:
+            break
+    return rows
+
+
+def _run_writer():
+    stop = _writer["stop"]
+    while not stop.is_set():
+        try:
+            rows = _drain(AUDIT_BATCH_SIZE, AUDIT_FLUSH_MS / 1000)
+            flushed = _flush(rows) if rows else True
+            now = time.monotonic()
+            if flushed and now - _writer["overflow_checked"] >= AUDIT_OVERFLOW_RETRY:
+                _writer["overflow_checked"] = now
+                _reload_overflow()
+        except Exception as e:
+            # Keep the thread alive: nothing else drains the queue or the overflow file
+            _stats["writer_errors"] += 1
+            _stats["last_error"] = str(e)
+            logger.exception("Audit writer iteration failed")
+
+
+def start_audit_writer():
+    """Start the background writer (called at application startup)."""
+    _writer["stop"].clear()
+    _writer["thread"] = threading.Thread(target=_run_writer, name="audit-writer", daemon=True)
+    _writer["thread"].start()
+
+
+def stop_audit_writer():
+    """Stop the writer and flush whatever is still queued (called at shutdown)."""
+    _writer["stop"].set()
+    if _writer["thread"] is not None:
+        _writer["thread"].join(timeout=AUDIT_FLUSH_MS / 1000 + 5)
+    while True:
+        rows = _drain(AUDIT_BATCH_SIZE, 0)
+        if not rows:
+            break
+        _flush(rows)
+
+
+def audit_queue_stats() -> dict:
+    """Queue depth, flush latency and loss counters for /api/health."""
+    return {**_stats, "queue_depth": _queue.qsize(), "queue_size": AUDIT_QUEUE_SIZE,
+            "overflow_pending": os.path.exists(AUDIT_OVERFLOW_FILE)}
 
 
 @router.get("")
@@ -37,11 +203,10 @@ def list_audit_logs(
     user_id: Optional[int] = Query(None),
     action: Optional[str] = Query(None),
     entity_type: Optional[str] = Query(None),
-    user=Depends(get_current_user)
+    user=Depends(get_current_user),
+    db=Depends(get_request_db),
 ):
     """List audit log entries with pagination and filters."""
-    conn = get_db()
-    cur = conn.cursor()
     offset = (page - 1) * per_page
 
     query = """
@@ -71,22 +236,25 @@ def list_audit_logs(
         params.append(entity_type)
         count_params.append(entity_type)
 
+    query += " ORDER BY a.created_at DESC LIMIT %s OFFSET %s"
+    params.extend([per_page, offset])
+
+    cur = db.cursor()
+
     # Count
     cur.execute(count_query, count_params)
     total = cur.fetchone()[0]
 
     # Data
-    query += " ORDER BY a.created_at DESC LIMIT %s OFFSET %s"
-    params.extend([per_page, offset])
     cur.execute(query, params)
+    rows = cur.fetchall()
 
     logs = [{
         "id": r[0], "user_id": r[1], "username": r[2], "action": r[3],
         "entity_type": r[4], "entity_id": r[5], "details": r[6],
         "ip_address": r[7],
         "created_at": r[8].isoformat() if r[8] else None,
-    } for r in cur.fetchall()]
-    conn.close()
+    } for r in rows]
 
     return {
         "logs": logs,
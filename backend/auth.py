@@ -2,13 +2,14 @@
 WPEX Orchestrator — Authentication API
 JWT-based auth with token blacklisting.
 """
-import os, datetime, uuid
+import os, datetime, uuid, time, threading, logging
+from collections import OrderedDict
 from fastapi import APIRouter, HTTPException, Depends, Response, Request
 from pydantic import BaseModel
 import jwt
 import psycopg2
 
-from database import get_db, _read_secret
+from database import get_db, get_request_db, _read_secret
 
 # --- JWT Config ---
 JWT_SECRET = _read_secret("jwt_secret") or os.getenv(
@@ -17,6 +18,15 @@ JWT_SECRET = _read_secret("jwt_secret") or os.getenv(
 JWT_ALGORITHM = "HS256"
 JWT_EXP_DAYS = 7
 
+# --- Verification cache config ---
+JWT_CACHE_TTL = float(os.getenv("JWT_CACHE_TTL", "60"))                   # trust a decoded token this long (s)
+JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", "10000"))                # max cached tokens (LRU)
+JWT_BLACKLIST_REFRESH = float(os.getenv("JWT_BLACKLIST_REFRESH", "15"))   # max lag for revocations made on other replicas (s)
+_BLACKLIST_OVERLAP = datetime.timedelta(seconds=60)  # re-read recent rows: created_at is the txn start, not commit time
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))                 # max staleness of role/tenant/status on other replicas (s)
+
+logger = logging.getLogger("auth")
+
 router = APIRouter(prefix="/api/auth", tags=["auth"])
 
 
@@ -42,23 +52,192 @@ def create_jwt_token(user_id: int, username: str):
     return token, exp
 
 
-def verify_jwt_token(token: str):
+# --- Verification cache ---
+# Decoded tokens are kept in a small LRU so polling tabs skip re-verification,
+# and revoked jtis live in an in-memory set that is loaded at startup, updated
+# locally on logout and topped up from token_blacklist at most every
+# JWT_BLACKLIST_REFRESH seconds (bounding how long a logout on another replica
+# takes to apply here).
+_token_cache = OrderedDict()     # token -> (payload, cached_at)
+_token_cache_lock = threading.Lock()
+_revoked = {}                    # jti -> expires_at (naive, as stored in token_blacklist)
+_revoked_lock = threading.Lock()
+_blacklist_state = {"synced_at": None, "watermark": None, "refreshing": False}
+_token_stats = {"hits": 0, "misses": 0, "revoked_hits": 0, "blacklist_refreshes": 0, "blacklist_refresh_errors": 0}
+
+
+def _cache_get(token: str):
+    now = time.monotonic()
+    with _token_cache_lock:
+        entry = _token_cache.get(token)
+        if entry is None or now - entry[1] > JWT_CACHE_TTL:
+            _token_cache.pop(token, None)
+            _token_stats["misses"] += 1
+            return None
+        _token_cache.move_to_end(token)
+        _token_stats["hits"] += 1
+        return entry[0]
+
+
+def _cache_put(token: str, payload: dict):
+    with _token_cache_lock:
+        _token_cache[token] = (payload, time.monotonic())
+        _token_cache.move_to_end(token)
+        while len(_token_cache) > JWT_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+
+
+def _read_blacklist(cur, since=None):
+    if since is None:
+        cur.execute("SELECT jti, expires_at, created_at FROM token_blacklist WHERE expires_at > NOW()")
+    else:
+        cur.execute("SELECT jti, expires_at, created_at FROM token_blacklist WHERE created_at > %s",
+                    (since - _BLACKLIST_OVERLAP,))
+    rows = cur.fetchall()
+    now = datetime.datetime.now()
+    with _revoked_lock:
+        for jti, expires_at, created_at in rows:
+            _revoked[jti] = expires_at
+            if created_at and (_blacklist_state["watermark"] is None or created_at > _blacklist_state["watermark"]):
+                _blacklist_state["watermark"] = created_at
+        for jti in [j for j, exp in _revoked.items() if exp and exp < now]:
+            del _revoked[jti]
+        _blacklist_state["synced_at"] = time.monotonic()
+
+
+def load_token_blacklist():
+    """Load every unexpired revoked jti into memory (called at startup)."""
+    with get_db() as conn:
+        _read_blacklist(conn.cursor())
+
+
+def _refresh_blacklist(db=None):
+    """Pull revocations added by other replicas once JWT_BLACKLIST_REFRESH has elapsed."""
+    with _revoked_lock:
+        synced_at = _blacklist_state["synced_at"]
+        if _blacklist_state["refreshing"] or (
+                synced_at is not None and time.monotonic() - synced_at < JWT_BLACKLIST_REFRESH):
+            return
+        _blacklist_state["refreshing"] = True
+        since = _blacklist_state["watermark"] if synced_at is not None else None
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        # Check blacklist
-        conn = get_db()
+        with get_db(db) as conn:
+            _read_blacklist(conn.cursor(), since)
+        _token_stats["blacklist_refreshes"] += 1
+    except Exception as e:
+        # Keep serving from the last known set; retry after the next interval.
+        logger.warning(f"Token blacklist refresh failed: {e}")
+        _token_stats["blacklist_refresh_errors"] += 1
+        with _revoked_lock:
+            _blacklist_state["synced_at"] = time.monotonic()
+        if db is not None:
+            db.rollback()
+    finally:
+        with _revoked_lock:
+            _blacklist_state["refreshing"] = False
+
+
+def revoke_token(jti: str, expires_at: datetime.datetime):
+    """Mark a jti as revoked in this process and drop any cached verification."""
+    with _revoked_lock:
+        _revoked[jti] = expires_at
+    with _token_cache_lock:
+        for token in [t for t, (p, _) in _token_cache.items() if p.get("jti") == jti]:
+            del _token_cache[token]
+
+
+def token_cache_stats() -> dict:
+    with _token_cache_lock:
+        cached = len(_token_cache)
+    with _revoked_lock:
+        revoked = len(_revoked)
+        synced_at = _blacklist_state["synced_at"]
+    return {
+        **_token_stats,
+        "cached_tokens": cached,
+        "revoked_jtis": revoked,
+        "blacklist_age_s": round(time.monotonic() - synced_at, 1) if synced_at is not None else None,
+    }
+
+
+# --- User role/tenant cache ---
+# (role, tenant_id, status) per user id. Writes on this replica invalidate
+# immediately; changes made on other replicas apply within USER_CACHE_TTL.
+_user_cache = {}                 # user_id -> ((role, tenant_id, status), cached_at)
+_user_cache_lock = threading.Lock()
+_user_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_user_cache_gen = [0]            # bumped on every invalidation so in-flight reads don't re-cache stale rows
+
+
+def _load_user_access(user_id: int, db=None):
+    now = time.monotonic()
+    with _user_cache_lock:
+        entry = _user_cache.get(user_id)
+        if entry is not None and now - entry[1] <= USER_CACHE_TTL:
+            _user_cache_stats["hits"] += 1
+            return entry[0]
+        _user_cache_stats["misses"] += 1
+        gen = _user_cache_gen[0]
+
+    with get_db(db) as conn:
         cur = conn.cursor()
-        cur.execute("SELECT 1 FROM token_blacklist WHERE jti = %s", (payload["jti"],))
-        if cur.fetchone():
-            conn.close()
+        cur.execute("SELECT role, tenant_id, status FROM users WHERE id = %s", (user_id,))
+        row = cur.fetchone()
+    if row:
+        with _user_cache_lock:
+            if _user_cache_gen[0] == gen:
+                _user_cache[user_id] = (row, now)
+    return row
+
+
+def invalidate_user(user_id: int):
+    """Drop the cached role/tenant/status of a user after it changed."""
+    with _user_cache_lock:
+        _user_cache_gen[0] += 1
+        if _user_cache.pop(user_id, None) is not None:
+            _user_cache_stats["invalidations"] += 1
+
+
+def invalidate_tenant_users(tenant_id: int):
+    """Drop every cached user that belongs to a tenant (e.g. after tenant approval)."""
+    with _user_cache_lock:
+        _user_cache_gen[0] += 1
+        for uid in [u for u, (row, _) in _user_cache.items() if row[1] == tenant_id]:
+            del _user_cache[uid]
+            _user_cache_stats["invalidations"] += 1
+
+
+def user_cache_stats() -> dict:
+    with _user_cache_lock:
+        lookups = _user_cache_stats["hits"] + _user_cache_stats["misses"]
+        return {
+            **_user_cache_stats,
+            "cached_users": len(_user_cache),
+            "hit_ratio": round(_user_cache_stats["hits"] / lookups, 3) if lookups else None,
+            "ttl_s": USER_CACHE_TTL,
+        }
+
+
+def verify_jwt_token(token: str, db=None):
+    payload = _cache_get(token)
+    if payload is None:
+        try:
+            payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
             return None
-        conn.close()
-        return payload
-    except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
+        _cache_put(token, payload)
+    elif payload["exp"] < time.time():
+        return None
+
+    # Check blacklist
+    _refresh_blacklist(db)
+    if payload["jti"] in _revoked:
+        _token_stats["revoked_hits"] += 1
         return None
+    return payload
 
 
-def get_current_user_any_status(request: Request):
+def get_current_user_any_status(request: Request, db=Depends(get_request_db)):
     """Dependency that extracts user and role/tenant but DOES NOT block pending users."""
     token = None
     auth_header = request.headers.get("Authorization")
@@ -69,7 +248,7 @@ def get_current_user_any_status(request: Request):
     if not token:
         raise HTTPException(status_code=401, detail="Non autenticato")
     
-    payload = verify_jwt_token(token)
+    payload = verify_jwt_token(token, db)
     if not payload:
         raise HTTPException(status_code=401, detail="Token non valido o scaduto")
 
@@ -78,17 +257,16 @@ def get_current_user_any_status(request: Request):
     tenant_id = None
     status = "active"
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT role, tenant_id, status FROM users WHERE id = %s", (user_id,))
-        row = cur.fetchone()
+        row = _load_user_access(user_id, db)
         if row:
             role = row[0] or "engineer"
             tenant_id = row[1]
             status = row[2] or "active"
-        conn.close()
-    except:
-        pass
+    except psycopg2.Error as e:
+        # Keep the defaults, but don't leave the shared request transaction
+        # aborted for the handler's own queries.
+        db.rollback()
+        logger.warning(f"User access lookup failed for {user_id}: {e}")
 
     return {"id": user_id, "username": payload["name"], "token": token,
             "role": role, "tenant_id": tenant_id, "status": status}
@@ -108,14 +286,13 @@ def get_current_user(user=Depends(get_current_user_any_status)):
 # --- Endpoints ---
 @router.post("/login")
 def login(body: LoginRequest, response: Response):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, username, status FROM users WHERE username = %s AND password_hash = crypt(%s, password_hash);",
-        (body.username, body.password),
-    )
-    user = cur.fetchone()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT id, username, status FROM users WHERE username = %s AND password_hash = crypt(%s, password_hash);",
+            (body.username, body.password),
+        )
+        user = cur.fetchone()
 
     if not user:
         raise HTTPException(status_code=401, detail="Credenziali non valide")
@@ -131,46 +308,45 @@ def login(body: LoginRequest, response: Response):
 
 @router.post("/register")
 def register(body: RegisterRequest):
-    conn = get_db()
     try:
-        cur = conn.cursor()
-        
-        target_tenant_id = body.tenant_id
-        
-        if target_tenant_id is None:
-            # New organization request
-            if not body.new_tenant_name or not body.new_tenant_slug:
-                raise HTTPException(status_code=400, detail="Fornire un tenant esistente o i dati per una nuova organizzazione")
-            
-            # Create a pending tenant
-            from database import generate_api_key
-            api_key = generate_api_key()
-            slug = body.new_tenant_slug.lower().replace(" ", "-")
-            cur.execute("""
-                INSERT INTO tenants (name, slug, api_key, status, is_active)
-                VALUES (%s, %s, %s, 'pending', FALSE)
-                RETURNING id;
-            """, (body.new_tenant_name, slug, api_key))
-            target_tenant_id = cur.fetchone()[0]
-            
-            # The user becomes the first engineer/admin of this pending tenant
-            cur.execute(
-                "INSERT INTO users (username, password_hash, status, role, tenant_id) VALUES (%s, crypt(%s, gen_salt('bf')), 'pending', 'engineer', %s);",
-                (body.username, body.password, target_tenant_id),
-            )
-        else:
-            # Join existing organization
-            cur.execute("SELECT id FROM tenants WHERE id = %s AND status = 'active' AND is_active = TRUE", (target_tenant_id,))
-            if not cur.fetchone():
-                raise HTTPException(status_code=400, detail="Organizzazione non valida, inattiva o non ancora approvata")
-            
-            # Insert user as pending with viewer role
-            cur.execute(
-                "INSERT INTO users (username, password_hash, status, role, tenant_id) VALUES (%s, crypt(%s, gen_salt('bf')), 'pending', 'viewer', %s);",
-                (body.username, body.password, target_tenant_id),
-            )
-        conn.commit()
-        conn.close()
+        with get_db() as conn:
+            cur = conn.cursor()
+
+            target_tenant_id = body.tenant_id
+
+            if target_tenant_id is None:
+                # New organization request
+                if not body.new_tenant_name or not body.new_tenant_slug:
+                    raise HTTPException(status_code=400, detail="Fornire un tenant esistente o i dati per una nuova organizzazione")
+
+                # Create a pending tenant
+                from database import generate_api_key
+                api_key = generate_api_key()
+                slug = body.new_tenant_slug.lower().replace(" ", "-")
+                cur.execute("""
+                    INSERT INTO tenants (name, slug, api_key, status, is_active)
+                    VALUES (%s, %s, %s, 'pending', FALSE)
+                    RETURNING id;
+                """, (body.new_tenant_name, slug, api_key))
+                target_tenant_id = cur.fetchone()[0]
+
+                # The user becomes the first engineer/admin of this pending tenant
+                cur.execute(
+                    "INSERT INTO users (username, password_hash, status, role, tenant_id) VALUES (%s, crypt(%s, gen_salt('bf')), 'pending', 'engineer', %s);",
+                    (body.username, body.password, target_tenant_id),
+                )
+            else:
+                # Join existing organization
+                cur.execute("SELECT id FROM tenants WHERE id = %s AND status = 'active' AND is_active = TRUE", (target_tenant_id,))
+                if not cur.fetchone():
+                    raise HTTPException(status_code=400, detail="Organizzazione non valida, inattiva o non ancora approvata")
+
+                # Insert user as pending with viewer role
+                cur.execute(
+                    "INSERT INTO users (username, password_hash, status, role, tenant_id) VALUES (%s, crypt(%s, gen_salt('bf')), 'pending', 'viewer', %s);",
+                    (body.username, body.password, target_tenant_id),
+                )
+            conn.commit()
         return {"message": "Registrazione completata. Il tuo account è in attesa di approvazione da parte della tua organizzazione."}
     except psycopg2.errors.UniqueViolation:
         raise HTTPException(status_code=409, detail="Username già esistente")
@@ -179,19 +355,18 @@ def register(body: RegisterRequest):
 
 
 @router.post("/logout")
-def logout(response: Response, user=Depends(get_current_user)):
+def logout(response: Response, user=Depends(get_current_user), db=Depends(get_request_db)):
     # Blacklist the current token
     try:
         payload = jwt.decode(user["token"], options={"verify_signature": False})
-        conn = get_db()
-        cur = conn.cursor()
         expires_at = datetime.datetime.fromtimestamp(payload["exp"])
+        revoke_token(payload["jti"], expires_at)
+        cur = db.cursor()
         cur.execute(
             "INSERT INTO token_blacklist (jti, expires_at) VALUES (%s, %s)",
             (payload["jti"], expires_at),
         )
-        conn.commit()
-        conn.close()
+        db.commit()
     except:
         pass
 
@@ -207,50 +382,43 @@ def me(user=Depends(get_current_user_any_status)):
 
 
 @router.get("/users")
-def list_users(user=Depends(get_current_user)):
+def list_users(user=Depends(get_current_user), db=Depends(get_request_db)):
     # Admin sees all. Engineer sees only their tenant's users.
-    conn = get_db()
-    cur = conn.cursor()
+    if user.get("role") not in ("admin", "engineer"):
+        raise HTTPException(status_code=403, detail="Solo gli admin e gli engineer possono visualizzare gli utenti")
+
+    cur = db.cursor()
     if user.get("role") == "admin":
         cur.execute("SELECT id, username, role, tenant_id, created_at, status FROM users ORDER BY id")
-    elif user.get("role") == "engineer":
-        cur.execute("SELECT id, username, role, tenant_id, created_at, status FROM users WHERE tenant_id = %s ORDER BY id", (user["tenant_id"],))
     else:
-        conn.close()
-        raise HTTPException(status_code=403, detail="Solo gli admin e gli engineer possono visualizzare gli utenti")
-    
+        cur.execute("SELECT id, username, role, tenant_id, created_at, status FROM users WHERE tenant_id = %s ORDER BY id", (user["tenant_id"],))
     rows = cur.fetchall()
-    conn.close()
     return {"users": [{"id": r[0], "username": r[1], "role": r[2] or "engineer",
                         "tenant_id": r[3], "created_at": str(r[4]) if r[4] else None,
                         "status": r[5] or "active"} for r in rows]}
 
 
 @router.put("/users/{user_id}/role")
-def update_user_role(user_id: int, body: dict, user=Depends(get_current_user)):
+def update_user_role(user_id: int, body: dict, user=Depends(get_current_user), db=Depends(get_request_db)):
     role = body.get("role")
     if role not in ("admin", "executive", "engineer", "viewer"):
         raise HTTPException(status_code=400, detail="Ruolo non valido")
         
-    conn = get_db()
-    cur = conn.cursor()
-    
+    cur = db.cursor()
+
     # RBAC rules
     if user.get("role") == "admin":
         pass # Admin can do anything
     elif user.get("role") == "engineer":
         if role in ("admin", "executive"):
-            conn.close()
             raise HTTPException(status_code=403, detail="Non puoi assegnare un ruolo con visibilità globale")
-            
+
         # Ensure user belongs to the same tenant
         cur.execute("SELECT tenant_id FROM users WHERE id = %s", (user_id,))
         row = cur.fetchone()
         if not row or row[0] != user.get("tenant_id"):
-            conn.close()
             raise HTTPException(status_code=403, detail="Puoi gestire solo utenti del tuo tenant")
     else:
-        conn.close()
         raise HTTPException(status_code=403, detail="Permessi insufficienti")
 
     if role in ("admin", "executive"):
@@ -258,44 +426,39 @@ def update_user_role(user_id: int, body: dict, user=Depends(get_current_user)):
         cur.execute("UPDATE users SET role = %s, tenant_id = NULL WHERE id = %s", (role, user_id))
     else:
         cur.execute("UPDATE users SET role = %s WHERE id = %s", (role, user_id))
-    conn.commit()
-    conn.close()
+    db.commit()
+    invalidate_user(user_id)
     return {"message": "Ruolo aggiornato", "user_id": user_id, "role": role}
 
 
 @router.put("/users/{user_id}/tenant")
-def update_user_tenant(user_id: int, body: dict, user=Depends(get_current_user)):
+def update_user_tenant(user_id: int, body: dict, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Solo gli admin possono assegnare tenant")
     tenant_id = body.get("tenant_id")
-    conn = get_db()
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute("SELECT role FROM users WHERE id = %s", (user_id,))
     row = cur.fetchone()
     if not row:
-        conn.close()
         raise HTTPException(status_code=404, detail="Utente non trovato")
     if row[0] in ("admin", "executive") and tenant_id is not None:
-        conn.close()
         raise HTTPException(status_code=400, detail="Gli utenti globali (admin) non possono essere assegnati a un tenant specifico.")
 
     cur.execute("UPDATE users SET tenant_id = %s WHERE id = %s", (tenant_id, user_id))
-    conn.commit()
-    conn.close()
+    db.commit()
+    invalidate_user(user_id)
     return {"message": "Tenant aggiornato", "user_id": user_id, "tenant_id": tenant_id}
 
 
 @router.put("/users/{user_id}/status")
-def update_user_status(user_id: int, body: dict, user=Depends(get_current_user)):
+def update_user_status(user_id: int, body: dict, user=Depends(get_current_user), db=Depends(get_request_db)):
     # RBAC Check: admin can do anything. Engineer can manage users in their tenant.
     if user.get("role") == "admin":
         pass
     elif user.get("role") == "engineer":
-        conn = get_db()
-        cur = conn.cursor()
+        cur = db.cursor()
         cur.execute("SELECT tenant_id FROM users WHERE id = %s", (user_id,))
         row = cur.fetchone()
-        conn.close()
         if not row or row[0] != user["tenant_id"]:
             raise HTTPException(status_code=403, detail="Puoi gestire solo utenti del tuo tenant")
     else:
@@ -305,16 +468,15 @@ def update_user_status(user_id: int, body: dict, user=Depends(get_current_user))
     if status not in ("pending", "active", "disabled"):
         raise HTTPException(status_code=400, detail="Status non valido")
     
-    conn = get_db()
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute("UPDATE users SET status = %s WHERE id = %s", (status, user_id))
-    conn.commit()
-    conn.close()
+    db.commit()
+    invalidate_user(user_id)
     return {"message": "Status aggiornato", "user_id": user_id, "status": status}
 
 
 @router.delete("/users/{user_id}")
-def delete_user(user_id: int, user=Depends(get_current_user)):
+def delete_user(user_id: int, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Solo gli admin possono eliminare utenti")
     
@@ -322,27 +484,24 @@ def delete_user(user_id: int, user=Depends(get_current_user)):
     if user_id == user["id"]:
         raise HTTPException(status_code=400, detail="Non puoi eliminare te stesso")
 
-    conn = get_db()
-    cur = conn.cursor()
+    cur = db.cursor()
     # Check if user exists
     cur.execute("SELECT id FROM users WHERE id = %s", (user_id,))
     if not cur.fetchone():
-        conn.close()
         raise HTTPException(status_code=404, detail="Utente non trovato")
-        
+
     cur.execute("DELETE FROM users WHERE id = %s", (user_id,))
-    conn.commit()
-    conn.close()
+    db.commit()
+    invalidate_user(user_id)
     return {"message": "Utente eliminato con successo", "user_id": user_id}
 
 
 @router.get("/public/tenants")
 def list_public_tenants():
     """Publicly accessible list of tenants for registration."""
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name FROM tenants WHERE status = 'active' AND is_active = TRUE ORDER BY name")
-    rows = cur.fetchall()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, name FROM tenants WHERE status = 'active' AND is_active = TRUE ORDER BY name")
+        rows = cur.fetchall()
     return {"tenants": [{"id": r[0], "name": r[1]} for r in rows]}
 
@@ -0,0 +1,175 @@
+"""
+WPEX Orchestrator — Query Plan Regression Check
+Seeds a throw-away copy of the schema with realistic row counts, runs
+EXPLAIN on the hot queries of the API and fails if any of them falls back
+to a sequential scan on a large table.
+
+Usage (against a local/dev PostgreSQL, same DB_* env as the backend):
+    python check_query_plans.py
+
+Everything happens inside one transaction in a scratch schema that is
+rolled back at the end, so the target database is left untouched.
+"""
+import sys
+
+from database import get_db, MIGRATIONS
+
+SCRATCH_SCHEMA = "wpex_qplan_check"
+
+# Row counts in the ballpark of a large production install (~50 keys and
+# 2 relays per tenant).
+SEED = {
+    "tenants": 1000,
+    "users": 5000,
+    "servers": 2000,
+    "access_keys": 50000,
+    "server_keys_link": 100000,
+    "sites": 20000,
+    "audit_log": 200000,
+    "token_blacklist": 10000,
+}
+
+SEED_SQL = [
+    """INSERT INTO tenants (name, slug, api_key)
+       SELECT 'tenant-' || g, 'tenant-' || g, 'key-' || g FROM generate_series(1, %(tenants)s) g""",
+    """INSERT INTO users (username, password_hash, status, role, tenant_id)
+       SELECT 'user-' || g, 'x', 'active', 'engineer', 1 + g %% %(tenants)s FROM generate_series(1, %(users)s) g""",
+    """INSERT INTO servers (name, port, web_port, tenant_id, region)
+       SELECT 'relay-' || g, 40000 + g, 8080 + g, 1 + g %% %(tenants)s, 'eu-' || (g %% 5)
+       FROM generate_series(1, %(servers)s) g""",
+    """INSERT INTO access_keys (alias, key_value, tenant_id)
+       SELECT 'site-' || g, convert_to('pubkey-' || g, 'UTF8'), 1 + g %% %(tenants)s
+       FROM generate_series(1, %(access_keys)s) g""",
+    """INSERT INTO server_keys_link (server_id, key_id)
+       SELECT DISTINCT 1 + (g * 7919) %% %(servers)s, 1 + g %% %(access_keys)s
+       FROM generate_series(1, %(server_keys_link)s) g""",
+    """INSERT INTO sites (tenant_id, name, region)
+       SELECT 1 + g %% %(tenants)s, 'site-' || g, 'eu-' || (g %% 5) FROM generate_series(1, %(sites)s) g""",
+    """INSERT INTO audit_log (user_id, action, entity_type, entity_id, created_at)
+       SELECT 1 + g %% %(users)s, (ARRAY['create','delete','update','start','stop'])[1 + g %% 5],
+              (ARRAY['relay','key','tenant','site'])[1 + g %% 4], g,
+              NOW() - (g || ' seconds')::interval
+       FROM generate_series(1, %(audit_log)s) g""",
+    """INSERT INTO token_blacklist (jti, expires_at, created_at)
+       SELECT md5(g::text), NOW() + interval '7 days', NOW() - (g || ' minutes')::interval
+       FROM generate_series(1, %(token_blacklist)s) g""",
+]
+
+# (name, SQL, params) — mirrors the queries issued by the routers.
+HOT_QUERIES = [
+    ("relay names by tenant",
+     "SELECT id, name FROM servers WHERE tenant_id = %s ORDER BY name",
+     (42,)),
+    ("servers with keys by tenant",
+     """SELECT s.id, s.name, s.port, s.web_port, s.tenant_id, s.region, s.description,
+               COALESCE(json_agg(json_build_array(k.id, k.alias, k.xmin::text) ORDER BY k.id)
+                        FILTER (WHERE k.id IS NOT NULL), '[]')
+        FROM servers s
+        LEFT JOIN server_keys_link l ON l.server_id = s.id
+        LEFT JOIN access_keys k ON k.id = l.key_id
+        WHERE s.tenant_id = %s GROUP BY s.id ORDER BY s.port ASC""",
+     (42,)),
+    ("servers with keys (admin)",
+     """SELECT s.id, s.name, s.port, s.web_port, s.tenant_id, s.region, s.description,
+               COALESCE(json_agg(json_build_array(k.id, k.alias, k.xmin::text) ORDER BY k.id)
+                        FILTER (WHERE k.id IS NOT NULL), '[]')
+        FROM servers s
+        LEFT JOIN server_keys_link l ON l.server_id = s.id
+        LEFT JOIN access_keys k ON k.id = l.key_id
+        GROUP BY s.id ORDER BY s.port ASC""",
+     ()),
+    ("relay count by tenant",
+     "SELECT COUNT(*) FROM servers WHERE tenant_id = %s",
+     (42,)),
+    ("keys by tenant",
+     "SELECT id, alias, tenant_id FROM access_keys WHERE tenant_id = %s ORDER BY created_at DESC",
+     (42,)),
+    ("keys of a relay",
+     """SELECT k.id, k.alias FROM access_keys k
+        JOIN server_keys_link l ON k.id = l.key_id WHERE l.server_id = %s""",
+     (42,)),
+    ("relays of a key",
+     "SELECT server_id FROM server_keys_link WHERE key_id = %s",
+     (42,)),
+    ("topology links by tenant",
+     """SELECT skl.key_id, skl.server_id, s.name FROM server_keys_link skl
+        JOIN access_keys k ON skl.key_id = k.id
+        JOIN servers s ON skl.server_id = s.id
+        WHERE k.tenant_id = %s""",
+     (42,)),
+    ("users by tenant",
+     "SELECT id, username, role, tenant_id, created_at, status FROM users WHERE tenant_id = %s ORDER BY id",
+     (42,)),
+    ("user access lookup",
+     "SELECT role, tenant_id, status FROM users WHERE id = %s",
+     (42,)),
+    ("sites by tenant",
+     "SELECT id, name, region, public_ip, subnet, is_active, created_at FROM sites WHERE tenant_id = %s ORDER BY name",
+     (42,)),
+    ("audit log first page",
+     """SELECT a.id, a.action, u.username FROM audit_log a LEFT JOIN users u ON a.user_id = u.id
+        ORDER BY a.created_at DESC LIMIT 50 OFFSET 0""",
+     ()),
+    ("audit log by user",
+     "SELECT a.id FROM audit_log a WHERE a.user_id = %s ORDER BY a.created_at DESC LIMIT 50 OFFSET 0",
+     (42,)),
+    ("audit log by entity type",
+     "SELECT a.id FROM audit_log a WHERE a.entity_type = %s ORDER BY a.created_at DESC LIMIT 50 OFFSET 0",
+     ("relay",)),
+    ("blacklist incremental refresh",
+     "SELECT jti, expires_at, created_at FROM token_blacklist WHERE created_at > NOW() - interval '2 minutes'",
+     ()),
+]
+
+# Small lookup tables where a seq scan is the right plan.
+SEQ_SCAN_ALLOWED = {"tenants"}
+
+# Queries that read whole tables by design (unfiltered admin listings).
+QUERY_SEQ_SCAN_ALLOWED = {
+    "servers with keys (admin)": {"servers", "server_keys_link", "access_keys"},
+}
+
+
+def _seq_scans(plan):
+    """Yield relation names of every Seq Scan node in an EXPLAIN JSON plan."""
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan.get("Relation Name")
+    for child in plan.get("Plans", []):
+        yield from _seq_scans(child)
+
+
+def main() -> int:
+    failures = []
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(f"CREATE SCHEMA {SCRATCH_SCHEMA}")
+        cur.execute(f"SET LOCAL search_path TO {SCRATCH_SCHEMA}, public")
+        for _, _, statements in MIGRATIONS:
+            for sql in statements:
+                cur.execute(sql)
+        for sql in SEED_SQL:
+            cur.execute(sql, SEED)
+        for table in SEED:
+            cur.execute(f"ANALYZE {table}")
+
+        for name, sql, params in HOT_QUERIES:
+            cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cur.fetchone()[0][0]["Plan"]
+            allowed = SEQ_SCAN_ALLOWED | QUERY_SEQ_SCAN_ALLOWED.get(name, set())
+            scans = sorted({r for r in _seq_scans(plan) if r not in allowed})
+            if scans:
+                failures.append((name, scans))
+                print(f"FAIL  {name}: sequential scan on {', '.join(scans)}")
+            else:
+                print(f"ok    {name}")
+        conn.rollback()
+
+    if failures:
+        print(f"\n{len(failures)}/{len(HOT_QUERIES)} hot queries fall back to a sequential scan")
+        return 1
+    print(f"\nAll {len(HOT_QUERIES)} hot queries use indexes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
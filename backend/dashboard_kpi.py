@@ -2,175 +2,63 @@
 WPEX Orchestrator — Dashboard KPI API
 Aggregated metrics for executive overview.
 """
-import requests
+import os, time, logging
+from collections import defaultdict
+from datetime import datetime
+
+from apscheduler.schedulers.background import BackgroundScheduler
 from fastapi import APIRouter, Depends
-from typing import Optional
+from psycopg2.extras import Json, execute_values
 
-from database import get_db, DATA_KEY
+from database import get_db, get_request_db
 from auth import get_current_user
+from k8s_cache import relay_statuses
+from relay_stats import get_snapshots
+from health import score_relays
+from timeseries import fleet_rates
 
-router = APIRouter(prefix="/api/dashboard", tags=["dashboard"])
-
-def _init_k8s():
-    try:
-        from kubernetes import config
-        config.load_incluster_config()
-    except:
-        try:
-            from kubernetes import config
-            config.load_kube_config()
-        except:
-            pass
-
-def _get_k8s_pod_status(name: str):
-    from kubernetes import client
-    _init_k8s()
-    try:
-        core_api = client.CoreV1Api()
-        pods = core_api.list_namespaced_pod(namespace="wpex", label_selector=f"app=wpex-{name}")
-        if not pods.items:
-            try:
-                apps_api = client.AppsV1Api()
-                apps_api.read_namespaced_deployment(name=f"wpex-{name}", namespace="wpex")
-                return "stopped", 0
-            except:
-                return "not_created", 0
-                
-        pod = pods.items[0]
-        status = pod.status.phase.lower()
-        if status == "running":
-            is_ready = any(cond.type == "Ready" and cond.status == "True" for cond in pod.status.conditions) if pod.status.conditions else False
-            if not is_ready:
-                status = "starting"
-        restart_count = sum([c.restart_count for c in pod.status.container_statuses]) if pod.status.container_statuses else 0
-        return status, restart_count
-    except:
-        return "error", 0
-
-
-def _fetch_relay_stats(container_name: str) -> Optional[dict]:
-    """Fetch stats from a WPEX relay container via internal Docker network."""
-    try:
-        resp = requests.get(f"http://{container_name}.wpex.svc.cluster.local:8080/stats", timeout=2)
-        if resp.status_code == 200:
-            return resp.json()
-    except:
-        pass
-    return None
-
-
-def _compute_health_score(status: str, stats, restart_count: int = 0) -> float:
-    """Compute composite health score (0-100) using the same weighted-average as relay_proxy."""
-    if status != "running":
-        return 0.0
-
-    components = {}
-
-    # Container status
-    components["container"] = 100.0
-
-    # Restart penalty
-    rc_score = max(0, 100 - restart_count * 10)
-    components["restarts"] = float(rc_score)
-
-    if stats:
-        # Handshake rate
-        total_hs = stats.get("total_handshakes", 0)
-        success_hs = stats.get("successful_handshakes", 0)
-        if total_hs > 0:
-            components["handshake_rate"] = round(success_hs / total_hs * 100, 1)
-        else:
-            components["handshake_rate"] = 100.0
-
-        # Peer connectivity
-        peers = stats.get("peers", {})
-        if isinstance(peers, dict) and len(peers) > 0:
-            connected = sum(1 for p in peers.values() if isinstance(p, dict) and p.get("status") == 1)
-            components["connectivity"] = round(connected / len(peers) * 100, 1)
-        else:
-            components["connectivity"] = 100.0
-
-    # Weighted average — same weights as relay_proxy.py
-    weights = {"container": 0.2, "restarts": 0.15, "handshake_rate": 0.35, "connectivity": 0.3}
-    weighted_sum = 0.0
-    total_weight = 0.0
-    for k, w in weights.items():
-        if k in components:
-            weighted_sum += components[k] * w
-            total_weight += w
-
-    return round(weighted_sum / total_weight, 1) if total_weight > 0 else 0.0
-
-
-@router.get("/kpi")
-def get_dashboard_kpi(user=Depends(get_current_user)):
-    conn = get_db()
-    cur = conn.cursor()
-
-    is_tenant_scoped = user.get("role") in ("engineer", "viewer")
-    tenant_id = user.get("tenant_id")
+KPI_SNAPSHOT_INTERVAL = float(os.getenv("KPI_SNAPSHOT_INTERVAL", "20"))   # rebuild period of the KPI snapshots (s)
+KPI_SNAPSHOT_PERSIST = os.getenv("KPI_SNAPSHOT_PERSIST", "0") == "1"     # also store them in kpi_snapshots for other replicas
+KPI_RATE_WINDOW = int(os.getenv("KPI_RATE_WINDOW", "300"))                # window of the throughput KPIs (s)
 
-    # Relay counts
-    if is_tenant_scoped:
-        cur.execute("SELECT COUNT(*) FROM servers WHERE tenant_id = %s", (tenant_id,))
-    else:
-        cur.execute("SELECT COUNT(*) FROM servers")
-    relays_total = cur.fetchone()[0]
+logger = logging.getLogger("dashboard_kpi")
 
-    # Tenant counts
-    if is_tenant_scoped:
-        cur.execute("SELECT COUNT(*) FROM tenants WHERE is_active = TRUE AND id = %s", (tenant_id,))
-    else:
-        cur.execute("SELECT COUNT(*) FROM tenants WHERE is_active = TRUE")
-    tenants_active = cur.fetchone()[0]
-
-    # Keys Assigned
-    if is_tenant_scoped:
-        cur.execute("SELECT COUNT(*) FROM access_keys WHERE tenant_id = %s", (tenant_id,))
-    else:
-        cur.execute("SELECT COUNT(*) FROM access_keys")
-    keys_assigned = cur.fetchone()[0]
+router = APIRouter(prefix="/api/dashboard", tags=["dashboard"])
 
-    # (Tunnels count removed)
+def _fleet_health(names, statuses, snapshots) -> dict:
+    """Health score per relay name, computed for the whole batch in one pass."""
+    scored = score_relays([(*statuses[n], snapshots[n]["stats"]) for n in names])
+    return {n: r["health_score"] for n, r in zip(names, scored)}
 
-    # Get relay details for health computation
-    if is_tenant_scoped:
-        cur.execute("""
-            SELECT s.id, s.name, s.port, s.web_port, s.tenant_id, t.name as tenant_name 
-            FROM servers s
-            LEFT JOIN tenants t ON s.tenant_id = t.id
-            WHERE s.tenant_id = %s ORDER BY s.name
-        """, (tenant_id,))
-    else:
-        cur.execute("""
-            SELECT s.id, s.name, s.port, s.web_port, s.tenant_id, t.name as tenant_name 
-            FROM servers s
-            LEFT JOIN tenants t ON s.tenant_id = t.id
-            ORDER BY s.name
-        """)
-    relays = cur.fetchall()
-    conn.close()
 
+def _kpi_payload(relays, statuses, snapshots, health_scores, tenants_active: int, keys_assigned: int) -> dict:
+    """KPI response body for a set of (id, name, port, web_port, tenant_id, tenant_name) relay rows."""
+    relays_total = len(relays)
     relays_active = 0
     total_health = 0
     total_bytes = 0
     total_peers = 0
+    total_rate = 0.0
     relay_details = []
+    rates = fleet_rates([r[1] for r in relays], KPI_RATE_WINDOW)
 
     for relay in relays:
         rid, name, udp_port, web_port, t_id, t_name = relay
-        container_name = f"wpex-{name}"
 
-        status, restart_count = _get_k8s_pod_status(name)
+        status, restart_count = statuses[name]
 
         if status == "running":
             relays_active += 1
 
-        # Fetch WPEX stats
-        stats = _fetch_relay_stats(container_name)
-        health = _compute_health_score(status, stats, restart_count)
+        # WPEX stats (partial when some relays miss the deadline)
+        snapshot = snapshots[name]
+        stats = snapshot["stats"]
+        health = health_scores[name]
         total_health += health
 
+        bytes_per_s = (rates.get(name) or {}).get("bytes_per_s")
+        total_rate += bytes_per_s or 0.0
+
         if stats:
             total_bytes += stats.get("total_bytes_transferred", 0)
             peers = stats.get("peers", {})
@@ -182,7 +70,9 @@ def get_dashboard_kpi(user=Depends(get_current_user)):
             "tenant_id": t_id, "tenant_name": t_name or "Globale",
             "health": float(f"{health:.1f}"),
             "bytes_transferred": stats.get("total_bytes_transferred", 0) if stats else 0,
+            "bytes_per_s": bytes_per_s,
             "peers_count": len(stats.get("peers", {})) if stats and isinstance(stats.get("peers"), dict) else 0,
+            "stale": snapshot["stale"], "timed_out": snapshot["timed_out"],
         })
 
     global_health = float(f"{(total_health / max(relays_total, 1)):.1f}")
@@ -194,35 +84,200 @@ def get_dashboard_kpi(user=Depends(get_current_user)):
         "tenants_active": tenants_active,
         "keys_assigned": keys_assigned,
         "bandwidth_aggregated_mb": bandwidth_mbps,
+        "throughput_bytes_per_s": round(total_rate, 1),
         "total_peers": total_peers,
         "global_health_score": global_health,
         "relays": relay_details,
+        "relays_timed_out": sum(1 for r in relay_details if r["timed_out"]),
+        "generated_at": datetime.now().isoformat(),
+    }
+
+
+_RELAYS_SQL = """
+    SELECT s.id, s.name, s.port, s.web_port, s.tenant_id, t.name as tenant_name
+    FROM servers s
+    LEFT JOIN tenants t ON s.tenant_id = t.id
+"""
+
+
+def _compute_kpi(db, is_tenant_scoped: bool, tenant_id) -> dict:
+    """Live KPI computation for one scope."""
+    cur = db.cursor()
+
+    # Tenant counts
+    if is_tenant_scoped:
+        cur.execute("SELECT COUNT(*) FROM tenants WHERE is_active = TRUE AND id = %s", (tenant_id,))
+    else:
+        cur.execute("SELECT COUNT(*) FROM tenants WHERE is_active = TRUE")
+    tenants_active = cur.fetchone()[0]
+
+    # Keys Assigned
+    if is_tenant_scoped:
+        cur.execute("SELECT COUNT(*) FROM access_keys WHERE tenant_id = %s", (tenant_id,))
+    else:
+        cur.execute("SELECT COUNT(*) FROM access_keys")
+    keys_assigned = cur.fetchone()[0]
+
+    # Relay details for health computation
+    if is_tenant_scoped:
+        cur.execute(_RELAYS_SQL + "WHERE s.tenant_id = %s ORDER BY s.name", (tenant_id,))
+    else:
+        cur.execute(_RELAYS_SQL + "ORDER BY s.name")
+    relays = cur.fetchall()
+    db.release()
+
+    names = [r[1] for r in relays]
+    statuses = relay_statuses(names) if relays else {}
+    snapshots = get_snapshots(names)
+    return _kpi_payload(relays, statuses, snapshots, _fleet_health(names, statuses, snapshots),
+                        tenants_active, keys_assigned)
+
+
+# --- KPI snapshots ---
+# A background job materializes the KPI payload for the global scope and
+# every tenant, so /kpi is a dict lookup. With KPI_SNAPSHOT_PERSIST the
+# payloads are also upserted into kpi_snapshots, letting a replica that has
+# just started (or whose job is lagging) serve what another one built.
+_kpi_snapshots = {}              # scope ("global" / "tenant:<id>") -> payload
+_kpi_state = {"built_at": None, "build_ms": None, "builds": 0, "errors": 0}
+_kpi_scheduler = BackgroundScheduler(daemon=True)
+
+
+def _kpi_scope(is_tenant_scoped: bool, tenant_id) -> str:
+    return f"tenant:{tenant_id}" if is_tenant_scoped else "global"
+
+
+def refresh_kpi_snapshots():
+    """Rebuild every KPI snapshot from one pass over relays, tenants and keys."""
+    global _kpi_snapshots
+    started = time.monotonic()
+    try:
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT id, is_active FROM tenants")
+            tenants = cur.fetchall()
+            cur.execute("SELECT tenant_id, COUNT(*) FROM access_keys GROUP BY tenant_id")
+            keys_by_tenant = dict(cur.fetchall())
+            cur.execute(_RELAYS_SQL + "ORDER BY s.name")
+            relays = cur.fetchall()
+
+        names = [r[1] for r in relays]
+        statuses = relay_statuses(names) if relays else {}
+        snapshots = get_snapshots(names)
+        health_scores = _fleet_health(names, statuses, snapshots)
+        relays_by_tenant = defaultdict(list)
+        for r in relays:
+            relays_by_tenant[r[4]].append(r)
+
+        built = {"global": _kpi_payload(relays, statuses, snapshots, health_scores,
+                                        sum(1 for _, active in tenants if active),
+                                        sum(keys_by_tenant.values()))}
+        for tid, active in tenants:
+            built[_kpi_scope(True, tid)] = _kpi_payload(relays_by_tenant[tid], statuses, snapshots, health_scores,
+                                                       1 if active else 0, keys_by_tenant.get(tid, 0))
+        _kpi_snapshots = built
+
+        if KPI_SNAPSHOT_PERSIST:
+            with get_db() as conn:
+                cur = conn.cursor()
+                execute_values(cur, """
+                    INSERT INTO kpi_snapshots (scope, payload, generated_at) VALUES %s
+                    ON CONFLICT (scope) DO UPDATE SET payload = EXCLUDED.payload, generated_at = EXCLUDED.generated_at
+                """, [(scope, Json(p), p["generated_at"]) for scope, p in built.items()])
+                cur.execute("DELETE FROM kpi_snapshots WHERE NOT (scope = ANY(%s))", (list(built),))
+                conn.commit()
+
+        _kpi_state.update(built_at=time.monotonic(), build_ms=round((time.monotonic() - started) * 1000, 1),
+                          builds=_kpi_state["builds"] + 1)
+    except Exception as e:
+        _kpi_state["errors"] += 1
+        logger.error(f"KPI snapshot build failed: {e}")
+
+
+def _get_kpi_snapshot(scope: str, db):
+    payload = _kpi_snapshots.get(scope)
+    built_at = _kpi_state["built_at"]
+    fresh = built_at is not None and time.monotonic() - built_at <= 2 * KPI_SNAPSHOT_INTERVAL
+    if KPI_SNAPSHOT_PERSIST and (payload is None or not fresh):
+        cur = db.cursor()
+        cur.execute("SELECT payload FROM kpi_snapshots WHERE scope = %s", (scope,))
+        row = cur.fetchone()
+        db.release()
+        if row and (payload is None or row[0]["generated_at"] > payload["generated_at"]):
+            payload = row[0]
+    return payload
+
+
+def start_kpi_snapshots():
+    _kpi_scheduler.add_job(
+        refresh_kpi_snapshots,
+        "interval",
+        seconds=KPI_SNAPSHOT_INTERVAL,
+        id="kpi_snapshots",
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+        next_run_time=datetime.now(),
+    )
+    _kpi_scheduler.start()
+
+
+def stop_kpi_snapshots():
+    if _kpi_scheduler.running:
+        _kpi_scheduler.shutdown(wait=False)
+
+
+def kpi_snapshot_stats() -> dict:
+    built_at = _kpi_state["built_at"]
+    return {
+        **{k: v for k, v in _kpi_state.items() if k != "built_at"},
+        "scopes": len(_kpi_snapshots),
+        "age_s": round(time.monotonic() - built_at, 1) if built_at is not None else None,
+        "persisted": KPI_SNAPSHOT_PERSIST,
     }
 
 
+@router.get("/kpi")
+def get_dashboard_kpi(fresh: bool = False, user=Depends(get_current_user), db=Depends(get_request_db)):
+    """Latest KPI snapshot for the caller's scope; admins can pass ?fresh=1
+    to recompute it now."""
+    is_tenant_scoped = user.get("role") in ("engineer", "viewer")
+    tenant_id = user.get("tenant_id")
+    scope = _kpi_scope(is_tenant_scoped, tenant_id)
+
+    if not (fresh and user.get("role") == "admin"):
+        payload = _get_kpi_snapshot(scope, db)
+        if payload is not None:
+            return payload
+
+    # No snapshot yet (first build still running) or an explicit refresh
+    payload = _compute_kpi(db, is_tenant_scoped, tenant_id)
+    _kpi_snapshots[scope] = payload
+    return payload
+
+
 @router.get("/alerts")
-def get_dashboard_alerts(user=Depends(get_current_user)):
+def get_dashboard_alerts(user=Depends(get_current_user), db=Depends(get_request_db)):
     """Get critical alerts based on current system state."""
-    conn = get_db()
-    cur = conn.cursor()
-    
     is_tenant_scoped = user.get("role") in ("engineer", "viewer")
     tenant_id = user.get("tenant_id")
     
+    cur = db.cursor()
     if is_tenant_scoped:
         cur.execute("SELECT id, name FROM servers WHERE tenant_id = %s ORDER BY name", (tenant_id,))
     else:
         cur.execute("SELECT id, name FROM servers ORDER BY name")
     relays = cur.fetchall()
-    conn.close()
+    db.release()
+    statuses = relay_statuses([r[1] for r in relays]) if relays else {}
+    snapshots = get_snapshots([r[1] for r in relays])
 
     alerts = []
 
     for relay in relays:
         rid, name = relay
-        container_name = f"wpex-{name}"
 
-        status, restart_count = _get_k8s_pod_status(name)
+        status, restart_count = statuses[name]
 
         if status != "running":
             alerts.append({
@@ -241,7 +296,7 @@ def get_dashboard_alerts(user=Depends(get_current_user)):
             })
 
         # Check stats
-        stats = _fetch_relay_stats(container_name)
+        stats = snapshots[name]["stats"]
         if stats:
             total_hs = stats.get("total_handshakes", 0)
             success_hs = stats.get("successful_handshakes", 0)
@@ -257,18 +312,18 @@ def get_dashboard_alerts(user=Depends(get_current_user)):
 
     return {"alerts": alerts, "total": len(alerts),
             "critical": len([a for a in alerts if a["severity"] == "critical"]),
-            "warning": len([a for a in alerts if a["severity"] == "warning"])}
+            "warning": len([a for a in alerts if a["severity"] == "warning"]),
+            "timed_out_relays": [name for name, s in snapshots.items() if s["timed_out"]]}
 
 
 @router.get("/topology")
-def get_topology_data(user=Depends(get_current_user)):
+def get_topology_data(user=Depends(get_current_user), db=Depends(get_request_db)):
     """Return topology data for D3.js visualization."""
-    conn = get_db()
-    cur = conn.cursor()
-
     is_tenant_scoped = user.get("role") in ("engineer", "viewer")
     tenant_id = user.get("tenant_id")
 
+    cur = db.cursor()
+
     # Nodes — relays
     if is_tenant_scoped:
         cur.execute("""
@@ -321,28 +376,34 @@ def get_topology_data(user=Depends(get_current_user)):
     # Edges — key-to-relay links
     if is_tenant_scoped:
         cur.execute("""
-            SELECT skl.key_id, skl.server_id, ten.name as tenant_name, s.name as server_name, pgp_sym_decrypt(k.key_value, %s) as public_key
+            SELECT skl.key_id, skl.server_id, ten.name as tenant_name, s.name as server_name
             FROM server_keys_link skl
             JOIN access_keys k ON skl.key_id = k.id
             JOIN servers s ON skl.server_id = s.id
             LEFT JOIN tenants ten ON k.tenant_id = ten.id
             WHERE k.tenant_id = %s
-        """, (DATA_KEY, tenant_id))
+        """, (tenant_id,))
     else:
         cur.execute("""
-            SELECT skl.key_id, skl.server_id, ten.name as tenant_name, s.name as server_name, pgp_sym_decrypt(k.key_value, %s) as public_key
+            SELECT skl.key_id, skl.server_id, ten.name as tenant_name, s.name as server_name
             FROM server_keys_link skl
             JOIN access_keys k ON skl.key_id = k.id
             JOIN servers s ON skl.server_id = s.id
             LEFT JOIN tenants ten ON k.tenant_id = ten.id
-        """, (DATA_KEY,))
+        """)
         
     links = cur.fetchall()
+    db.release()
 
     server_names = {link[3] for link in links}
+    snapshots = get_snapshots(server_names)
+    for node in relay_nodes:
+        snapshot = snapshots.get(node["label"])
+        node["data"]["stale"] = snapshot["stale"] if snapshot else False
+        node["data"]["timed_out"] = snapshot["timed_out"] if snapshot else False
     server_stats = {}
     for s_name in server_names:
-        stats = _fetch_relay_stats(f"wpex-{s_name}")
+        stats = snapshots[s_name]["stats"]
         raw_peers = stats.get("peers", {}) if stats else {}
         
         peers_list = list(raw_peers.values()) if isinstance(raw_peers, dict) else (raw_peers if isinstance(raw_peers, list) else [])
@@ -364,7 +425,7 @@ def get_topology_data(user=Depends(get_current_user)):
         active_available = int(server_stats.get(s_name, {}).get("active_count", 0))
         
         for link in sub_links:
-            key_id, server_id, tenant_name, server_name, public_key = link
+            key_id, server_id, tenant_name, server_name = link
             
             if active_available > 0:
                 status = "active"
@@ -380,7 +441,6 @@ def get_topology_data(user=Depends(get_current_user)):
                 "status": status
             })
 
-    conn.close()
     return {
         "nodes": relay_nodes + key_nodes,
         "edges": edges,
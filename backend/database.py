@@ -4,8 +4,17 @@ Connection management, schema init, and migrations.
 Supports multi-tenant SaaS architecture.
 """
 import os
-import psycopg2
+import time
+import logging
+import threading
 import secrets
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+logger = logging.getLogger("database")
 
 # --- CONFIG ---
 DB_HOST = os.getenv("DB_HOST", "db")
@@ -25,24 +34,343 @@ DB_PASS = _read_secret("db_password", "admin")
 DATA_KEY = _read_secret("db_encryption_key", "mysecretkey")
 
 
-def get_db():
-    """Return a new psycopg2 connection."""
-    return psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS)
+# --- POOL CONFIG ---
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))          # max wait for a free connection (s)
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))       # TCP/auth timeout for new connections (s)
+DB_POOL_CHECK_IDLE = float(os.getenv("DB_POOL_CHECK_IDLE", "30"))    # ping connections idle longer than this (s)
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))       # close surplus connections idle longer than this (s)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within DB_POOL_TIMEOUT."""
+
+
+class ConnectionPool:
+    """Bounded, thread-safe psycopg2 connection pool.
+
+    Connections are opened lazily up to ``maxconn``; callers beyond that wait
+    up to ``timeout`` seconds for one to be returned. Idle connections are
+    pinged before reuse when they have been idle longer than ``check_idle``,
+    and connections above ``minconn`` are closed once idle for ``max_idle``.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, check_idle, max_idle):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.max_idle = max_idle
+        self._cond = threading.Condition()
+        self._idle = []          # LIFO stack of (conn, returned_at)
+        self._open = 0           # connections currently open (idle + in use)
+        self._in_use = 0
+        self._waiting = 0
+        self._stats = {
+            "acquired": 0,
+            "created": 0,
+            "discarded": 0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+            "wait_count": 0,
+            "wait_time_total_ms": 0.0,
+            "wait_time_max_ms": 0.0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(
+            host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS,
+            connect_timeout=DB_CONNECT_TIMEOUT,
+        )
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    @staticmethod
+    def _is_alive(conn) -> bool:
+        if conn.closed:
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def open(self):
+        """Pre-open ``minconn`` connections so the first requests don't pay the handshake."""
+        with self._cond:
+            missing = self.minconn - self._open
+            self._open += max(missing, 0)
+        for _ in range(max(missing, 0)):
+            try:
+                conn = self._connect()
+            except psycopg2.Error:
+                with self._cond:
+                    self._open -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def acquire(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        conn = None
+        with self._cond:
+            waited = False
+            while True:
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._open < self.maxconn:
+                    self._open += 1
+                    returned_at = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"No database connection available within {self.timeout}s")
+                waited = True
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_use += 1
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif time.monotonic() - returned_at > self.check_idle and not self._is_alive(conn):
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+                self._close_quietly(conn)
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        wait_ms = (time.monotonic() - started) * 1000
+        with self._cond:
+            self._stats["acquired"] += 1
+            if waited:
+                self._stats["wait_count"] += 1
+            self._stats["wait_time_total_ms"] += wait_ms
+            self._stats["wait_time_max_ms"] = max(self._stats["wait_time_max_ms"], wait_ms)
+        return conn
+
+    def release(self, conn, discard=False):
+        if not discard and not conn.closed:
+            # Never hand out a connection with an open (or aborted) transaction.
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+        discard = discard or bool(conn.closed)
+
+        now = time.monotonic()
+        stale = []
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._open -= 1
+                self._stats["discarded"] += 1
+            else:
+                self._idle.append((conn, now))
+            # Trim surplus connections that have sat idle too long (oldest are at the bottom).
+            while self._open > self.minconn and self._idle and now - self._idle[0][1] > self.max_idle:
+                stale.append(self._idle.pop(0)[0])
+                self._open -= 1
+            self._cond.notify()
+        if discard:
+            self._close_quietly(conn)
+        for c in stale:
+            self._close_quietly(c)
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            acquired = self._stats["acquired"]
+            return {
+                "size_max": self.maxconn,
+                "open": self._open,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                **self._stats,
+                "wait_time_avg_ms": round(self._stats["wait_time_total_ms"] / acquired, 3) if acquired else 0.0,
+                "wait_time_total_ms": round(self._stats["wait_time_total_ms"], 3),
+                "wait_time_max_ms": round(self._stats["wait_time_max_ms"], 3),
+            }
+
+
+_pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_CHECK_IDLE, DB_POOL_MAX_IDLE)
+
+
+def open_pool():
+    """Warm up the connection pool (called at application startup)."""
+    _pool.open()
+
+
+def close_pool():
+    """Close every idle pooled connection (called at application shutdown)."""
+    _pool.close_all()
+
+
+def pool_stats() -> dict:
+    """Pool counters for /api/health."""
+    return _pool.stats()
+
+
+def dedicated_connection():
+    """A connection outside the pool, for session state that must outlive a
+    request (e.g. an advisory lock). TCP keepalives make a dead peer show up
+    as an error within ~25s instead of hanging."""
+    return psycopg2.connect(
+        host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS,
+        connect_timeout=DB_CONNECT_TIMEOUT,
+        keepalives=1, keepalives_idle=10, keepalives_interval=5, keepalives_count=3,
+    )
+
+
+@contextmanager
+def get_db(db=None):
+    """Borrow a pooled psycopg2 connection.
+
+    Usage::
+
+        with get_db() as conn:
+            cur = conn.cursor()
+            ...
+            conn.commit()
+
+    Work that isn't committed explicitly is rolled back; the connection is
+    always returned to the pool, and discarded if it turned out to be broken.
+
+    When ``db`` is a request-scoped connection (see ``get_request_db``) it is
+    used as-is: the caller owns the transaction and nothing is committed,
+    rolled back or released here.
+    """
+    if db is not None:
+        yield db
+        return
+    conn = _pool.acquire()
+    discard = False
+    try:
+        yield conn
+    except BaseException:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            discard = True
+        raise
+    finally:
+        _pool.release(conn, discard=discard)
+
+
+
+class RequestConnection:
+    """One pooled connection shared by auth, endpoint and audit for a single request.
 
+    The connection is borrowed lazily on first use, so requests that never
+    touch the database never take a pool slot. ``release()`` hands it back
+    early (e.g. before slow K8s or relay calls); a later use borrows again.
+    Callbacks registered with ``after_commit()`` run once the transaction
+    commits and are dropped if it rolls back.
+    """
+
+    def __init__(self):
+        self._conn = None
+        self._after_commit = []
+
+    @property
+    def connection(self):
+        if self._conn is None:
+            self._conn = _pool.acquire()
+        return self._conn
+
+    def cursor(self, *args, **kwargs):
+        return self.connection.cursor(*args, **kwargs)
+
+    def after_commit(self, callback):
+        """Run *callback* after the next successful commit()."""
+        self._after_commit.append(callback)
+
+    def commit(self):
+        if self._conn is not None:
+            self._conn.commit()
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        self._after_commit = []
+        if self._conn is not None:
+            self._conn.rollback()
+
+    def release(self, discard=False):
+        """Return the connection to the pool; uncommitted work is rolled back."""
+        self._after_commit = []
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            _pool.release(conn, discard=discard)
+
+
+def get_request_db():
+    """FastAPI dependency yielding the request's shared ``RequestConnection``.
+
+    Handlers commit explicitly once the business write and its audit row
+    are both in the transaction; anything left uncommitted (including on
+    error) is rolled back when the request ends.
+    """
+    db = RequestConnection()
+    discard = False
+    try:
+        yield db
+    except BaseException:
+        try:
+            db.rollback()
+        except psycopg2.Error:
+            discard = True
+        raise
+    finally:
+        db.release(discard=discard)
 
 def generate_api_key():
     """Generate a secure random API key."""
     return secrets.token_urlsafe(48)
 
 
-def init_db():
-    """Create tables if they don't exist."""
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("CREATE EXTENSION IF NOT EXISTS pgcrypto;")
-
-    # ── Original tables ──────────────────────────────────
-    cur.execute("""
+# --- MIGRATIONS ---
+# Numbered, append-only schema changes. Each migration runs once, in its own
+# transaction, and is recorded in schema_version; never edit a migration that
+# has shipped — add a new one instead.
+MIGRATIONS = [
+    (1, "baseline schema", [
+        "CREATE EXTENSION IF NOT EXISTS pgcrypto;",
+        """
         CREATE TABLE IF NOT EXISTS access_keys (
             id SERIAL PRIMARY KEY,
             alias VARCHAR(50),
@@ -50,9 +378,8 @@ def init_db():
             tenant_id INT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-    """)
-
-    cur.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS servers (
             id SERIAL PRIMARY KEY,
             name VARCHAR(50) UNIQUE NOT NULL,
@@ -60,17 +387,15 @@ def init_db():
             web_port INT UNIQUE NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-    """)
-
-    cur.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS server_keys_link (
             server_id INT REFERENCES servers(id) ON DELETE CASCADE,
             key_id INT REFERENCES access_keys(id) ON DELETE CASCADE,
             PRIMARY KEY (server_id, key_id)
         );
-    """)
-
-    cur.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS users (
             id SERIAL PRIMARY KEY,
             username VARCHAR(50) UNIQUE NOT NULL,
@@ -78,17 +403,15 @@ def init_db():
             status VARCHAR(20) DEFAULT 'pending',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-    """)
-
-    cur.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS token_blacklist (
             jti VARCHAR(36) PRIMARY KEY,
             expires_at TIMESTAMP NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-    """)
-
-    cur.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS tenants (
             id SERIAL PRIMARY KEY,
             name VARCHAR(100) UNIQUE NOT NULL,
@@ -105,9 +428,8 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-    """)
-
-    cur.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS sites (
             id SERIAL PRIMARY KEY,
             tenant_id INT REFERENCES tenants(id) ON DELETE CASCADE,
@@ -118,9 +440,8 @@ def init_db():
             is_active BOOLEAN DEFAULT TRUE,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-    """)
-
-    cur.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS audit_log (
             id SERIAL PRIMARY KEY,
             user_id INT,
@@ -131,42 +452,138 @@ def init_db():
             ip_address VARCHAR(45),
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
-    """)
-
-    conn.commit()
-    conn.close()
-
-
-def migrate_db():
-    """Run any pending schema migrations."""
-    conn = get_db()
-    try:
-        cur = conn.cursor()
+        """,
         # Original migration
-        cur.execute("ALTER TABLE servers ADD COLUMN IF NOT EXISTS web_port INT DEFAULT 8080;")
-        # SaaS migrations — RBAC fields on users
-        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS role VARCHAR(20) DEFAULT 'engineer';")
-        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS tenant_id INT;")
-        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS mfa_secret VARCHAR(100);")
-        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS ip_whitelist TEXT[];")
+        "ALTER TABLE servers ADD COLUMN IF NOT EXISTS web_port INT DEFAULT 8080;",
+        # SaaS — RBAC fields on users
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS role VARCHAR(20) DEFAULT 'engineer';",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS tenant_id INT;",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS mfa_secret VARCHAR(100);",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS ip_whitelist TEXT[];",
         # Onboarding: status field (pending/active/disabled)
-        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS status VARCHAR(20) DEFAULT 'active';")
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS status VARCHAR(20) DEFAULT 'active';",
         # Relay tenant association
-        cur.execute("ALTER TABLE servers ADD COLUMN IF NOT EXISTS tenant_id INT;")
-        cur.execute("ALTER TABLE servers ADD COLUMN IF NOT EXISTS region VARCHAR(50);")
-        cur.execute("ALTER TABLE servers ADD COLUMN IF NOT EXISTS description TEXT DEFAULT '';")
+        "ALTER TABLE servers ADD COLUMN IF NOT EXISTS tenant_id INT;",
+        "ALTER TABLE servers ADD COLUMN IF NOT EXISTS region VARCHAR(50);",
+        "ALTER TABLE servers ADD COLUMN IF NOT EXISTS description TEXT DEFAULT '';",
         # Access Keys tenant isolation
-        cur.execute("ALTER TABLE access_keys ADD COLUMN IF NOT EXISTS tenant_id INT;")
-
+        "ALTER TABLE access_keys ADD COLUMN IF NOT EXISTS tenant_id INT;",
         # Tenant registration status
-        cur.execute("ALTER TABLE tenants ADD COLUMN IF NOT EXISTS status VARCHAR(20) DEFAULT 'active';")
-        
+        "ALTER TABLE tenants ADD COLUMN IF NOT EXISTS status VARCHAR(20) DEFAULT 'active';",
         # Obsolete Tunnels removal
-        cur.execute("DROP TABLE IF EXISTS relay_config_versions CASCADE;")
-        cur.execute("DROP TABLE IF EXISTS tunnels CASCADE;")
-        
-        conn.commit()
-    except:
-        pass
-    finally:
-        conn.close()
+        "DROP TABLE IF EXISTS relay_config_versions CASCADE;",
+        "DROP TABLE IF EXISTS tunnels CASCADE;",
+    ]),
+    (2, "secondary indexes for tenant-scoped and join-heavy queries", [
+        # Tenant-scoped list endpoints (filter + their ORDER BY)
+        "CREATE INDEX IF NOT EXISTS idx_servers_tenant_port ON servers (tenant_id, port);",
+        "CREATE INDEX IF NOT EXISTS idx_access_keys_tenant_created ON access_keys (tenant_id, created_at DESC);",
+        "CREATE INDEX IF NOT EXISTS idx_sites_tenant_name ON sites (tenant_id, name);",
+        "CREATE INDEX IF NOT EXISTS idx_users_tenant ON users (tenant_id);",
+        # Link table: the PK covers (server_id, key_id); key -> servers needs the reverse
+        # (also used by ON DELETE CASCADE when a key is removed)
+        "CREATE INDEX IF NOT EXISTS idx_server_keys_link_key_server ON server_keys_link (key_id, server_id);",
+        # Audit log: newest-first paging, optionally filtered by user or entity type
+        "CREATE INDEX IF NOT EXISTS idx_audit_log_created ON audit_log (created_at DESC);",
+        "CREATE INDEX IF NOT EXISTS idx_audit_log_user_created ON audit_log (user_id, created_at DESC);",
+        "CREATE INDEX IF NOT EXISTS idx_audit_log_entity_created ON audit_log (entity_type, created_at DESC);",
+        # Incremental blacklist refresh in auth
+        "CREATE INDEX IF NOT EXISTS idx_token_blacklist_created ON token_blacklist (created_at);",
+    ]),
+    (3, "materialized dashboard KPI snapshots", [
+        """
+        CREATE TABLE IF NOT EXISTS kpi_snapshots (
+            scope VARCHAR(64) PRIMARY KEY,
+            payload JSONB NOT NULL,
+            generated_at TIMESTAMP NOT NULL
+        );
+        """,
+    ]),
+    (4, "relay to Zabbix host map", [
+        """
+        CREATE TABLE IF NOT EXISTS zabbix_hosts (
+            server_id INT PRIMARY KEY REFERENCES servers(id) ON DELETE CASCADE,
+            hostid VARCHAR(32) NOT NULL,
+            item_keys TEXT[] NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+    ]),
+    (5, "background job status shared by replicas", [
+        """
+        CREATE TABLE IF NOT EXISTS job_status (
+            job VARCHAR(64) PRIMARY KEY,
+            status JSONB NOT NULL,
+            replica VARCHAR(128) NOT NULL,
+            updated_at TIMESTAMP NOT NULL
+        );
+        """,
+    ]),
+]
+
+_MIGRATION_LOCK_ID = 0x77706578  # pg_advisory_lock key ("wpex")
+
+
+class MigrationError(Exception):
+    """A schema migration failed; the database is left at the previous version."""
+
+
+def _schema_version(cur) -> int:
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+
+def run_migrations():
+    """Bring the schema up to the latest migration.
+
+    A warm start costs a single SELECT on schema_version. Otherwise the
+    pending migrations are applied under a session advisory lock so several
+    replicas booting at once don't race; whoever waits re-reads the version
+    after acquiring the lock and usually finds nothing left to do.
+    """
+    latest = MIGRATIONS[-1][0]
+    with get_db() as conn:
+        cur = conn.cursor()
+        try:
+            current = _schema_version(cur)
+        except psycopg2.errors.UndefinedTable:
+            current = 0
+        conn.rollback()
+        if current >= latest:
+            return current
+
+        cur.execute("SELECT pg_advisory_lock(%s)", (_MIGRATION_LOCK_ID,))
+        try:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+            conn.commit()
+            current = _schema_version(cur)
+
+            for version, description, statements in MIGRATIONS:
+                if version <= current:
+                    continue
+                started = time.monotonic()
+                try:
+                    for sql in statements:
+                        cur.execute(sql)
+                    cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                                (version, description))
+                    conn.commit()
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    raise MigrationError(f"Migration {version} ({description}) failed: {e}") from e
+                logger.info(f"Applied migration {version} ({description}) in {time.monotonic() - started:.2f}s")
+                current = version
+        finally:
+            # Session locks outlive transactions; a broken connection drops it anyway.
+            try:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (_MIGRATION_LOCK_ID,))
+                conn.commit()
+            except psycopg2.Error:
+                pass
+    return current
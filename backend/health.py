@@ -0,0 +1,94 @@
+"""
+WPEX Orchestrator — Relay Health Engine
+Weighted health score (0-100) for many relays at once: the inputs are
+packed into columnar arrays and every score is computed in one NumPy pass.
+Used by the relay proxy and the dashboard so the formula lives in one place.
+"""
+import os
+
+import numpy as np
+
+COMPONENTS = ("container", "restarts", "handshake_rate", "connectivity")
+DEFAULT_WEIGHTS = {"container": 0.2, "restarts": 0.15, "handshake_rate": 0.35, "connectivity": 0.3}
+RESTART_PENALTY = float(os.getenv("HEALTH_RESTART_PENALTY", "10"))   # points lost per container restart
+
+
+def _load_weights() -> dict:
+    """DEFAULT_WEIGHTS, overridden by HEALTH_WEIGHTS="container=0.2,connectivity=0.4,..."."""
+    weights = dict(DEFAULT_WEIGHTS)
+    for part in filter(None, os.getenv("HEALTH_WEIGHTS", "").split(",")):
+        name, _, value = part.partition("=")
+        if name.strip() in weights:
+            weights[name.strip()] = float(value)
+    return weights
+
+
+HEALTH_WEIGHTS = _load_weights()
+
+
+def _peer_counts(stats):
+    peers = stats.get("peers", {})
+    if not isinstance(peers, dict):
+        return 0, 0
+    return len(peers), sum(1 for p in peers.values() if isinstance(p, dict) and p.get("status") == 1)
+
+
+def score_relays(relays, details: bool = False) -> list:
+    """Score a batch of relays.
+
+    *relays* is a sequence of (status, restart_count, stats) where stats is
+    the relay's /stats JSON or None. Returns one dict per relay with
+    "health_score" and, per component that applies, its score — plus a
+    human-readable "detail" when *details* is set.
+    """
+    n = len(relays)
+    if n == 0:
+        return []
+
+    running = np.fromiter((r[0] == "running" for r in relays), dtype=bool, count=n)
+    restarts = np.fromiter((r[1] or 0 for r in relays), dtype=np.float64, count=n)
+    has_stats = np.fromiter((bool(r[2]) for r in relays), dtype=bool, count=n)
+    hs_total = np.fromiter(((r[2] or {}).get("total_handshakes", 0) for r in relays), dtype=np.float64, count=n)
+    hs_ok = np.fromiter(((r[2] or {}).get("successful_handshakes", 0) for r in relays), dtype=np.float64, count=n)
+    peer_counts = [_peer_counts(r[2]) if r[2] else (0, 0) for r in relays]
+    peers_total = np.fromiter((p[0] for p in peer_counts), dtype=np.float64, count=n)
+    peers_up = np.fromiter((p[1] for p in peer_counts), dtype=np.float64, count=n)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = np.column_stack([
+            np.full(n, 100.0),
+            np.maximum(0.0, 100.0 - restarts * RESTART_PENALTY),
+            np.where(hs_total > 0, np.round(hs_ok / hs_total * 100, 1), 100.0),
+            np.where(peers_total > 0, np.round(peers_up / peers_total * 100, 1), 100.0),
+        ])
+    # Handshake and connectivity only count when the relay answered /stats
+    present = np.column_stack([running, running, running & has_stats, running & has_stats])
+    weights = np.array([HEALTH_WEIGHTS[c] for c in COMPONENTS]) * present
+    total_weight = weights.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        health = np.where(total_weight > 0, (scores * weights).sum(axis=1) / total_weight, 0.0)
+    health = np.round(np.where(running, health, 0.0), 1)
+
+    results = []
+    for i, (status, rc, stats) in enumerate(relays):
+        if not running[i]:
+            components = {"container": {"score": 0}}
+        else:
+            components = {c: {"score": float(scores[i, j])} for j, c in enumerate(COMPONENTS) if present[i, j]}
+        if details:
+            if not running[i]:
+                components["container"]["detail"] = f"Container {status}"
+            else:
+                components["container"]["detail"] = "Running"
+                components["restarts"]["detail"] = f"{int(restarts[i])} restarts"
+                if has_stats[i]:
+                    components["handshake_rate"]["detail"] = (
+                        f"{int(hs_ok[i])}/{int(hs_total[i])} success" if hs_total[i] > 0 else "No handshakes yet")
+                    components["connectivity"]["detail"] = (
+                        f"{int(peers_up[i])}/{int(peers_total[i])} peers connected" if peers_total[i] > 0 else "No peers tracked")
+        results.append({"health_score": float(health[i]), "components": components})
+    return results
+
+
+def score_relay(status: str, restart_count: int, stats, details: bool = False) -> dict:
+    return score_relays([(status, restart_count, stats)], details)[0]
@@ -0,0 +1,290 @@
+"""
+WPEX Orchestrator — Kubernetes Relay Cache
+Informer-style list+watch of relay Pods and Deployments in the wpex
+namespace, indexed by `app` label, so status lookups don't hit the API
+server on every request.
+"""
+import os, time, threading, logging
+
+NAMESPACE = "wpex"
+K8S_WATCH_TIMEOUT = int(os.getenv("K8S_WATCH_TIMEOUT", "300"))        # server-side watch timeout, then re-watch (s)
+K8S_RESYNC_INTERVAL = float(os.getenv("K8S_RESYNC_INTERVAL", "900"))  # full relist period (s)
+K8S_MAX_BACKOFF = 60                                                  # retry cap after a failed list/watch (s)
+
+logger = logging.getLogger("k8s_cache")
+
+_config_lock = threading.Lock()
+_config_state = {"loaded": None}
+
+
+def init_k8s() -> bool:
+    """Load in-cluster (or local kube) config once per process."""
+    with _config_lock:
+        if _config_state["loaded"] is None:
+            from kubernetes import config
+            try:
+                config.load_incluster_config()
+                _config_state["loaded"] = True
+            except Exception:
+                try:
+                    config.load_kube_config()
+                    _config_state["loaded"] = True
+                except Exception as e:
+                    logger.warning(f"No Kubernetes config available: {e}")
+                    _config_state["loaded"] = False
+        return _config_state["loaded"]
+
+
+def _pod_summary(pod) -> dict:
+    st = pod.status
+    return {
+        "status": st.phase.lower() if st.phase else "unknown",
+        "ready": any(c.type == "Ready" and c.status == "True" for c in st.conditions) if st.conditions else False,
+        "restart_count": sum(c.restart_count for c in st.container_statuses) if st.container_statuses else 0,
+        "image": pod.spec.containers[0].image if pod.spec.containers else None,
+        "started_at": st.start_time.isoformat() if st.start_time else None,
+        "pod_name": pod.metadata.name,
+        "node_name": pod.spec.node_name,
+    }
+
+
+def _deployment_summary(dep) -> dict:
+    return {"name": dep.metadata.name}
+
+
+class _Informer:
+    """Keeps one resource kind of the namespace mirrored in memory."""
+
+    def __init__(self, kind, list_fn, summarize):
+        self.kind = kind
+        self._list_fn = list_fn
+        self._summarize = summarize
+        self._objects = {}           # object name -> (app label, summary)
+        self._by_app = {}            # app label -> {object name: summary}
+        self._lock = threading.Lock()
+        self._watch = None
+        self.synced = False
+        self.stats = {"resyncs": 0, "watch_restarts": 0, "events": 0, "errors": 0,
+                      "synced_at": None, "last_event_at": None}
+
+    # --- store ---
+    def _put(self, obj):
+        name = obj.metadata.name
+        app = (obj.metadata.labels or {}).get("app")
+        self._drop(name)
+        summary = self._summarize(obj)
+        self._objects[name] = (app, summary)
+        if app:
+            self._by_app.setdefault(app, {})[name] = summary
+
+    def _drop(self, name):
+        old = self._objects.pop(name, None)
+        if old and old[0]:
+            bucket = self._by_app.get(old[0], {})
+            bucket.pop(name, None)
+            if not bucket:
+                self._by_app.pop(old[0], None)
+
+    def has(self, name) -> bool:
+        with self._lock:
+            return name in self._objects
+
+    def get(self, app):
+        """Summaries of objects with this `app` label, sorted by name (API list order)."""
+        with self._lock:
+            bucket = self._by_app.get(app, {})
+            return [bucket[n] for n in sorted(bucket)]
+
+    # --- list + watch loop ---
+    def _relist(self):
+        resp = self._list_fn(namespace=NAMESPACE)
+        with self._lock:
+            self._objects.clear()
+            self._by_app.clear()
+            for obj in resp.items:
+                self._put(obj)
+            self.synced = True
+            self.stats["resyncs"] += 1
+            self.stats["synced_at"] = time.monotonic()
+        return resp.metadata.resource_version
+
+    def run(self, stop):
+        from kubernetes import watch
+        backoff = 1
+        while not stop.is_set():
+            try:
+                rv = self._relist()
+                backoff = 1
+                relist_at = time.monotonic() + K8S_RESYNC_INTERVAL
+                while not stop.is_set() and time.monotonic() < relist_at:
+                    self._watch = watch.Watch()
+                    expired = False
+                    for event in self._watch.stream(self._list_fn, namespace=NAMESPACE, resource_version=rv,
+                                                    timeout_seconds=K8S_WATCH_TIMEOUT,
+                                                    _request_timeout=K8S_WATCH_TIMEOUT + 30):
+                        if event["type"] == "ERROR":
+                            # Usually 410 Gone: our resourceVersion is too old, relist.
+                            expired = True
+                            break
+                        obj = event["object"]
+                        rv = obj.metadata.resource_version
+                        with self._lock:
+                            if event["type"] == "DELETED":
+                                self._drop(obj.metadata.name)
+                            else:
+                                self._put(obj)
+                            self.stats["events"] += 1
+                            self.stats["last_event_at"] = time.monotonic()
+                    if expired:
+                        break
+                    self.stats["watch_restarts"] += 1
+            except Exception as e:
+                if stop.is_set():
+                    break
+                logger.warning(f"{self.kind} watch failed, retrying in {backoff}s: {e}")
+                with self._lock:
+                    self.synced = False
+                    self.stats["errors"] += 1
+                stop.wait(backoff)
+                backoff = min(backoff * 2, K8S_MAX_BACKOFF)
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.stop()
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            synced_at, last_event_at = self.stats["synced_at"], self.stats["last_event_at"]
+            return {
+                **{k: v for k, v in self.stats.items() if k not in ("synced_at", "last_event_at")},
+                "synced": self.synced,
+                "objects": len(self._objects),
+                "last_resync_age_s": round(now - synced_at, 1) if synced_at is not None else None,
+                "last_event_age_s": round(now - last_event_at, 1) if last_event_at is not None else None,
+            }
+
+
+_pods = None
+_deployments = None
+_stop = threading.Event()
+_threads = []
+_fallback_stats = {"pod_reads": 0, "deployment_reads": 0}
+
+
+def start():
+    """Start the Pod and Deployment informers (no-op without a kube config)."""
+    global _pods, _deployments
+    if _threads or not init_k8s():
+        return
+    from kubernetes import client
+    core_api, apps_api = client.CoreV1Api(), client.AppsV1Api()
+    _pods = _Informer("Pod", core_api.list_namespaced_pod, _pod_summary)
+    _deployments = _Informer("Deployment", apps_api.list_namespaced_deployment, _deployment_summary)
+    _stop.clear()
+    for informer in (_pods, _deployments):
+        t = threading.Thread(target=informer.run, args=(_stop,), name=f"k8s-{informer.kind.lower()}-informer", daemon=True)
+        t.start()
+        _threads.append(t)
+
+
+def stop():
+    _stop.set()
+    for informer in (_pods, _deployments):
+        if informer is not None:
+            informer.stop()
+    _threads.clear()
+
+
+# --- Lookups (cache when synced, direct API read otherwise) ---
+def get_pod(name: str):
+    """Summary of the relay's pod, or None when it has none. Raises on API errors."""
+    app = f"wpex-{name}"
+    if _pods is not None and _pods.synced:
+        pods = _pods.get(app)
+    else:
+        from kubernetes import client
+        init_k8s()
+        _fallback_stats["pod_reads"] += 1
+        items = client.CoreV1Api().list_namespaced_pod(namespace=NAMESPACE, label_selector=f"app={app}").items
+        pods = [_pod_summary(p) for p in items]
+    return pods[0] if pods else None
+
+
+def has_deployment(name: str) -> bool:
+    app = f"wpex-{name}"
+    if _deployments is not None and _deployments.synced:
+        return _deployments.has(app)
+    from kubernetes import client
+    from kubernetes.client.rest import ApiException
+    init_k8s()
+    _fallback_stats["deployment_reads"] += 1
+    try:
+        client.AppsV1Api().read_namespaced_deployment(name=app, namespace=NAMESPACE)
+        return True
+    except ApiException as e:
+        if e.status == 404:
+            return False
+        raise
+
+
+def _status_of(pod, deployed, readiness):
+    if pod is None:
+        return ("stopped" if deployed() else "not_created"), 0
+    status = pod["status"]
+    if readiness and status == "running" and not pod["ready"]:
+        status = "starting"
+    return status, pod["restart_count"]
+
+
+def relay_status(name: str, readiness: bool = True):
+    """(status, restart_count) where status is the pod phase ("starting" while
+    running but not Ready when *readiness* is set), "stopped" for a
+    deployment without pods, "not_created" or "error"."""
+    try:
+        return _status_of(get_pod(name), lambda: has_deployment(name), readiness)
+    except Exception:
+        return "error", 0
+
+
+def relay_statuses(names, readiness: bool = True) -> dict:
+    """relay_status for many relays; before the informers have synced this
+    costs one namespace-wide listing instead of one read per relay."""
+    if _pods is not None and _pods.synced and _deployments.synced:
+        return {name: relay_status(name, readiness) for name in names}
+    from kubernetes import client
+    init_k8s()
+    try:
+        _fallback_stats["pod_reads"] += 1
+        by_app = {}
+        for pod in client.CoreV1Api().list_namespaced_pod(namespace=NAMESPACE).items:
+            app = (pod.metadata.labels or {}).get("app")
+            if app:
+                by_app.setdefault(app, []).append(pod)
+        deployments = None
+
+        def deployed(app):
+            nonlocal deployments
+            if deployments is None:
+                _fallback_stats["deployment_reads"] += 1
+                items = client.AppsV1Api().list_namespaced_deployment(namespace=NAMESPACE).items
+                deployments = {d.metadata.name for d in items}
+            return app in deployments
+
+        statuses = {}
+        for name in names:
+            app = f"wpex-{name}"
+            pods = sorted(by_app.get(app, []), key=lambda p: p.metadata.name)
+            pod = _pod_summary(pods[0]) if pods else None
+            statuses[name] = _status_of(pod, lambda: deployed(app), readiness)
+        return statuses
+    except Exception:
+        return {name: ("error", 0) for name in names}
+
+
+def k8s_cache_stats() -> dict:
+    return {
+        "pods": _pods.snapshot() if _pods is not None else None,
+        "deployments": _deployments.snapshot() if _deployments is not None else None,
+        "fallback_reads": dict(_fallback_stats),
+    }
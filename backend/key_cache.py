@@ -0,0 +1,86 @@
+"""
+WPEX Orchestrator — Decrypted Key Cache
+In-process LRU of decrypted access keys so listing paths don't run
+pgp_sym_decrypt on unchanged ciphertext. Plaintext only lives in this
+process' memory; it is never persisted.
+"""
+import os, threading
+from collections import OrderedDict
+
+from database import DATA_KEY
+
+KEY_CACHE_SIZE = int(os.getenv("KEY_CACHE_SIZE", "50000"))   # max cached keys (LRU)
+
+# Entries are keyed by access key id and tagged with the row's xmin, so a
+# rewritten key_value (new row version) is a miss even on another replica's
+# write. Invalidation on create/delete just keeps the cache from holding dead
+# rows; the generation counter stops an in-flight decrypt from re-adding them.
+_key_cache = OrderedDict()       # key_id -> (xmin, plaintext)
+_key_cache_lock = threading.Lock()
+_key_cache_stats = {"hits": 0, "misses": 0, "decrypt_queries": 0, "invalidations": 0}
+_key_cache_gen = [0]
+
+
+def decrypt_keys(versions, db) -> dict:
+    """Return {key_id: plaintext} for an iterable of (key_id, xmin) pairs.
+
+    Cached entries whose xmin still matches are reused; every miss is
+    decrypted in a single query on *db*.
+    """
+    result, missing = {}, set()
+    with _key_cache_lock:
+        for key_id, xmin in versions:
+            entry = _key_cache.get(key_id)
+            if entry is not None and entry[0] == xmin:
+                _key_cache.move_to_end(key_id)
+                result[key_id] = entry[1]
+                _key_cache_stats["hits"] += 1
+            elif key_id not in result:
+                missing.add(key_id)
+        _key_cache_stats["misses"] += len(missing)
+        gen = _key_cache_gen[0]
+    if not missing:
+        return result
+
+    cur = db.cursor()
+    cur.execute(
+        "SELECT id, xmin::text, pgp_sym_decrypt(key_value, %s) FROM access_keys WHERE id = ANY(%s)",
+        (DATA_KEY, list(missing)),
+    )
+    rows = cur.fetchall()
+    with _key_cache_lock:
+        _key_cache_stats["decrypt_queries"] += 1
+        for key_id, xmin, plaintext in rows:
+            result[key_id] = plaintext
+            if _key_cache_gen[0] == gen:
+                _key_cache[key_id] = (xmin, plaintext)
+                _key_cache.move_to_end(key_id)
+        while len(_key_cache) > KEY_CACHE_SIZE:
+            _key_cache.popitem(last=False)
+    return result
+
+
+def get_public_keys(key_ids, db) -> list:
+    """Decrypted keys for the given ids (unknown ids are skipped)."""
+    cur = db.cursor()
+    cur.execute("SELECT id, xmin::text FROM access_keys WHERE id = ANY(%s)", (list(key_ids),))
+    versions = cur.fetchall()
+    plain = decrypt_keys(versions, db)
+    return [plain[key_id] for key_id, _ in versions if key_id in plain]
+
+
+def invalidate_key(key_id: int):
+    with _key_cache_lock:
+        _key_cache_gen[0] += 1
+        if _key_cache.pop(key_id, None) is not None:
+            _key_cache_stats["invalidations"] += 1
+
+
+def key_cache_stats() -> dict:
+    with _key_cache_lock:
+        lookups = _key_cache_stats["hits"] + _key_cache_stats["misses"]
+        return {
+            **_key_cache_stats,
+            "cached_keys": len(_key_cache),
+            "hit_ratio": round(_key_cache_stats["hits"] / lookups, 3) if lookups else None,
+        }
@@ -0,0 +1,153 @@
+"""
+WPEX Orchestrator — Leader Election
+Only one backend process (replica or uvicorn worker) should run the jobs
+whose side effects must not be duplicated, like the Zabbix sync. The
+leader is whoever holds a Postgres session advisory lock on a dedicated
+connection: when it dies its session ends, the lock is released and
+another process takes over at its next check (LEADER_CHECK_INTERVAL).
+
+Job status is published to the job_status table so every replica reports
+the leader's view, not its own idle one.
+"""
+import os, time, socket, threading, logging
+from datetime import datetime
+
+import psycopg2
+from psycopg2.extras import Json
+
+from database import dedicated_connection, get_db
+
+LEADER_LOCK_ID = 0x77706579                                              # pg_advisory_lock key ("wpey")
+LEADER_CHECK_INTERVAL = float(os.getenv("LEADER_CHECK_INTERVAL", "10"))  # acquire / keep-alive period (s)
+REPLICA_ID = f"{os.getenv('HOSTNAME') or socket.gethostname()}:{os.getpid()}"
+
+logger = logging.getLogger("leader")
+
+_state = {"conn": None, "leader": False, "since": None, "elections": 0, "last_check": None, "error": None}
+_lock = threading.Lock()
+_stop = threading.Event()
+_thread = {"t": None}
+
+
+def _close():
+    conn, _state["conn"] = _state["conn"], None
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def _check():
+    """Try to become leader, or confirm the session holding the lock is alive."""
+    with _lock:
+        try:
+            if _state["conn"] is None or _state["conn"].closed:
+                _state["conn"] = dedicated_connection()
+                _state["conn"].autocommit = True
+            cur = _state["conn"].cursor()
+            if _state["leader"]:
+                cur.execute("SELECT 1")       # the lock lives exactly as long as this session
+            else:
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (LEADER_LOCK_ID,))
+                if cur.fetchone()[0]:
+                    _state.update(leader=True, since=time.time(), elections=_state["elections"] + 1)
+                    logger.info(f"{REPLICA_ID} is now the leader for background jobs")
+            cur.close()
+            _state["error"] = None
+        except psycopg2.Error as e:
+            if _state["leader"]:
+                logger.warning(f"{REPLICA_ID} lost leadership: {e}")
+            _state.update(leader=False, since=None, error=str(e))
+            _close()
+        _state["last_check"] = time.time()
+
+
+def _run():
+    _check()
+    while not _stop.wait(LEADER_CHECK_INTERVAL):
+        _check()
+
+
+def start():
+    """Start campaigning (first attempt runs immediately)."""
+    _stop.clear()
+    _thread["t"] = threading.Thread(target=_run, name="leader-election", daemon=True)
+    _thread["t"].start()
+
+
+def stop():
+    """Step down so another replica takes over without waiting for a timeout."""
+    _stop.set()
+    with _lock:
+        if _state["leader"] and _state["conn"] is not None:
+            try:
+                _state["conn"].cursor().execute("SELECT pg_advisory_unlock(%s)", (LEADER_LOCK_ID,))
+            except psycopg2.Error:
+                pass
+        _state.update(leader=False, since=None)
+        _close()
+
+
+def is_leader() -> bool:
+    return _state["leader"]
+
+
+def publish_status(job: str, status: dict):
+    """Store a job's status where every replica can read it."""
+    try:
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO job_status (job, status, replica, updated_at) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (job) DO UPDATE SET status = EXCLUDED.status, replica = EXCLUDED.replica,
+                                                updated_at = EXCLUDED.updated_at
+            """, (job, Json(status), REPLICA_ID, datetime.now()))
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Could not publish {job} status: {e}")
+
+
+def read_status(job: str):
+    """(status, replica, updated_at) last published for *job*, or None."""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT status, replica, updated_at FROM job_status WHERE job = %s", (job,))
+        return cur.fetchone()
+
+
+def _like_prefix(prefix: str) -> str:
+    return prefix.replace("%", r"\%").replace("_", r"\_") + "%"
+
+
+def list_status(prefix: str) -> list:
+    """(job, status, replica, updated_at) of every job whose name starts with *prefix*, oldest first."""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT job, status, replica, updated_at FROM job_status WHERE job LIKE %s ORDER BY updated_at",
+                    (_like_prefix(prefix),))
+        return cur.fetchall()
+
+
+def prune_status(prefix: str, max_age: float):
+    """Forget published statuses of jobs whose name starts with *prefix*, once older than *max_age* seconds."""
+    try:
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM job_status WHERE job LIKE %s AND updated_at < %s",
+                        (_like_prefix(prefix), datetime.fromtimestamp(time.time() - max_age)))
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Could not prune {prefix} statuses: {e}")
+
+
+def leader_stats() -> dict:
+    since, last = _state["since"], _state["last_check"]
+    return {
+        "replica": REPLICA_ID,
+        "is_leader": _state["leader"],
+        "leader_for_s": round(time.time() - since, 1) if since is not None else None,
+        "elections": _state["elections"],
+        "last_check_age_s": round(time.time() - last, 1) if last is not None else None,
+        "error": _state["error"],
+    }
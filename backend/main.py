@@ -5,18 +5,26 @@ SaaS multi-tenant VPN dashboard API.
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from database import init_db, migrate_db
-from auth import router as auth_router
+from database import run_migrations, open_pool, close_pool, pool_stats
+from auth import router as auth_router, load_token_blacklist, token_cache_stats, user_cache_stats
+from key_cache import key_cache_stats
+import k8s_cache
+import relay_stats
+from relay_client import relay_client_stats
+from timeseries import timeseries_stats
+import zabbix_client
+import leader
 from servers import router as servers_router
 from keys import router as keys_router
 from tenants import router as tenants_router
-from dashboard_kpi import router as dashboard_router
+from dashboard_kpi import router as dashboard_router, start_kpi_snapshots, stop_kpi_snapshots, kpi_snapshot_stats
 from relay_proxy import router as relay_proxy_router
 
-from audit import router as audit_router
+from audit import router as audit_router, start_audit_writer, stop_audit_writer, audit_queue_stats
 from zabbix_api import router as zabbix_router
 from zabbix_traffic import router as zabbix_traffic_router
-from zabbix_sender import router as zabbix_sender_router, start_scheduler
+from zabbix_sender import router as zabbix_sender_router, start_scheduler, stop_scheduler
+from metrics_sinks import router as metrics_router, metrics_sinks_stats
 
 app = FastAPI(title="WPEX Orchestrator SaaS API", version="3.0")
 
@@ -41,15 +49,50 @@ app.include_router(audit_router)
 app.include_router(zabbix_router)
 app.include_router(zabbix_traffic_router)
 app.include_router(zabbix_sender_router)
+app.include_router(metrics_router)
 
 
 @app.on_event("startup")
 def startup():
-    init_db()
-    migrate_db()
+    open_pool()
+    run_migrations()
+    start_audit_writer()
+    load_token_blacklist()
+    k8s_cache.start()
+    relay_stats.start()
+    start_kpi_snapshots()
+    leader.start()
     start_scheduler()
 
 
+@app.on_event("shutdown")
+def shutdown():
+    stop_kpi_snapshots()
+    stop_scheduler()          # before stepping down: no sync may overlap the next leader's
+    leader.stop()
+    relay_stats.stop()
+    k8s_cache.stop()
+    zabbix_client.logout()
+    stop_audit_writer()
+    close_pool()
+
+
 @app.get("/api/health")
 def health():
-    return {"status": "ok", "version": "3.0"}
+    return {
+        "status": "ok",
+        "version": "3.0",
+        "db_pool": pool_stats(),
+        "token_cache": token_cache_stats(),
+        "user_cache": user_cache_stats(),
+        "key_cache": key_cache_stats(),
+        "k8s_cache": k8s_cache.k8s_cache_stats(),
+        "relay_stats": relay_stats.relay_stats_stats(),
+        "relay_client": relay_client_stats(),
+        "kpi_snapshots": kpi_snapshot_stats(),
+        "timeseries": timeseries_stats(),
+        "zabbix_client": zabbix_client.zabbix_client_stats(),
+        "leader": leader.leader_stats(),
+        "metrics_sinks": metrics_sinks_stats(),
+        "audit_queue": audit_queue_stats(),
+    }
@@ -0,0 +1,206 @@
+"""
+WPEX Orchestrator — Relay Metrics Sinks
+The relay metric set, extracted once per sync cycle from the stats
+collector's snapshots and handed to every registered sink (Zabbix
+trapper, the OpenMetrics /metrics endpoint, ...), so relays are polled
+once whatever the number of monitoring backends.
+"""
+import os, time, threading, logging
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException, Response
+
+import leader
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")    # when set, /metrics wants "Authorization: Bearer <token>"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+logger = logging.getLogger("metrics_sinks")
+
+# kind: counter (cumulative) or gauge; type: int or float values
+METRIC_DEFS = [
+    {"key": "wpex.bytes_rx",          "name": "Bytes Received (total)", "units": "B", "kind": "counter", "type": "int"},
+    {"key": "wpex.bytes_tx",          "name": "Bytes Sent (total)",     "units": "B", "kind": "counter", "type": "int"},
+    {"key": "wpex.bytes_transferred", "name": "Bytes Transferred",      "units": "B", "kind": "counter", "type": "int"},
+    {"key": "wpex.active_peers",      "name": "Active Peers",           "units": "",  "kind": "gauge",   "type": "int"},
+    {"key": "wpex.total_peers",       "name": "Total Peers",            "units": "",  "kind": "gauge",   "type": "int"},
+    {"key": "wpex.handshake_success", "name": "Handshake Success Rate", "units": "%", "kind": "gauge",   "type": "float"},
+    {"key": "wpex.total_handshakes",  "name": "Total Handshakes",       "units": "",  "kind": "counter", "type": "int"},
+    {"key": "wpex.uptime_seconds",    "name": "Relay Uptime",           "units": "s", "kind": "gauge",   "type": "float"},
+]
+
+
+def extract_metrics(stats: dict) -> dict:
+    """Parse wpex stats JSON into flat metrics dict.
+
+    Accepts both the raw /stats shape (peers keyed by public key, status 1
+    when connected) and the /api/v1/stats shape (peer list, "connected").
+    Raw /stats only has the relay-wide total_bytes_transferred: per-direction
+    bytes and uptime are None unless the payload carries them, and sinks
+    skip None values rather than report a zero.
+    """
+    peers = stats.get("peers") or []
+    if isinstance(peers, dict):
+        peers = list(peers.values())
+    peers = [p for p in peers if isinstance(p, dict)]
+    active_peers = sum(1 for p in peers if p.get("status") in (1, "connected"))
+    directional = any("bytes_received" in p or "bytes_sent" in p for p in peers)
+    bytes_rx = sum(p.get("bytes_received", 0) for p in peers) if directional else None
+    bytes_tx = sum(p.get("bytes_sent", 0) for p in peers) if directional else None
+    if "total_bytes_transferred" in stats:
+        bytes_total = stats.get("total_bytes_transferred") or 0
+    else:
+        bytes_total = bytes_rx + bytes_tx if directional else None
+    total_hs = stats.get("total_handshakes", 0)
+    success_hs = stats.get("successful_handshakes", 0)
+    success_rate = round((success_hs / total_hs * 100), 2) if total_hs > 0 else 0.0
+    uptime = stats.get("uptime_seconds")
+
+    return {
+        "wpex.bytes_rx":          bytes_rx,
+        "wpex.bytes_tx":          bytes_tx,
+        "wpex.bytes_transferred": bytes_total,
+        "wpex.active_peers":      active_peers,
+        "wpex.total_peers":       len(peers),
+        "wpex.handshake_success": success_rate,
+        "wpex.total_handshakes":  total_hs,
+        "wpex.uptime_seconds":    uptime,
+    }
+
+
+def make_sample(name: str, snapshot: dict, labels: dict) -> dict:
+    """One relay's metrics at the time it was polled, as handed to the sinks."""
+    return {
+        "relay": name,
+        "host": f"wpex-{name}",
+        "clock": int(snapshot["fetched_at"]),
+        "labels": labels,
+        "metrics": extract_metrics(snapshot["stats"]),
+    }
+
+
+# ── Sinks ─────────────────────────────────────────────────────────────
+class MetricsSink:
+    """A destination for relay samples. write() gets every sample of a sync
+    cycle and returns a summary dict (an "errors" list in it is merged into
+    the cycle's errors). Slow sinks may call *progress(n)* with the number
+    of samples handled so far."""
+
+    name = "sink"
+
+    def write(self, samples: list, progress=None) -> dict:
+        raise NotImplementedError
+
+
+_sinks = []
+_sinks_lock = threading.Lock()
+
+
+def register_sink(sink: MetricsSink):
+    """Add *sink*, replacing a registered sink with the same name."""
+    with _sinks_lock:
+        _sinks[:] = [s for s in _sinks if s.name != sink.name] + [sink]
+
+
+def write_samples(samples: list, errors: list, progress=None) -> dict:
+    """Write *samples* to every sink; a failing sink doesn't stop the others."""
+    with _sinks_lock:
+        sinks = list(_sinks)
+    results = {}
+    for sink in sinks:
+        started = time.monotonic()
+        try:
+            result = sink.write(samples, progress) or {}
+        except Exception as e:
+            logger.error(f"Metrics sink {sink.name} failed: {e}")
+            result = {"errors": [f"{sink.name}: {e}"]}
+        errors.extend(result.pop("errors", []))
+        result["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+        results[sink.name] = result
+    return results
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class OpenMetricsSink(MetricsSink):
+    """Keeps the latest cycle's samples and renders them in the OpenMetrics
+    text format. The rendering is cached until the next write, so scrapes
+    between two sync cycles only copy bytes."""
+
+    name = "openmetrics"
+
+    def __init__(self):
+        self._samples = []
+        self._written_at = None
+        self._rendered = {}          # is_leader -> bytes
+        self._lock = threading.Lock()
+        self.stats = {"writes": 0, "renders": 0, "scrapes": 0}
+
+    def write(self, samples: list, progress=None) -> dict:
+        with self._lock:
+            self._samples = list(samples)
+            self._written_at = time.time()
+            self._rendered = {}
+            self.stats["writes"] += 1
+        return {"relays": len(samples)}
+
+    def _render(self, is_leader: bool) -> bytes:
+        lines = [
+            "# TYPE wpex_exporter_leader gauge",
+            "# HELP wpex_exporter_leader Whether this replica runs the sync that feeds the relay metrics.",
+            f'wpex_exporter_leader{{replica="{_escape(leader.REPLICA_ID)}"}} {1 if is_leader else 0}',
+        ]
+        if self._written_at is not None:
+            lines += [
+                "# TYPE wpex_exporter_last_sync_timestamp_seconds gauge",
+                "# HELP wpex_exporter_last_sync_timestamp_seconds When the relay metrics were last refreshed.",
+                f"wpex_exporter_last_sync_timestamp_seconds {self._written_at:.3f}",
+            ]
+        for metric in METRIC_DEFS:
+            name = metric["key"].replace(".", "_")
+            suffix = "_total" if metric["kind"] == "counter" else ""
+            lines.append(f"# TYPE {name} {metric['kind']}")
+            lines.append(f"# HELP {name} {metric['name']}.")
+            for sample in self._samples:
+                value = sample["metrics"].get(metric["key"])
+                if value is None:
+                    continue
+                labels = ",".join(f'{k}="{_escape(v)}"' for k, v in
+                                  (("relay", sample["relay"]), *sorted(sample["labels"].items())) if v is not None)
+                lines.append(f"{name}{suffix}{{{labels}}} {value} {sample['clock']}")
+        lines.append("# EOF")
+        return ("\n".join(lines) + "\n").encode()
+
+    def render(self) -> bytes:
+        is_leader = leader.is_leader()
+        with self._lock:
+            self.stats["scrapes"] += 1
+            body = self._rendered.get(is_leader)
+            if body is None:
+                body = self._rendered[is_leader] = self._render(is_leader)
+                self.stats["renders"] += 1
+        return body
+
+
+openmetrics = OpenMetricsSink()
+register_sink(openmetrics)
+
+
+def metrics_sinks_stats() -> dict:
+    with _sinks_lock:
+        names = [s.name for s in _sinks]
+    return {"sinks": names, "openmetrics": dict(openmetrics.stats)}
+
+
+# ── /metrics ──────────────────────────────────────────────────────────
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics")
+def metrics(authorization: Optional[str] = Header(None)):
+    """Relay metrics in the OpenMetrics text format, labelled by tenant and region."""
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Token non valido")
+    return Response(content=openmetrics.render(), media_type=OPENMETRICS_CONTENT_TYPE)
@@ -0,0 +1,136 @@
+"""
+WPEX Orchestrator — Relay HTTP Client
+One pooled keep-alive session for every call to a relay's :8080 API, with
+cached service DNS, uniform timeouts/retries and per-relay counters.
+"""
+import os, time, socket, threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RELAY_NAMESPACE = "wpex"
+RELAY_HTTP_PORT = 8080
+STATS_PATH = "/stats"                       # raw stats; every consumer reads this shape
+RELOAD_PATH = "/api/v1/config/reload"
+
+RELAY_CONNECT_TIMEOUT = float(os.getenv("RELAY_CONNECT_TIMEOUT", "1"))   # TCP connect timeout (s)
+RELAY_READ_TIMEOUT = float(os.getenv("RELAY_READ_TIMEOUT", "3"))         # response read timeout (s)
+RELAY_RELOAD_TIMEOUT = float(os.getenv("RELAY_RELOAD_TIMEOUT", "10"))    # read timeout of a config reload (s)
+RELAY_RETRIES = int(os.getenv("RELAY_RETRIES", "2"))                     # connect retries (any method), read/5xx retries (GET)
+RELAY_DNS_TTL = float(os.getenv("RELAY_DNS_TTL", "300"))                 # keep resolved service IPs this long (s)
+RELAY_POOL_HOSTS = int(os.getenv("RELAY_POOL_HOSTS", "256"))             # relays with a live connection pool
+RELAY_POOL_SIZE = int(os.getenv("RELAY_POOL_SIZE", "4"))                 # keep-alive connections per relay
+
+
+def _build_session() -> requests.Session:
+    retry = Retry(
+        total=RELAY_RETRIES,
+        connect=RELAY_RETRIES,
+        read=RELAY_RETRIES,
+        status=RELAY_RETRIES,
+        backoff_factor=0.2,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=RELAY_POOL_HOSTS, pool_maxsize=RELAY_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    return session
+
+
+_session = _build_session()
+
+_dns_cache = {}                  # service host -> (address, expires_at)
+_dns_lock = threading.Lock()
+_relay_counters = {}             # relay name -> counters dict
+_counters_lock = threading.Lock()
+
+
+def relay_host(name: str) -> str:
+    return f"wpex-{name}.{RELAY_NAMESPACE}.svc.cluster.local"
+
+
+def _resolve(host: str) -> str:
+    now = time.monotonic()
+    with _dns_lock:
+        entry = _dns_cache.get(host)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+    try:
+        address = socket.getaddrinfo(host, RELAY_HTTP_PORT, type=socket.SOCK_STREAM)[0][4][0]
+    except OSError:
+        return host              # let the request itself surface the lookup error
+    with _dns_lock:
+        _dns_cache[host] = (address, now + RELAY_DNS_TTL)
+    return address
+
+
+def _forget(host: str):
+    with _dns_lock:
+        _dns_cache.pop(host, None)
+
+
+def _record(name: str, latency_ms: float, error):
+    with _counters_lock:
+        c = _relay_counters.setdefault(name, {
+            "requests": 0, "errors": 0, "last_error": None,
+            "last_latency_ms": None, "avg_latency_ms": None,
+        })
+        c["requests"] += 1
+        c["last_latency_ms"] = latency_ms
+        c["avg_latency_ms"] = latency_ms if c["avg_latency_ms"] is None else round(0.8 * c["avg_latency_ms"] + 0.2 * latency_ms, 1)
+        if error is not None:
+            c["errors"] += 1
+            c["last_error"] = error
+
+
+def request(method: str, name: str, path: str, timeout=None, **kwargs) -> requests.Response:
+    """Call a relay's HTTP API. Raises requests exceptions like requests.request."""
+    host = relay_host(name)
+    address = _resolve(host)
+    netloc = f"[{address}]" if ":" in address else address
+    headers = {**kwargs.pop("headers", {}), "Host": f"{host}:{RELAY_HTTP_PORT}"}
+    started = time.monotonic()
+    try:
+        resp = _session.request(
+            method, f"http://{netloc}:{RELAY_HTTP_PORT}{path}", headers=headers,
+            timeout=timeout or (RELAY_CONNECT_TIMEOUT, RELAY_READ_TIMEOUT), **kwargs,
+        )
+    except requests.RequestException as e:
+        if isinstance(e, requests.ConnectionError):
+            _forget(host)        # the service may have been recreated with a new IP
+        _record(name, round((time.monotonic() - started) * 1000, 1), type(e).__name__)
+        raise
+    _record(name, round((time.monotonic() - started) * 1000, 1),
+            None if resp.status_code < 500 else f"HTTP {resp.status_code}")
+    return resp
+
+
+def get(name: str, path: str, **kwargs) -> requests.Response:
+    return request("GET", name, path, **kwargs)
+
+
+def post(name: str, path: str, **kwargs) -> requests.Response:
+    return request("POST", name, path, **kwargs)
+
+
+def forget_relay(name: str):
+    """Drop cached DNS and counters of a deleted relay."""
+    _forget(relay_host(name))
+    with _counters_lock:
+        _relay_counters.pop(name, None)
+
+
+def relay_client_stats() -> dict:
+    with _counters_lock:
+        relays = {name: dict(c) for name, c in _relay_counters.items()}
+    with _dns_lock:
+        dns_entries = len(_dns_cache)
+    return {
+        "requests": sum(c["requests"] for c in relays.values()),
+        "errors": sum(c["errors"] for c in relays.values()),
+        "dns_cached_hosts": dns_entries,
+        "relays": relays,
+    }
@@ -4,161 +4,162 @@ Proxies requests to individual WPEX relay containers.
 Provides enhanced container info and diagnostics.
 """
 import os
-import requests as http_requests
 from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
 from typing import Optional
 
-from database import get_db
+from database import get_request_db
 from auth import get_current_user
+from k8s_cache import init_k8s, get_pod, relay_statuses
+from relay_stats import get_stats, get_snapshots, relay_schedule
+from health import score_relay, score_relays
+from timeseries import TS_RESOLUTION, TS_RETENTION, fleet_rates, rates as relay_rates
 
 router = APIRouter(prefix="/api/relays", tags=["relays"])
 
 
-def _init_k8s():
-    try:
-        from kubernetes import config
-        config.load_incluster_config()
-    except:
-        try:
-            from kubernetes import config
-            config.load_kube_config()
-        except:
-            pass
-
 def _get_k8s_pod_info(name):
-    from kubernetes import client
-    _init_k8s()
     try:
-        core_api = client.CoreV1Api()
-        pods = core_api.list_namespaced_pod(namespace="wpex", label_selector=f"app=wpex-{name}")
-        if not pods.items:
-            return {"status": "not_found", "restart_count": 0, "image": None, "started_at": None, "pod_name": None}
-        
-        pod = pods.items[0]
-        status = pod.status.phase.lower()
-        restart_count = sum([c.restart_count for c in pod.status.container_statuses]) if pod.status.container_statuses else 0
-        image = pod.spec.containers[0].image
-        started_at = pod.status.start_time.isoformat() if pod.status.start_time else None
-        return {
-            "status": "running" if status == "running" else status,
-            "restart_count": restart_count,
-            "image": image,
-            "started_at": started_at,
-            "pod_name": pod.metadata.name,
-            "node_name": pod.spec.node_name
-        }
-    except:
+        pod = get_pod(name)
+    except Exception:
         return {"status": "error", "restart_count": 0, "image": None, "started_at": None, "pod_name": None}
+    if pod is None:
+        return {"status": "not_found", "restart_count": 0, "image": None, "started_at": None, "pod_name": None}
+    return {k: pod[k] for k in ("status", "restart_count", "image", "started_at", "pod_name", "node_name")}
 
 
-def _get_relay_name(relay_id: int) -> Optional[str]:
-    conn = get_db()
-    cur = conn.cursor()
+def _get_relay_name(relay_id: int, db) -> Optional[str]:
+    """Resolve the relay name, then hand the request connection back to the pool
+    since every caller goes on to slow K8s or relay HTTP calls."""
+    cur = db.cursor()
     cur.execute("SELECT name FROM servers WHERE id = %s", (relay_id,))
     row = cur.fetchone()
-    conn.close()
+    db.release()
     return row[0] if row else None
 
 
 @router.get("/{relay_id}/stats")
-def get_relay_stats(relay_id: int, user=Depends(get_current_user)):
-    """Proxy stats from WPEX relay container."""
-    name = _get_relay_name(relay_id)
+def get_relay_stats(relay_id: int, max_age: Optional[float] = None, user=Depends(get_current_user), db=Depends(get_request_db)):
+    """Stats of a WPEX relay container from the collector cache
+    (max_age=0 forces a fresh fetch)."""
+    name = _get_relay_name(relay_id, db)
     if not name:
         raise HTTPException(status_code=404, detail="Relay non trovato")
 
-    container_name = f"wpex-{name}"
-    try:
-        resp = http_requests.get(f"http://{container_name}.wpex.svc.cluster.local:8080/stats", timeout=3)
-        if resp.status_code == 200:
-            return resp.json()
-    except Exception as e:
-        pass
+    stats = get_stats(name, max_age)
+    if stats is not None:
+        return stats
 
     return {"error": "Statistiche non disponibili", "relay": name}
 
 
+def _visible_relays(ids: Optional[str], user, db) -> list:
+    """(id, name) of the relays in *ids* ("1,2,3"; all when None) the user may see."""
+    query = "SELECT id, name FROM servers WHERE TRUE "
+    params = []
+    if ids:
+        try:
+            params.append([int(i) for i in ids.split(",") if i.strip()])
+        except ValueError:
+            raise HTTPException(status_code=400, detail="ids deve essere una lista di interi separati da virgola")
+        query += "AND id = ANY(%s) "
+    if user.get("role") in ("engineer", "viewer"):
+        query += "AND tenant_id = %s "
+        params.append(user.get("tenant_id"))
+    cur = db.cursor()
+    cur.execute(query + "ORDER BY id", params)
+    relays = cur.fetchall()
+    db.release()
+    return relays
+
+
+@router.get("/health")
+def get_relays_health(ids: Optional[str] = None, user=Depends(get_current_user), db=Depends(get_request_db)):
+    """Health scores of many relays in one call (?ids=1,2,3; all visible relays when omitted)."""
+    relays = _visible_relays(ids, user, db)
+    names = [r[1] for r in relays]
+    statuses = relay_statuses(names, readiness=False) if relays else {}
+    snapshots = get_snapshots(names)
+    scored = score_relays([(*statuses[n], snapshots[n]["stats"]) for n in names], details=True)
+    return {"relays": [
+        {
+            "relay_id": rid, "relay_name": name,
+            **result,
+            "status": statuses[name][0], "restart_count": statuses[name][1],
+            "stats_available": snapshots[name]["stats"] is not None,
+            "stale": snapshots[name]["stale"], "timed_out": snapshots[name]["timed_out"],
+        }
+        for (rid, name), result in zip(relays, scored)
+    ]}
+
+
+@router.get("/rates")
+def get_relays_rates(window: int = 300, ids: Optional[str] = None, user=Depends(get_current_user), db=Depends(get_request_db)):
+    """Throughput/handshake rates and peer counts of many relays over the last *window* seconds."""
+    window = max(TS_RESOLUTION, min(window, TS_RETENTION))
+    relays = _visible_relays(ids, user, db)
+    summaries = fleet_rates([r[1] for r in relays], window)
+    return {"window": window, "relays": [
+        {"relay_id": rid, "relay_name": name, "rates": summaries[name]} for rid, name in relays
+    ]}
+
+
+@router.get("/schedule")
+def get_relays_schedule(ids: Optional[str] = None, user=Depends(get_current_user), db=Depends(get_request_db)):
+    """Stats collector poll plan per relay: mode (normal/busy/backoff), period,
+    next poll time and last poll duration."""
+    relays = _visible_relays(ids, user, db)
+    plan = relay_schedule({r[1] for r in relays})
+    return {"relays": [
+        {"relay_id": rid, "relay_name": name, "schedule": plan.get(name)} for rid, name in relays
+    ]}
+
+
+@router.get("/{relay_id}/rates")
+def get_relay_rates(relay_id: int, window: int = 3600, step: Optional[int] = None,
+                    user=Depends(get_current_user), db=Depends(get_request_db)):
+    """Rate time series of a relay from the in-memory ring buffer, optionally
+    downsampled to one point per *step* seconds."""
+    name = _get_relay_name(relay_id, db)
+    if not name:
+        raise HTTPException(status_code=404, detail="Relay non trovato")
+
+    window = max(TS_RESOLUTION, min(window, TS_RETENTION))
+    series = relay_rates(name, window, step)
+    return {"relay_id": relay_id, "relay_name": name, "window": window,
+            "step": max(TS_RESOLUTION, step or TS_RESOLUTION), **series}
+
+
 @router.get("/{relay_id}/health")
-def get_relay_health(relay_id: int, user=Depends(get_current_user)):
+def get_relay_health(relay_id: int, user=Depends(get_current_user), db=Depends(get_request_db)):
     """Get computed health score for a relay."""
-    name = _get_relay_name(relay_id)
+    name = _get_relay_name(relay_id, db)
     if not name:
         raise HTTPException(status_code=404, detail="Relay non trovato")
 
-    container_name = f"wpex-{name}"
-
     # K8s status
     docker_info = _get_k8s_pod_info(name)
     docker_info["uptime"] = None
 
     # WPEX stats
-    stats = None
-    try:
-        resp = http_requests.get(f"http://{container_name}.wpex.svc.cluster.local:8080/stats", timeout=2)
-        if resp.status_code == 200:
-            stats = resp.json()
-    except:
-        pass
-
-    # Compute health
-    score = 100.0
-    components = {}
-
-    if docker_info["status"] != "running":
-        score = 0.0
-        components["container"] = {"score": 0, "detail": f"Container {docker_info['status']}"}
-    else:
-        components["container"] = {"score": 100, "detail": "Running"}
-
-        # Restart penalty
-        rc = docker_info["restart_count"]
-        rc_score = max(0, 100 - rc * 10)
-        components["restarts"] = {"score": rc_score, "detail": f"{rc} restarts"}
-
-        if stats:
-            # Handshake rate
-            total_hs = stats.get("total_handshakes", 0)
-            success_hs = stats.get("successful_handshakes", 0)
-            if total_hs > 0:
-                hs_rate = success_hs / total_hs * 100
-                components["handshake_rate"] = {"score": round(hs_rate, 1), "detail": f"{success_hs}/{total_hs} success"}
-            else:
-                components["handshake_rate"] = {"score": 100, "detail": "No handshakes yet"}
-
-            # Peer connectivity
-            peers = stats.get("peers", {})
-            if isinstance(peers, dict) and len(peers) > 0:
-                connected = sum(1 for p in peers.values() if isinstance(p, dict) and p.get("status") == 1)
-                conn_pct = connected / len(peers) * 100
-                components["connectivity"] = {"score": round(conn_pct, 1), "detail": f"{connected}/{len(peers)} peers connected"}
-            else:
-                components["connectivity"] = {"score": 100, "detail": "No peers tracked"}
-
-        # Weighted average
-        weights = {"container": 0.2, "restarts": 0.15, "handshake_rate": 0.35, "connectivity": 0.3}
-        weighted_sum = 0
-        total_weight = 0
-        for k, w in weights.items():
-            if k in components:
-                weighted_sum += components[k]["score"] * w
-                total_weight += w
-        score = round(weighted_sum / total_weight, 1) if total_weight > 0 else 0
+    stats = get_stats(name)
+
+    result = score_relay(docker_info["status"], docker_info["restart_count"], stats, details=True)
 
     return {
         "relay_id": relay_id,
         "relay_name": name,
-        "health_score": score,
-        "components": components,
+        "health_score": result["health_score"],
+        "components": result["components"],
         "docker": docker_info,
         "stats_available": stats is not None,
     }
 
 
 @router.get("/{relay_id}/container")
-def get_relay_container_info(relay_id: int, user=Depends(get_current_user)):
+def get_relay_container_info(relay_id: int, user=Depends(get_current_user), db=Depends(get_request_db)):
     """Get detailed Docker container info for a relay."""
-    name = _get_relay_name(relay_id)
+    name = _get_relay_name(relay_id, db)
     if not name:
         raise HTTPException(status_code=404, detail="Relay non trovato")
 
@@ -202,9 +203,9 @@ class DiagnosticRequest(BaseModel):
     target: str
 
 @router.post("/{relay_id}/diagnostics/ping")
-def ping_from_relay(relay_id: int, body: DiagnosticRequest, user=Depends(get_current_user)):
+def ping_from_relay(relay_id: int, body: DiagnosticRequest, user=Depends(get_current_user), db=Depends(get_request_db)):
     """Execute ping from relay container."""
-    name = _get_relay_name(relay_id)
+    name = _get_relay_name(relay_id, db)
     if not name:
         raise HTTPException(status_code=404)
 
@@ -232,9 +233,9 @@ def ping_from_relay(relay_id: int, body: DiagnosticRequest, user=Depends(get_cur
 
 
 @router.post("/{relay_id}/diagnostics/traceroute")
-def traceroute_from_relay(relay_id: int, body: DiagnosticRequest, user=Depends(get_current_user)):
+def traceroute_from_relay(relay_id: int, body: DiagnosticRequest, user=Depends(get_current_user), db=Depends(get_request_db)):
     """Execute traceroute from relay container."""
-    name = _get_relay_name(relay_id)
+    name = _get_relay_name(relay_id, db)
     if not name:
         raise HTTPException(status_code=404)
 
@@ -262,15 +263,15 @@ def traceroute_from_relay(relay_id: int, body: DiagnosticRequest, user=Depends(g
 
 
 @router.post("/{relay_id}/restart")
-def restart_relay(relay_id: int, user=Depends(get_current_user)):
+def restart_relay(relay_id: int, user=Depends(get_current_user), db=Depends(get_request_db)):
     """Restart a relay container."""
-    name = _get_relay_name(relay_id)
+    name = _get_relay_name(relay_id, db)
     if not name:
         raise HTTPException(status_code=404)
 
     try:
         from kubernetes import client
-        _init_k8s()
+        init_k8s()
         apps_api = client.AppsV1Api()
         import datetime
         patch = {'spec': {'template': {'metadata': {'annotations': {'wpex.io/restartedAt': str(datetime.datetime.now())}}}}}
@@ -285,33 +286,23 @@ class UpgradeRequest(BaseModel):
 
 
 @router.post("/{relay_id}/upgrade")
-def upgrade_relay(relay_id: int, body: UpgradeRequest, user=Depends(get_current_user)):
+def upgrade_relay(relay_id: int, body: UpgradeRequest, user=Depends(get_current_user), db=Depends(get_request_db)):
     """Upgrade a relay container to a new image version."""
-    conn = get_db()
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute("SELECT name, port, web_port FROM servers WHERE id = %s", (relay_id,))
     row = cur.fetchone()
     if not row:
-        conn.close()
         raise HTTPException(status_code=404)
 
     name, port, web_port = row
-
-    # Get current keys
-    cur.execute("""
-        SELECT pgp_sym_decrypt(k.key_value, (SELECT value FROM (SELECT 'mysecretkey' as value) as v))
-        FROM access_keys k
-        JOIN server_keys_link l ON k.id = l.key_id
-        WHERE l.server_id = %s
-    """, (relay_id,))
-    conn.close()
+    db.release()
 
     image = body.image if body.image else "nikoceps/wpex-monitoring:latest"
     image = body.image if body.image else "nikoceps/wpex-monitoring:latest"
 
     try:
         from kubernetes import client
-        _init_k8s()
+        init_k8s()
         apps_api = client.AppsV1Api()
         patch = {'spec': {'template': {'spec': {'containers': [{'name': 'relay', 'image': image}]}}}}
         apps_api.patch_namespaced_deployment(name=f"wpex-{name}", namespace="wpex", body=patch)
@@ -0,0 +1,311 @@
+"""
+WPEX Orchestrator — Relay Stats Collector
+Polls every relay's /stats endpoint on a schedule and keeps the latest
+snapshot per relay in memory, so the dashboard, relay proxy and Zabbix
+sender don't each fetch stats one relay at a time.
+
+Each relay has its own slot, phase-shifted across RELAY_STATS_INTERVAL so
+polls are spread out instead of bursting. Unreachable relays back off
+exponentially up to RELAY_STATS_MAX_BACKOFF, busy ones (traffic above
+RELAY_BUSY_BYTES_PER_S or a change in connected peers) are polled every
+RELAY_STATS_BUSY_INTERVAL, and RELAY_STATS_WORKERS caps concurrent polls.
+
+With several backend processes only the leader (see leader) polls on the
+schedule, so replicas don't multiply the load on every relay; the others
+fetch on demand when a reader needs a snapshot older than
+RELAY_STATS_MAX_AGE. Their time series then only hold those reads: set
+RELAY_STATS_LEADER_ONLY=0 to poll on every process.
+"""
+import os, math, time, zlib, random, threading, logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Optional
+
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from database import get_db
+import relay_client
+import timeseries
+import leader
+
+RELAY_STATS_INTERVAL = float(os.getenv("RELAY_STATS_INTERVAL", "15"))   # collection period (s)
+RELAY_STATS_MAX_AGE = float(os.getenv("RELAY_STATS_MAX_AGE", "60"))     # older snapshots are re-fetched on read (s)
+RELAY_STATS_WORKERS = int(os.getenv("RELAY_STATS_WORKERS", "16"))       # concurrent relay fetches
+RELAY_FANOUT_DEADLINE = float(os.getenv("RELAY_FANOUT_DEADLINE", "2.5"))  # overall budget of a multi-relay read (s)
+RELAY_STATS_BUSY_INTERVAL = float(os.getenv("RELAY_STATS_BUSY_INTERVAL", "5"))    # poll period of busy relays (s)
+RELAY_STATS_MAX_BACKOFF = float(os.getenv("RELAY_STATS_MAX_BACKOFF", "300"))      # poll period cap of dead relays (s)
+RELAY_STATS_JITTER = float(os.getenv("RELAY_STATS_JITTER", "0.1"))                # +/- fraction of the period
+RELAY_BUSY_BYTES_PER_S = float(os.getenv("RELAY_BUSY_BYTES_PER_S", "1000000"))    # traffic that makes a relay busy
+RELAY_STATS_LEADER_ONLY = os.getenv("RELAY_STATS_LEADER_ONLY", "1") == "1"      # scheduled polls on the leader only
+RELAY_STATS_TICK = 1.0                                                            # scheduler resolution (s)
+
+logger = logging.getLogger("relay_stats")
+
+_snapshots = {}                  # relay name -> {"stats", "fetched_at", "latency_ms", "error"}
+_snapshots_lock = threading.Lock()
+_inflight = {}                   # relay name -> Future of a running fetch
+_pool = ThreadPoolExecutor(max_workers=RELAY_STATS_WORKERS, thread_name_prefix="relay-stats")
+_schedule = {}                   # relay name -> poll slot, see _new_entry()
+_collector_stats = {"polls": 0, "poll_failures": 0, "on_demand_fetches": 0, "fanout_timeouts": 0,
+                    "relay_syncs": 0, "relays_synced_at": None}
+
+
+def _fetch(name: str) -> dict:
+    """Fetch one relay's stats and store the snapshot (failures included)."""
+    started = time.monotonic()
+    stats, error = None, None
+    try:
+        resp = relay_client.get(name, relay_client.STATS_PATH)
+        if resp.status_code == 200:
+            stats = resp.json()
+        else:
+            error = f"HTTP {resp.status_code}"
+    except Exception as e:
+        error = str(e)
+    snapshot = {
+        "stats": stats,
+        "fetched_at": time.time(),
+        "latency_ms": round((time.monotonic() - started) * 1000, 1),
+        "error": error,
+    }
+    with _snapshots_lock:
+        _snapshots[name] = snapshot
+        _reschedule(name, snapshot)
+    if isinstance(stats, dict):
+        timeseries.record(name, stats, snapshot["fetched_at"])
+    return snapshot
+
+
+def _fetch_async(name: str):
+    """Start a fetch for *name*, or join the one already running."""
+    with _snapshots_lock:
+        future = _inflight.get(name)
+        if future is None:
+            future = _inflight[name] = _pool.submit(_fetch, name)
+        else:
+            return future
+
+    def done(f):
+        with _snapshots_lock:
+            if _inflight.get(name) is f:
+                del _inflight[name]
+    future.add_done_callback(done)
+    return future
+
+
+def _is_fresh(name, snapshot, limit) -> bool:
+    """Young enough for the caller — or a failure of a relay that is backing
+    off, so readers don't re-poll a dead relay on every request."""
+    if snapshot is None or limit <= 0:
+        return False
+    if time.time() - snapshot["fetched_at"] <= limit:
+        return True
+    entry = _schedule.get(name)
+    return snapshot["stats"] is None and entry is not None and entry["failures"] > 0 and entry["next_at"] > time.time()
+
+
+def get_snapshot(name: str, max_age: Optional[float] = None) -> dict:
+    """Latest snapshot for a relay, fetched now if missing or older than
+    *max_age* seconds (RELAY_STATS_MAX_AGE by default; 0 forces a fetch)."""
+    limit = RELAY_STATS_MAX_AGE if max_age is None else max_age
+    with _snapshots_lock:
+        snapshot = _snapshots.get(name)
+    if not _is_fresh(name, snapshot, limit):
+        _collector_stats["on_demand_fetches"] += 1
+        snapshot = _fetch_async(name).result()
+    return snapshot
+
+
+def get_snapshots(names, max_age: Optional[float] = None, deadline: Optional[float] = None) -> dict:
+    """Snapshots for many relays at once, for dashboard-style fan-outs.
+
+    Fresh cache entries are returned as-is; the others are fetched
+    concurrently and waited for at most *deadline* seconds overall
+    (RELAY_FANOUT_DEADLINE by default). A relay that doesn't answer in time
+    comes back with timed_out=True and, if there is one, its previous
+    snapshot with stale=True — the response never blocks on dead relays.
+    """
+    limit = RELAY_STATS_MAX_AGE if max_age is None else max_age
+    budget = RELAY_FANOUT_DEADLINE if deadline is None else deadline
+    with _snapshots_lock:
+        cached = {name: _snapshots.get(name) for name in names}
+
+    results, pending = {}, {}
+    for name, snapshot in cached.items():
+        if _is_fresh(name, snapshot, limit):
+            results[name] = {**snapshot, "stale": False, "timed_out": False}
+        else:
+            pending[name] = _fetch_async(name)
+    if pending:
+        _collector_stats["on_demand_fetches"] += len(pending)
+        wait(pending.values(), timeout=budget)
+        for name, future in pending.items():
+            if future.done():
+                results[name] = {**future.result(), "stale": False, "timed_out": False}
+            else:
+                _collector_stats["fanout_timeouts"] += 1
+                previous = cached[name] or {"stats": None, "fetched_at": None, "latency_ms": None, "error": "timeout"}
+                results[name] = {**previous, "stale": cached[name] is not None, "timed_out": True}
+    return results
+
+
+def get_stats(name: str, max_age: Optional[float] = None) -> Optional[dict]:
+    """Relay stats JSON from the cache, or None when the relay is unreachable."""
+    return get_snapshot(name, max_age)["stats"]
+
+
+# ── Per-relay poll schedule ───────────────────────────────────────────
+def _peer_activity(stats: dict):
+    peers = stats.get("peers") or {}
+    peers = list(peers.values()) if isinstance(peers, dict) else peers
+    connected = sum(1 for p in peers if isinstance(p, dict) and p.get("status") in (1, "connected"))
+    return float(stats.get("total_bytes_transferred", 0) or 0), connected
+
+
+def _new_entry(name: str, now: float) -> dict:
+    # Stable phase per relay: the same slot across restarts and replicas
+    phase = (zlib.crc32(name.encode()) % 10000) / 10000 * RELAY_STATS_INTERVAL
+    slot = now - now % RELAY_STATS_INTERVAL + phase
+    if slot < now:
+        slot += RELAY_STATS_INTERVAL
+    return {"slot": slot, "next_at": slot, "interval": RELAY_STATS_INTERVAL, "mode": "normal", "failures": 0,
+            "last_poll_at": None, "last_poll_at_ok": None, "last_ms": None, "last_bytes": None,
+            "last_connected": None}
+
+
+def _reschedule(name: str, snapshot: dict):
+    """Plan the next poll of *name* from the outcome of this one (called under _snapshots_lock)."""
+    entry = _schedule.get(name)
+    if entry is None:
+        return
+    t = snapshot["fetched_at"]
+    _collector_stats["polls"] += 1
+    entry["last_poll_at"], entry["last_ms"] = t, snapshot["latency_ms"]
+    stats = snapshot["stats"]
+    if not isinstance(stats, dict):
+        _collector_stats["poll_failures"] += 1
+        entry["failures"] += 1
+        entry["mode"] = "backoff"
+        interval = min(RELAY_STATS_INTERVAL * 2 ** entry["failures"], RELAY_STATS_MAX_BACKOFF)
+    else:
+        bytes_total, connected = _peer_activity(stats)
+        busy = False
+        if entry["last_bytes"] is not None and entry["failures"] == 0:
+            elapsed = t - entry["last_poll_at_ok"]
+            delta = bytes_total - entry["last_bytes"]
+            busy = (elapsed > 0 and delta >= 0 and delta / elapsed >= RELAY_BUSY_BYTES_PER_S) \
+                or connected != entry["last_connected"]
+        entry.update(failures=0, mode="busy" if busy else "normal", last_bytes=bytes_total,
+                     last_connected=connected, last_poll_at_ok=t)
+        interval = RELAY_STATS_BUSY_INTERVAL if busy else RELAY_STATS_INTERVAL
+
+    # Next slot on the relay's own phase at least half a period after this
+    # poll, so extra on-demand fetches neither pull it in nor push it away
+    slot = entry["slot"] + max(0, math.ceil((t + interval / 2 - entry["slot"]) / interval)) * interval
+    entry.update(slot=slot, interval=interval,
+                 next_at=slot + random.uniform(-RELAY_STATS_JITTER, RELAY_STATS_JITTER) * interval)
+
+
+def _sync_relays():
+    """Pick up relays added to / removed from the DB."""
+    try:
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT name FROM servers")
+            names = {row[0] for row in cur.fetchall()}
+    except Exception as e:
+        logger.error(f"Relay list refresh failed: {e}")
+        return
+    now = time.time()
+    with _snapshots_lock:
+        for name in names - set(_schedule):
+            _schedule[name] = _new_entry(name, now)
+        gone = (set(_schedule) | set(_snapshots)) - names
+        for name in gone:
+            _schedule.pop(name, None)
+            _snapshots.pop(name, None)
+    for name in gone:
+        timeseries.forget(name)
+    _collector_stats["relay_syncs"] += 1
+    _collector_stats["relays_synced_at"] = now
+
+
+def _polling() -> bool:
+    return not RELAY_STATS_LEADER_ONLY or leader.is_leader()
+
+
+def _tick():
+    """Start the polls that are due; the pool bounds how many run at once."""
+    now = time.time()
+    synced = _collector_stats["relays_synced_at"]
+    if synced is None or now - synced >= RELAY_STATS_INTERVAL:
+        _sync_relays()
+    if not _polling():
+        return                   # the leader polls; reads here fetch on demand
+    with _snapshots_lock:
+        due = [name for name, entry in _schedule.items() if entry["next_at"] <= now and name not in _inflight]
+    for name in due:
+        _fetch_async(name)
+
+
+def relay_schedule(names=None) -> dict:
+    """Per-relay poll plan, for debugging: mode, period, next poll, last duration."""
+    now = time.time()
+    with _snapshots_lock:
+        entries = {n: dict(e) for n, e in _schedule.items() if names is None or n in names}
+    return {name: {
+        "mode": e["mode"],
+        "interval_s": round(e["interval"], 1),
+        "failures": e["failures"],
+        "next_poll_at": round(e["next_at"], 1),
+        "next_poll_in_s": round(max(0.0, e["next_at"] - now), 1),
+        "last_poll_age_s": round(now - e["last_poll_at"], 1) if e["last_poll_at"] is not None else None,
+        "last_duration_ms": e["last_ms"],
+    } for name, e in entries.items()}
+
+
+# ── Scheduler ─────────────────────────────────────────────────────────
+_scheduler = BackgroundScheduler(daemon=True)
+
+
+def start():
+    """Start the background collector (first relay sync runs immediately)."""
+    _scheduler.add_job(
+        _tick,
+        "interval",
+        seconds=RELAY_STATS_TICK,
+        id="relay_stats_collector",
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+        next_run_time=datetime.now(),
+    )
+    _scheduler.start()
+    logger.info(f"Relay stats collector started — polling each relay every {RELAY_STATS_INTERVAL}s")
+
+
+def stop():
+    if _scheduler.running:
+        _scheduler.shutdown(wait=False)
+
+
+def relay_stats_stats() -> dict:
+    now = time.time()
+    with _snapshots_lock:
+        ages = [now - s["fetched_at"] for s in _snapshots.values()]
+        reachable = sum(1 for s in _snapshots.values() if s["stats"] is not None)
+        modes = [e["mode"] for e in _schedule.values()]
+        overdue = sum(1 for e in _schedule.values() if now - e["next_at"] > RELAY_STATS_TICK * 2) if _polling() else 0
+    synced = _collector_stats["relays_synced_at"]
+    return {
+        **{k: v for k, v in _collector_stats.items() if k != "relays_synced_at"},
+        "relays_synced_age_s": round(now - synced, 1) if synced is not None else None,
+        "scheduled_polling": _polling(),
+        "relays_scheduled": len(modes),
+        "relays_busy": modes.count("busy"),
+        "relays_backoff": modes.count("backoff"),
+        "polls_overdue": overdue,
+        "relays_cached": len(ages),
+        "relays_reachable": reachable,
+        "oldest_snapshot_s": round(max(ages), 1) if ages else None,
+    }
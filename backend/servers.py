@@ -2,15 +2,18 @@
 WPEX Orchestrator — Server Management API
 CRUD operations + Docker container actions.
 """
-import os
+import os, time, threading
 from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
 from typing import List, Optional
-from kubernetes import client, config
+from kubernetes import client
 from kubernetes.client.rest import ApiException
 import requests
 
-from database import get_db, DATA_KEY
+from database import get_request_db
+from key_cache import decrypt_keys, get_public_keys
+from k8s_cache import init_k8s, relay_statuses
+import relay_client
 from auth import get_current_user
 from audit import log_audit_event
 
@@ -20,11 +23,26 @@ IMAGE_NAME = "nikoceps/wpex-monitoring:latest"
 WPEX_NETWORK = os.getenv("WPEX_NETWORK", "wpex_wpex-network")
 
 
+PUBLIC_IP_TTL = float(os.getenv("PUBLIC_IP_TTL", "3600"))   # re-resolve the host IP this often (s)
+PUBLIC_IP_RETRY = 60                                         # back-off after a failed lookup (s)
+_public_ip = {"value": None, "expires": 0.0}
+_public_ip_lock = threading.Lock()
+
+
 def _get_public_ip():
+    host_ip = os.getenv("HOST_IP")
+    if host_ip:
+        return host_ip
+    with _public_ip_lock:
+        if _public_ip["value"] is not None and time.monotonic() < _public_ip["expires"]:
+            return _public_ip["value"]
     try:
-        return os.getenv("HOST_IP", requests.get("https://api.ipify.org", timeout=1).text)
+        value, ttl = requests.get("https://api.ipify.org", timeout=1).text, PUBLIC_IP_TTL
     except:
-        return "localhost"
+        value, ttl = "localhost", PUBLIC_IP_RETRY
+    with _public_ip_lock:
+        _public_ip.update(value=value, expires=time.monotonic() + ttl)
+    return value
 
 
 # --- Pydantic Models ---
@@ -42,35 +60,8 @@ class UpdateKeysRequest(BaseModel):
 
 # --- Docker Helpers ---
 # --- Kubernetes Helpers ---
-def _init_k8s():
-    try:
-        config.load_incluster_config()
-    except:
-        try:
-            config.load_kube_config()
-        except:
-            pass
-
-def _k8s_status(name: str):
-    _init_k8s()
-    try:
-        core_api = client.CoreV1Api()
-        pods = core_api.list_namespaced_pod(namespace="wpex", label_selector=f"app=wpex-{name}")
-        if not pods.items:
-            apps_api = client.AppsV1Api()
-            try:
-                apps_api.read_namespaced_deployment(name=f"wpex-{name}", namespace="wpex")
-                return "stopped"
-            except:
-                return "not_created"
-        
-        pod = pods.items[0]
-        return pod.status.phase.lower()
-    except Exception:
-        return "error"
-
 def _deploy_relay(name, udp_port, web_port, keys_list):
-    _init_k8s()
+    init_k8s()
     app_name = f"wpex-{name}"
     
     cmd_args = ["--port", str(udp_port), "--stats", ":8080"]
@@ -150,43 +141,46 @@ def _deploy_relay(name, udp_port, web_port, keys_list):
 
 
 @router.get("")
-def list_servers(user=Depends(get_current_user)):
-    conn = get_db()
-    cur = conn.cursor()
-    
-    query = "SELECT id, name, port, web_port, tenant_id, region, description FROM servers "
+def list_servers(user=Depends(get_current_user), db=Depends(get_request_db)):
+    # Servers and their linked keys in one round-trip; keys come back as
+    # [id, alias, xmin] triples and are decrypted through the key cache.
+    query = """SELECT s.id, s.name, s.port, s.web_port, s.tenant_id, s.region, s.description,
+                      COALESCE(json_agg(json_build_array(k.id, k.alias, k.xmin::text) ORDER BY k.id)
+                               FILTER (WHERE k.id IS NOT NULL), '[]')
+               FROM servers s
+               LEFT JOIN server_keys_link l ON l.server_id = s.id
+               LEFT JOIN access_keys k ON k.id = l.key_id """
     params = []
     
     if user.get("role") in ("engineer", "viewer"):
-        query += "WHERE tenant_id = %s "
+        query += "WHERE s.tenant_id = %s "
         params.append(user.get("tenant_id"))
         
-    query += "ORDER BY port ASC"
+    query += "GROUP BY s.id ORDER BY s.port ASC"
     
+    cur = db.cursor()
     cur.execute(query, params)
+    rows = cur.fetchall()
+    plain = decrypt_keys([(k[0], k[2]) for row in rows for k in row[7]], db)
+
+    # K8s lookups happen after the connection is back in the pool
+    db.release()
+    statuses = relay_statuses([row[1] for row in rows], readiness=False) if rows else {}
     servers = []
-    for row in cur.fetchall():
-        sid, name, udp_port, web_port, tenant_id, region, description = row
-        cur.execute(
-            """SELECT k.id, k.alias, pgp_sym_decrypt(k.key_value, %s)
-               FROM access_keys k
-               JOIN server_keys_link l ON k.id = l.key_id
-               WHERE l.server_id = %s""",
-            (DATA_KEY, sid),
-        )
-        keys_data = [{"id": k[0], "alias": k[1], "key": k[2]} for k in cur.fetchall()]
-        status = _k8s_status(name)
+    for row in rows:
+        sid, name, udp_port, web_port, tenant_id, region, description, keys = row
+        keys_data = [{"id": k[0], "alias": k[1], "key": plain.get(k[0])} for k in keys]
+        status = statuses[name][0]
         servers.append({
             "id": sid, "name": name, "udp_port": udp_port, "web_port": web_port,
             "tenant_id": tenant_id, "region": region, "description": description,
             "keys": keys_data, "status": status,
         })
-    conn.close()
     return {"servers": servers, "host_ip": _get_public_ip()}
 
 
 @router.post("")
-def create_server(body: CreateServerRequest, user=Depends(get_current_user)):
+def create_server(body: CreateServerRequest, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") in ("viewer", "executive"):
         raise HTTPException(status_code=403, detail="Permessi insufficienti per creare server")
 
@@ -194,17 +188,16 @@ def create_server(body: CreateServerRequest, user=Depends(get_current_user)):
     if user.get("role") == "engineer":
         tenant_id = user.get("tenant_id")
         
-    conn = get_db()
-    cur = conn.cursor()
-
-    # Get next web port
-    cur.execute("SELECT MAX(web_port) FROM servers")
-    max_port = cur.fetchone()[0]
-    web_port = (max_port + 1) if max_port else 8080
-
     name = body.name.lower().replace(" ", "-")
     
     try:
+        cur = db.cursor()
+
+        # Get next web port
+        cur.execute("SELECT MAX(web_port) FROM servers")
+        max_port = cur.fetchone()[0]
+        web_port = (max_port + 1) if max_port else 8080
+
         cur.execute(
             """INSERT INTO servers (name, port, web_port, tenant_id, region, description) 
                VALUES (%s, %s, %s, %s, %s, %s) RETURNING id;""",
@@ -213,25 +206,22 @@ def create_server(body: CreateServerRequest, user=Depends(get_current_user)):
         server_id = cur.fetchone()[0]
         for kid in body.key_ids:
             cur.execute("INSERT INTO server_keys_link (server_id, key_id) VALUES (%s, %s)", (server_id, kid))
-        conn.commit()
 
-        # Get actual key values for Docker
-        cur.execute(
-            "SELECT pgp_sym_decrypt(key_value, %s) FROM access_keys WHERE id = ANY(%s)",
-            (DATA_KEY, body.key_ids),
-        )
-        raw_keys = [r[0] for r in cur.fetchall()]
-        conn.close()
-
-        ok, msg = _deploy_relay(name, body.udp_port, web_port, raw_keys)
-        
         log_audit_event(
             user_id=user["id"],
             action="create",
             entity_type="relay",
             entity_id=server_id,
-            details={"name": name, "udp_port": body.udp_port}
+            details={"name": name, "udp_port": body.udp_port},
+            db=db,
         )
+        db.commit()
+
+        # Get actual key values for Docker
+        raw_keys = get_public_keys(body.key_ids, db)
+        db.release()
+
+        ok, msg = _deploy_relay(name, body.udp_port, web_port, raw_keys)
         
         if not ok:
             return {"id": server_id, "warning": msg}
@@ -241,23 +231,21 @@ def create_server(body: CreateServerRequest, user=Depends(get_current_user)):
 
 
 @router.delete("/{server_id}")
-def delete_server(server_id: int, user=Depends(get_current_user)):
+def delete_server(server_id: int, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") in ("viewer", "executive"):
         raise HTTPException(status_code=403, detail="Permessi insufficienti")
 
-    conn = get_db()
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute("SELECT name, tenant_id FROM servers WHERE id = %s", (server_id,))
     row = cur.fetchone()
     if not row:
-        conn.close()
         raise HTTPException(status_code=404, detail="Server non trovato")
         
     name, tenant_id = row
     if user.get("role") == "engineer" and tenant_id != user.get("tenant_id"):
-        conn.close()
         raise HTTPException(status_code=403, detail="Server non appartiene alla tua organizzazione")
-    _init_k8s()
+    db.release()
+    init_k8s()
     try:
         apps_api = client.AppsV1Api()
         core_api = client.CoreV1Api()
@@ -266,31 +254,31 @@ def delete_server(server_id: int, user=Depends(get_current_user)):
     except:
         pass
     
+    cur = db.cursor()
     cur.execute("DELETE FROM servers WHERE id = %s", (server_id,))
-    conn.commit()
-    conn.close()
     
     log_audit_event(
         user_id=user["id"],
         action="delete",
         entity_type="relay",
         entity_id=server_id,
-        details={"name": name}
+        details={"name": name},
+        db=db,
     )
+    db.commit()
+    relay_client.forget_relay(name)
     
     return {"message": f"Server {name} eliminato"}
 
 
 @router.post("/{server_id}/start")
-def start_server(server_id: int, user=Depends(get_current_user)):
+def start_server(server_id: int, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") in ("viewer", "executive"):
         raise HTTPException(status_code=403, detail="Permessi insufficienti")
         
-    conn = get_db()
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute("SELECT name, tenant_id FROM servers WHERE id = %s", (server_id,))
     row = cur.fetchone()
-    conn.close()
     if not row:
         raise HTTPException(status_code=404)
         
@@ -298,7 +286,8 @@ def start_server(server_id: int, user=Depends(get_current_user)):
     if user.get("role") == "engineer" and tenant_id != user.get("tenant_id"):
         raise HTTPException(status_code=403, detail="Server non appartiene alla tua organizzazione")
 
-    _init_k8s()
+    db.release()
+    init_k8s()
     try:
         apps_api = client.AppsV1Api()
         deployment = apps_api.read_namespaced_deployment(name=f"wpex-{name}", namespace="wpex")
@@ -312,22 +301,22 @@ def start_server(server_id: int, user=Depends(get_current_user)):
         action="start",
         entity_type="relay",
         entity_id=server_id,
-        details={"name": name}
+        details={"name": name},
+        db=db,
     )
+    db.commit()
     
     return {"message": "Avviato"}
 
 
 @router.post("/{server_id}/stop")
-def stop_server(server_id: int, user=Depends(get_current_user)):
+def stop_server(server_id: int, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") in ("viewer", "executive"):
         raise HTTPException(status_code=403, detail="Permessi insufficienti")
         
-    conn = get_db()
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute("SELECT name, tenant_id FROM servers WHERE id = %s", (server_id,))
     row = cur.fetchone()
-    conn.close()
     if not row:
         raise HTTPException(status_code=404)
         
@@ -335,7 +324,8 @@ def stop_server(server_id: int, user=Depends(get_current_user)):
     if user.get("role") == "engineer" and tenant_id != user.get("tenant_id"):
         raise HTTPException(status_code=403, detail="Server non appartiene alla tua organizzazione")
 
-    _init_k8s()
+    db.release()
+    init_k8s()
     try:
         apps_api = client.AppsV1Api()
         deployment = apps_api.read_namespaced_deployment(name=f"wpex-{name}", namespace="wpex")
@@ -349,89 +339,94 @@ def stop_server(server_id: int, user=Depends(get_current_user)):
         action="stop",
         entity_type="relay",
         entity_id=server_id,
-        details={"name": name}
+        details={"name": name},
+        db=db,
     )
+    db.commit()
     
     return {"message": "Fermato"}
 
 
 @router.put("/{server_id}/keys")
-def update_keys(server_id: int, body: UpdateKeysRequest, user=Depends(get_current_user)):
+def update_keys(server_id: int, body: UpdateKeysRequest, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") in ("viewer", "executive"):
         raise HTTPException(status_code=403, detail="Permessi insufficienti")
         
-    conn = get_db()
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute("SELECT name, port, web_port, tenant_id FROM servers WHERE id = %s", (server_id,))
     row = cur.fetchone()
     if not row:
-        conn.close()
         raise HTTPException(status_code=404)
-    
+
     name, udp_port, web_port, tenant_id = row
-    
+
     if user.get("role") == "engineer" and tenant_id != user.get("tenant_id"):
-        conn.close()
         raise HTTPException(status_code=403, detail="Server non appartiene alla tua organizzazione")
 
     cur.execute("DELETE FROM server_keys_link WHERE server_id = %s", (server_id,))
     for kid in body.key_ids:
         cur.execute("INSERT INTO server_keys_link (server_id, key_id) VALUES (%s, %s)", (server_id, kid))
-    conn.commit()
+    # Audited in the same transaction as the link rows; how the relay picked
+    # up the keys is only known afterwards and gets its own event (_applied).
+    log_audit_event(
+        user_id=user["id"],
+        action="update_keys",
+        entity_type="relay",
+        entity_id=server_id,
+        details={"name": name, "key_count": len(body.key_ids)},
+        db=db,
+    )
+    db.commit()
 
     # Fetch raw WireGuard public keys for the selected key IDs
-    cur.execute(
-        "SELECT pgp_sym_decrypt(key_value, %s) FROM access_keys WHERE id = ANY(%s)",
-        (DATA_KEY, body.key_ids),
-    )
-    raw_keys = [r[0] for r in cur.fetchall()]
-    conn.close()
+    raw_keys = get_public_keys(body.key_ids, db)
+    db.release()
+
+    def applied(method):
+        log_audit_event(
+            user_id=user["id"],
+            action="update_keys_applied",
+            entity_type="relay",
+            entity_id=server_id,
+            details={"name": name, "method": method},
+        )
 
     # Try hot-reload first — zero downtime for peers whose keys are still valid.
-    # Falls back to full redeploy only when the relay pod doesn't exist yet.
-    import requests as _req
-    container_name = f"wpex-{name}"
+    # Falls back to full redeploy only when the relay pod doesn't exist yet
+    # (or refuses the reload): a slow answer may already have applied the keys.
     try:
-        reload_url = f"http://{container_name}.wpex.svc.cluster.local:8080/api/v1/config/reload"
-        resp = _req.post(reload_url, json={"public_keys": raw_keys}, timeout=5)
+        resp = relay_client.post(name, relay_client.RELOAD_PATH, json={"public_keys": raw_keys},
+                                 timeout=(relay_client.RELAY_CONNECT_TIMEOUT, relay_client.RELAY_RELOAD_TIMEOUT))
         if resp.status_code == 200:
-            log_audit_event(
-                user_id=user["id"], action="update_keys", entity_type="relay",
-                entity_id=server_id, details={"name": name, "key_count": len(body.key_ids), "method": "hot_reload"}
-            )
+            applied("hot_reload")
             return {"message": "Chiavi aggiornate via hot-reload (nessun riavvio)"}
-    except Exception:
+    except requests.ConnectionError:
         pass  # Relay not running yet — fall through to full deploy
+    except requests.RequestException:
+        applied("hot_reload_unconfirmed")
+        raise HTTPException(status_code=504, detail="Chiavi salvate, ma il relay non ha confermato l'hot-reload")
 
     _deploy_relay(name, udp_port, web_port, raw_keys)
-
-    log_audit_event(
-        user_id=user["id"],
-        action="update_keys",
-        entity_type="relay",
-        entity_id=server_id,
-        details={"name": name, "key_count": len(body.key_ids), "method": "redeploy"}
-    )
+    applied("redeploy")
 
     return {"message": "Chiavi aggiornate e server riavviato"}
 
 
 
 @router.get("/{server_id}/logs")
-def get_logs(server_id: int, user=Depends(get_current_user)):
-    conn = get_db()
-    cur = conn.cursor()
+def get_logs(server_id: int, user=Depends(get_current_user), db=Depends(get_request_db)):
+    cur = db.cursor()
     cur.execute("SELECT name, tenant_id FROM servers WHERE id = %s", (server_id,))
     row = cur.fetchone()
-    conn.close()
     if not row:
         raise HTTPException(status_code=404)
         
     name, tenant_id = row
     if user.get("role") in ("engineer", "viewer") and tenant_id != user.get("tenant_id"):
         raise HTTPException(status_code=403, detail="Server non appartiene alla tua organizzazione")
+    db.release()
 
-    _init_k8s()
+    init_k8s()
     try:
         core_api = client.CoreV1Api()
         pods = core_api.list_namespaced_pod(namespace="wpex", label_selector=f"app=wpex-{name}")
@@ -7,8 +7,8 @@ from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
 from typing import List, Optional
 
-from database import get_db, generate_api_key
-from auth import get_current_user
+from database import get_request_db, generate_api_key
+from auth import get_current_user, invalidate_tenant_users
 from audit import log_audit_event
 
 router = APIRouter(prefix="/api/tenants", tags=["tenants"])
@@ -42,10 +42,7 @@ class CreateSiteRequest(BaseModel):
 
 # --- Tenant Endpoints ---
 @router.get("")
-def list_tenants(user=Depends(get_current_user)):
-    conn = get_db()
-    cur = conn.cursor()
-    
+def list_tenants(user=Depends(get_current_user), db=Depends(get_request_db)):
     is_tenant_scoped = user.get("role") in ("engineer", "viewer")
     tenant_id = user.get("tenant_id")
     
@@ -63,9 +60,12 @@ def list_tenants(user=Depends(get_current_user)):
         
     query += " ORDER BY t.name ASC"
     
+    cur = db.cursor()
     cur.execute(query, params)
+    rows = cur.fetchall()
+
     tenants = []
-    for row in cur.fetchall():
+    for row in rows:
         tenants.append({
             "id": row[0], "name": row[1], "slug": row[2],
             "max_bandwidth_mbps": row[3],
@@ -75,19 +75,17 @@ def list_tenants(user=Depends(get_current_user)):
             "created_at": row[10].isoformat() if row[10] else None,
             "site_count": row[11],
         })
-    conn.close()
     return {"tenants": tenants}
 
 
 @router.post("")
-def create_tenant(body: CreateTenantRequest, user=Depends(get_current_user)):
+def create_tenant(body: CreateTenantRequest, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Solo gli admin possono creare tenant")
         
-    conn = get_db()
     try:
-        cur = conn.cursor()
         api_key = generate_api_key()
+        cur = db.cursor()
         cur.execute("""
             INSERT INTO tenants (name, slug, max_bandwidth_mbps,
                                  sla_target, allowed_regions, preferred_relay_ids, api_key)
@@ -98,16 +96,16 @@ def create_tenant(body: CreateTenantRequest, user=Depends(get_current_user)):
               body.sla_target, body.allowed_regions,
               body.preferred_relay_ids, api_key))
         tenant_id = cur.fetchone()[0]
-        conn.commit()
-        conn.close()
         
         log_audit_event(
             user_id=user["id"],
             action="create",
             entity_type="tenant",
             entity_id=tenant_id,
-            details={"name": body.name, "slug": body.slug}
+            details={"name": body.name, "slug": body.slug},
+            db=db,
         )
+        db.commit()
         
         return {"id": tenant_id, "api_key": api_key, "message": "Tenant creato"}
     except Exception as e:
@@ -115,12 +113,11 @@ def create_tenant(body: CreateTenantRequest, user=Depends(get_current_user)):
 
 
 @router.get("/{tenant_id}")
-def get_tenant(tenant_id: int, user=Depends(get_current_user)):
+def get_tenant(tenant_id: int, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") in ("engineer", "viewer") and tenant_id != user.get("tenant_id"):
         raise HTTPException(status_code=403, detail="Accesso negato")
 
-    conn = get_db()
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute("""
         SELECT id, name, slug, max_bandwidth_mbps,
                sla_target, allowed_regions, preferred_relay_ids,
@@ -129,14 +126,12 @@ def get_tenant(tenant_id: int, user=Depends(get_current_user)):
     """, (tenant_id,))
     row = cur.fetchone()
     if not row:
-        conn.close()
         raise HTTPException(status_code=404, detail="Tenant non trovato")
 
     # Get sites (keys mapping)
     cur.execute("SELECT id, alias FROM access_keys WHERE tenant_id = %s ORDER BY alias", (tenant_id,))
     sites = [{"id": s[0], "alias": s[1]} for s in cur.fetchall()]
 
-    conn.close()
     return {
         "id": row[0], "name": row[1], "slug": row[2],
         "max_bandwidth_mbps": row[3],
@@ -154,14 +149,13 @@ def get_tenant(tenant_id: int, user=Depends(get_current_user)):
 
 
 @router.put("/{tenant_id}")
-def update_tenant(tenant_id: int, body: UpdateTenantRequest, user=Depends(get_current_user)):
+def update_tenant(tenant_id: int, body: UpdateTenantRequest, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Solo gli admin possono modificare i tenant")
 
-    conn = get_db()
-    cur = conn.cursor()
     updates = []
     values = [] # type: list
+    approve_pending = False
     if body.name is not None:
         updates.append("name = %s")
         values.append(body.name)
@@ -183,107 +177,107 @@ def update_tenant(tenant_id: int, body: UpdateTenantRequest, user=Depends(get_cu
         values.append(body.preferred_relay_ids)
     if body.status is not None:
         if body.status not in ('active', 'pending', 'disabled'):
-            conn.close()
             raise HTTPException(status_code=400, detail="Status non valido")
         updates.append("status = %s")
         values.append(body.status)
         # If activated, also set is_active = TRUE and approve the pending admin
         if body.status == 'active':
             updates.append("is_active = TRUE")
-            # Automatically approve the user who requested this tenant
-            cur.execute("UPDATE users SET status = 'active' WHERE tenant_id = %s AND status = 'pending' AND role = 'engineer'", (tenant_id,))
+            approve_pending = True
     elif body.is_active is not None:
         updates.append("is_active = %s")
         values.append(body.is_active)
 
     if not updates:
-        conn.close()
         return {"message": "Nessun aggiornamento"}
 
     updates.append("updated_at = CURRENT_TIMESTAMP")
     values.append(tenant_id)
+    cur = db.cursor()
+    if approve_pending:
+        # Automatically approve the user who requested this tenant
+        cur.execute("UPDATE users SET status = 'active' WHERE tenant_id = %s AND status = 'pending' AND role = 'engineer'", (tenant_id,))
     cur.execute(f"UPDATE tenants SET {', '.join(updates)} WHERE id = %s", values)
-    conn.commit()
-    conn.close()
     
     log_audit_event(
         user_id=user["id"],
         action="update",
         entity_type="tenant",
         entity_id=tenant_id,
-        details={"fields_updated": [u.split(' =')[0] for u in updates if u != "updated_at = CURRENT_TIMESTAMP"]}
+        details={"fields_updated": [u.split(' =')[0] for u in updates if u != "updated_at = CURRENT_TIMESTAMP"]},
+        db=db,
     )
+    db.commit()
+    if approve_pending:
+        invalidate_tenant_users(tenant_id)
     
     return {"message": "Tenant aggiornato"}
 
 
 @router.delete("/{tenant_id}")
-def delete_tenant(tenant_id: int, user=Depends(get_current_user)):
+def delete_tenant(tenant_id: int, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Solo gli admin possono eliminare i tenant")
 
-    conn = get_db()
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute("DELETE FROM tenants WHERE id = %s", (tenant_id,))
-    conn.commit()
-    conn.close()
     
     log_audit_event(
         user_id=user["id"],
         action="delete",
         entity_type="tenant",
-        entity_id=tenant_id
+        entity_id=tenant_id,
+        db=db,
     )
+    db.commit()
     
     return {"message": "Tenant eliminato"}
 
 
 # --- Site Endpoints ---
 @router.get("/{tenant_id}/sites")
-def list_sites(tenant_id: int, user=Depends(get_current_user)):
+def list_sites(tenant_id: int, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") in ("engineer", "viewer") and tenant_id != user.get("tenant_id"):
         raise HTTPException(status_code=403, detail="Accesso negato")
 
-    conn = get_db()
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute("""
         SELECT id, name, region, public_ip, subnet, is_active, created_at
         FROM sites WHERE tenant_id = %s ORDER BY name
     """, (tenant_id,))
+    rows = cur.fetchall()
     sites = [{
         "id": r[0], "name": r[1], "region": r[2],
         "public_ip": r[3], "subnet": r[4], "is_active": r[5],
         "created_at": r[6].isoformat() if r[6] else None,
-    } for r in cur.fetchall()]
-    conn.close()
+    } for r in rows]
     return {"sites": sites}
 
 
 @router.post("/{tenant_id}/sites")
-def create_site(tenant_id: int, body: CreateSiteRequest, user=Depends(get_current_user)):
+def create_site(tenant_id: int, body: CreateSiteRequest, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") in ("viewer", "executive"):
         raise HTTPException(status_code=403, detail="Permessi insufficienti per creare site")
     if user.get("role") == "engineer" and tenant_id != user.get("tenant_id"):
         raise HTTPException(status_code=403, detail="Accesso negato")
 
-    conn = get_db()
     try:
-        cur = conn.cursor()
+        cur = db.cursor()
         cur.execute("""
             INSERT INTO sites (tenant_id, name, region, public_ip, subnet)
             VALUES (%s, %s, %s, %s, %s) RETURNING id;
         """, (tenant_id, body.name, body.region, body.public_ip, body.subnet))
         site_id = cur.fetchone()[0]
-        conn.commit()
-        conn.close()
         
         log_audit_event(
             user_id=user["id"],
             action="create",
             entity_type="site",
             entity_id=site_id,
-            details={"name": body.name, "tenant_id": tenant_id}
+            details={"name": body.name, "tenant_id": tenant_id},
+            db=db,
         )
+        db.commit()
         
         return {"id": site_id, "message": "Site creato"}
     except Exception as e:
@@ -291,47 +285,43 @@ def create_site(tenant_id: int, body: CreateSiteRequest, user=Depends(get_curren
 
 
 @router.delete("/{tenant_id}/sites/{site_id}")
-def delete_site(tenant_id: int, site_id: int, user=Depends(get_current_user)):
+def delete_site(tenant_id: int, site_id: int, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") in ("viewer", "executive"):
         raise HTTPException(status_code=403, detail="Permessi insufficienti per eliminare site")
     if user.get("role") == "engineer" and tenant_id != user.get("tenant_id"):
         raise HTTPException(status_code=403, detail="Accesso negato")
 
-    conn = get_db()
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute("DELETE FROM sites WHERE id = %s AND tenant_id = %s", (site_id, tenant_id))
-    conn.commit()
-    conn.close()
     
     log_audit_event(
         user_id=user["id"],
         action="delete",
         entity_type="site",
         entity_id=site_id,
-        details={"tenant_id": tenant_id}
+        details={"tenant_id": tenant_id},
+        db=db,
     )
+    db.commit()
     
     return {"message": "Site eliminato"}
 
 
 @router.get("/{tenant_id}/usage")
-def get_tenant_usage(tenant_id: int, user=Depends(get_current_user)):
+def get_tenant_usage(tenant_id: int, user=Depends(get_current_user), db=Depends(get_request_db)):
     if user.get("role") in ("engineer", "viewer") and tenant_id != user.get("tenant_id"):
         raise HTTPException(status_code=403, detail="Accesso negato")
 
-    conn = get_db()
-    cur = conn.cursor()
+    cur = db.cursor()
     cur.execute("SELECT max_bandwidth_mbps FROM tenants WHERE id = %s", (tenant_id,))
     row = cur.fetchone()
     if not row:
-        conn.close()
         raise HTTPException(status_code=404, detail="Tenant non trovato")
 
     max_bw = row[0]
     cur.execute("SELECT COUNT(*) FROM sites WHERE tenant_id = %s", (tenant_id,))
     site_count = cur.fetchone()[0]
 
-    conn.close()
     return {
         "bandwidth_limit_mbps": max_bw,
         "sites_count": site_count,
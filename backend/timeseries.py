@@ -0,0 +1,156 @@
+"""
+WPEX Orchestrator — Relay Time Series
+Fixed-size ring buffer per relay of the counters reported by /stats,
+fed by the relay stats collector, so throughput can be reported as rates
+without asking Zabbix.
+
+Cumulative counters are stored as per-slot increments (a counter that
+goes backwards means the relay restarted and counts from zero again), next
+to the seconds they cover, so a rate is just sum(increments) / sum(seconds).
+"""
+import os, time, threading
+
+import numpy as np
+
+TS_RESOLUTION = int(os.getenv("TS_RESOLUTION", "30"))       # seconds per slot
+TS_RETENTION = int(os.getenv("TS_RETENTION", "86400"))      # history kept per relay (s)
+TS_SLOTS = max(1, TS_RETENTION // TS_RESOLUTION)
+
+COUNTERS = ("bytes", "handshakes", "successful_handshakes")  # cumulative in /stats
+GAUGES = ("active_sessions", "peers", "peers_connected")
+_ELAPSED = len(COUNTERS)                                     # column holding the seconds covered
+_FIELDS = len(COUNTERS) + 1 + len(GAUGES)
+
+# 32 bytes per slot: 2,880 slots (24 h at 30 s) is ~90 KB per relay
+_series = {}                     # relay name -> _Series
+_lock = threading.Lock()
+
+
+class _Series:
+    __slots__ = ("slots", "values", "pos", "last_raw", "last_t")
+
+    def __init__(self):
+        self.slots = np.full(TS_SLOTS, -1, dtype=np.int32)
+        self.values = np.zeros((TS_SLOTS, _FIELDS), dtype=np.float32)
+        self.pos = -1
+        self.last_raw = None
+        self.last_t = None
+
+    def record(self, t: float, counters, gauges):
+        slot = int(t // TS_RESOLUTION)
+        if self.last_raw is None or t <= self.last_t:
+            deltas, elapsed = [0.0] * len(counters), 0.0
+        else:
+            deltas = [c - p if c >= p else c for c, p in zip(counters, self.last_raw)]
+            elapsed = t - self.last_t
+        self.last_raw, self.last_t = counters, t
+
+        if self.pos < 0 or slot > self.slots[self.pos]:
+            self.pos = (self.pos + 1) % TS_SLOTS
+            self.slots[self.pos] = slot
+            row = self.values[self.pos]
+            row[:] = 0
+        else:
+            row = self.values[self.pos]
+        row[:_ELAPSED] += deltas
+        row[_ELAPSED] += elapsed
+        row[_ELAPSED + 1:] = gauges
+
+    def window(self, since_slot: int):
+        mask = self.slots >= since_slot
+        order = np.argsort(self.slots[mask])
+        return self.slots[mask][order], self.values[mask][order]
+
+
+def _extract(stats: dict):
+    peers = stats.get("peers") or {}
+    peers = list(peers.values()) if isinstance(peers, dict) else peers
+    peers = [p for p in peers if isinstance(p, dict)]
+    counters = (
+        float(stats.get("total_bytes_transferred", 0) or 0),
+        float(stats.get("total_handshakes", 0) or 0),
+        float(stats.get("successful_handshakes", 0) or 0),
+    )
+    gauges = (
+        float(stats.get("active_sessions", 0) or 0),
+        float(len(peers)),
+        float(sum(1 for p in peers if p.get("status") in (1, "connected"))),
+    )
+    return counters, gauges
+
+
+def record(name: str, stats: dict, t: float):
+    """Append one /stats sample taken at epoch time *t*."""
+    counters, gauges = _extract(stats)
+    with _lock:
+        series = _series.get(name)
+        if series is None:
+            series = _series[name] = _Series()
+        series.record(t, counters, gauges)
+
+
+def forget(name: str):
+    with _lock:
+        _series.pop(name, None)
+
+
+def _rates(values) -> dict:
+    elapsed = float(values[:, _ELAPSED].sum())
+    latest = values[-1, _ELAPSED + 1:]
+    out = {f"{c}_per_s": round(float(values[:, i].sum()) / elapsed, 3) if elapsed > 0 else None
+           for i, c in enumerate(COUNTERS)}
+    out.update({g: int(latest[i]) for i, g in enumerate(GAUGES)})
+    return out
+
+
+def rates(name: str, window: int, step: int = None, now: float = None) -> dict:
+    """Rates over the last *window* seconds: a summary plus one point per
+    *step* seconds (per slot when omitted). Points carry bucket start time,
+    per-second rates of every counter and the mean of every gauge."""
+    now = time.time() if now is None else now
+    since = int((now - window) // TS_RESOLUTION) + 1
+    with _lock:
+        series = _series.get(name)
+        if series is None:
+            return {"summary": None, "points": []}
+        slots, values = series.window(since)
+    if len(slots) == 0:
+        return {"summary": None, "points": []}
+
+    step = max(TS_RESOLUTION, int(step or TS_RESOLUTION))
+    buckets = (slots.astype(np.int64) * TS_RESOLUTION) // step
+    keys, inverse = np.unique(buckets, return_inverse=True)
+    sums = np.zeros((len(keys), _FIELDS), dtype=np.float64)
+    np.add.at(sums, inverse, values)
+    counts = np.bincount(inverse)
+    elapsed = sums[:, _ELAPSED]
+
+    points = []
+    for b in range(len(keys)):
+        point = {"t": int(keys[b] * step)}
+        for i, c in enumerate(COUNTERS):
+            point[f"{c}_per_s"] = round(float(sums[b, i] / elapsed[b]), 3) if elapsed[b] > 0 else None
+        for i, g in enumerate(GAUGES):
+            point[g] = round(float(sums[b, _ELAPSED + 1 + i] / counts[b]), 2)
+        points.append(point)
+    return {"summary": _rates(values), "points": points}
+
+
+def fleet_rates(names, window: int) -> dict:
+    """Summary rates over the last *window* seconds for many relays."""
+    since = int((time.time() - window) // TS_RESOLUTION) + 1
+    out = {}
+    with _lock:
+        picked = {n: _series[n].window(since)[1] for n in names if n in _series}
+    for name in names:
+        values = picked.get(name)
+        out[name] = _rates(values) if values is not None and len(values) else None
+    return out
+
+
+def timeseries_stats() -> dict:
+    with _lock:
+        relays = len(_series)
+    per_relay = TS_SLOTS * (4 + 4 * _FIELDS)
+    return {"relays": relays, "slots_per_relay": TS_SLOTS, "resolution_s": TS_RESOLUTION,
+            "memory_bytes": relays * per_relay}
@@ -0,0 +1,184 @@
+"""
+WPEX Orchestrator — Zabbix API Client
+Single JSON-RPC client shared by the Zabbix modules: one pooled HTTP
+session, one auth token reused until Zabbix reports the session expired,
+and a short TTL cache for host/item metadata lookups.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("zabbix_client")
+
+# ── Configuration ────────────────────────────────────────────────────
+# ZABBIX_URL may be the frontend base URL or the full api_jsonrpc.php URL.
+ZABBIX_HOST      = os.environ.get("ZABBIX_HOST", "host.docker.internal")
+ZABBIX_URL       = os.environ.get("ZABBIX_URL", f"http://{ZABBIX_HOST}:8080")
+ZABBIX_API_URL   = ZABBIX_URL if ZABBIX_URL.endswith("api_jsonrpc.php") else ZABBIX_URL.rstrip("/") + "/api_jsonrpc.php"
+ZABBIX_USER      = os.environ.get("ZABBIX_USER", "Admin")
+ZABBIX_PASS      = os.environ.get("ZABBIX_PASS", "zabbix")
+ZABBIX_TIMEOUT   = float(os.environ.get("ZABBIX_TIMEOUT", "10"))
+ZABBIX_VERIFY_TLS = os.environ.get("ZABBIX_VERIFY_TLS", "0") == "1"   # the bundled frontend has no trusted cert
+ZABBIX_META_TTL  = float(os.environ.get("ZABBIX_META_TTL", "300"))     # host/item/group metadata cache (s)
+ZABBIX_META_EMPTY_TTL = float(os.environ.get("ZABBIX_META_EMPTY_TTL", "10"))  # ... of empty results (s)
+
+
+class ZabbixError(Exception):
+    """Zabbix answered with a JSON-RPC error (or could not be reached)."""
+
+
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=16))
+_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=16))
+
+_auth = {"token": None}
+_auth_lock = threading.Lock()
+_meta_cache = {}                 # (method, params json) -> (result, expires_at)
+_meta_lock = threading.Lock()
+_req_id = [0]
+_stats = {"calls": 0, "batched_calls": 0, "errors": 0, "logins": 0, "relogins": 0, "meta_hits": 0, "meta_misses": 0}
+
+
+def _rpc(method: str, params, auth):
+    _req_id[0] += 1
+    payload = {"jsonrpc": "2.0", "method": method, "params": params, "id": _req_id[0]}
+    if auth is not None:
+        payload["auth"] = auth
+    _stats["calls"] += 1
+    try:
+        r = _session.post(ZABBIX_API_URL, json=payload, timeout=ZABBIX_TIMEOUT, verify=ZABBIX_VERIFY_TLS)
+        r.raise_for_status()
+        data = r.json()
+    except (requests.RequestException, ValueError) as e:
+        _stats["errors"] += 1
+        raise ZabbixError(str(e)) from e
+    if "error" in data:
+        _stats["errors"] += 1
+        raise ZabbixError(data["error"].get("data") or data["error"].get("message") or str(data["error"]))
+    return data["result"]
+
+
+def _session_expired(err: ZabbixError) -> bool:
+    msg = str(err).lower()
+    return "re-login" in msg or "session terminated" in msg or "not authori" in msg
+
+
+def _token(refresh_from=None) -> str:
+    """Current auth token; logs in when there is none or *refresh_from* was rejected."""
+    with _auth_lock:
+        if _auth["token"] is None or _auth["token"] == refresh_from:
+            _auth["token"] = _rpc("user.login", {"user": ZABBIX_USER, "password": ZABBIX_PASS}, None)
+            _stats["logins"] += 1
+        return _auth["token"]
+
+
+def call(method: str, params):
+    """Authenticated JSON-RPC call; re-logs in once if the session expired."""
+    token = _token()
+    try:
+        return _rpc(method, params, token)
+    except ZabbixError as e:
+        if not _session_expired(e):
+            raise
+        logger.info("Zabbix session expired, logging in again")
+        _stats["relogins"] += 1
+        return _rpc(method, params, _token(refresh_from=token))
+
+
+def _rpc_batch(calls, auth) -> list:
+    payload = []
+    for method, params in calls:
+        _req_id[0] += 1
+        payload.append({"jsonrpc": "2.0", "method": method, "params": params, "id": _req_id[0], "auth": auth})
+    _stats["calls"] += 1
+    _stats["batched_calls"] += len(calls)
+    try:
+        r = _session.post(ZABBIX_API_URL, json=payload, timeout=ZABBIX_TIMEOUT, verify=ZABBIX_VERIFY_TLS)
+        r.raise_for_status()
+        data = r.json()
+    except (requests.RequestException, ValueError) as e:
+        _stats["errors"] += 1
+        raise ZabbixError(str(e)) from e
+    by_id = {resp.get("id"): resp for resp in data} if isinstance(data, list) else {}
+    results = []
+    for entry in payload:
+        resp = by_id.get(entry["id"])
+        if resp is None:
+            results.append(ZabbixError(f"no response to {entry['method']}"))
+        elif "error" in resp:
+            _stats["errors"] += 1
+            err = resp["error"]
+            results.append(ZabbixError(err.get("data") or err.get("message") or str(err)))
+        else:
+            results.append(resp["result"])
+    return results
+
+
+def batch(calls) -> list:
+    """Several authenticated calls in one HTTP request (a JSON-RPC batch array).
+
+    *calls* is a sequence of (method, params). Returns one entry per call, in
+    order: its result, or the ZabbixError it failed with.
+    """
+    if not calls:
+        return []
+    token = _token()
+    results = _rpc_batch(calls, token)
+    if any(isinstance(r, ZabbixError) and _session_expired(r) for r in results):
+        logger.info("Zabbix session expired, logging in again")
+        _stats["relogins"] += 1
+        results = _rpc_batch(calls, _token(refresh_from=token))
+    return results
+
+
+def cached(method: str, params, ttl: float = None):
+    """call() for read-only metadata (host.get, item.get, ...) with a TTL cache.
+
+    Empty results only live ZABBIX_META_EMPTY_TTL: a host provisioned by
+    another replica (whose invalidate_metadata() doesn't reach this one)
+    shows up within seconds instead of a full TTL.
+    """
+    key = (method, json.dumps(params, sort_keys=True))
+    now = time.monotonic()
+    with _meta_lock:
+        entry = _meta_cache.get(key)
+        if entry is not None and entry[1] > now:
+            _stats["meta_hits"] += 1
+            return entry[0]
+    _stats["meta_misses"] += 1
+    result = call(method, params)
+    with _meta_lock:
+        if not result:
+            ttl = ZABBIX_META_EMPTY_TTL if ttl is None else min(ttl, ZABBIX_META_EMPTY_TTL)
+        _meta_cache[key] = (result, now + (ZABBIX_META_TTL if ttl is None else ttl))
+    return result
+
+
+def invalidate_metadata():
+    """Drop cached metadata after creating hosts, items or groups."""
+    with _meta_lock:
+        _meta_cache.clear()
+
+
+def logout():
+    """End the Zabbix session (called at shutdown)."""
+    with _auth_lock:
+        token, _auth["token"] = _auth["token"], None
+    if token is not None:
+        try:
+            _rpc("user.logout", [], token)
+        except ZabbixError as e:
+            logger.debug(f"Zabbix logout failed: {e}")
+
+
+def zabbix_client_stats() -> dict:
+    with _meta_lock:
+        cached_entries = len(_meta_cache)
+    return {**_stats, "logged_in": _auth["token"] is not None, "meta_cached": cached_entries,
+            "api_url": ZABBIX_API_URL}
@@ -2,49 +2,76 @@
 WPEX Orchestrator — Zabbix Sender
 Periodically polls every wpex relay container for stats and pushes
 metrics into Zabbix via Zabbix API (host/item management) and
-ZabbixSender (data ingestion on port 10051).
+ZabbixSender (data ingestion on port 10051). The same samples are written
+to every other registered metrics sink (see metrics_sinks).
 
 Metrics pushed per relay:
-  wpex.bytes_rx            — cumulative bytes received across all peers
-  wpex.bytes_tx            — cumulative bytes sent across all peers
+  wpex.bytes_rx            — cumulative bytes received across all peers (*)
+  wpex.bytes_tx            — cumulative bytes sent across all peers (*)
+  wpex.bytes_transferred   — cumulative bytes relayed (total_bytes_transferred)
   wpex.active_peers        — number of currently connected peers
   wpex.total_peers         — total peers known to the relay
   wpex.handshake_success   — handshake success rate (%)
   wpex.total_handshakes    — total handshake attempts
-  wpex.uptime_seconds      — relay process uptime in seconds
+  wpex.uptime_seconds      — relay process uptime in seconds (*)
+
+(*) Stats come from the relays' raw /stats (see relay_stats), which has no
+per-direction byte counters or uptime: these items only get values from
+relays that report them, the others are not sent at all instead of as 0.
 """
 
 import os
+import json
+import time
+import uuid
+import asyncio
 import logging
-import requests
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from typing import Optional
 
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
 from pyzabbix import ZabbixSender, ZabbixMetric
-from fastapi import APIRouter
+from psycopg2.extras import execute_values
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from relay_stats import get_snapshots
+from metrics_sinks import METRIC_DEFS, MetricsSink, make_sample, register_sink, write_samples
+import zabbix_spool
+import leader
+from zabbix_client import ZABBIX_HOST, ZABBIX_API_URL, ZabbixError, batch, call, invalidate_metadata
 
 logger = logging.getLogger("zabbix_sender")
 
 # ── Configuration ────────────────────────────────────────────────────
-ZABBIX_HOST      = os.environ.get("ZABBIX_HOST", "host.docker.internal")
-ZABBIX_API_URL   = os.environ.get("ZABBIX_URL", f"http://{ZABBIX_HOST}:8080")
+# Zabbix host / API URL / credentials live in zabbix_client
 ZABBIX_SENDER_PORT = int(os.environ.get("ZABBIX_SENDER_PORT", "10051"))
-ZABBIX_USER      = os.environ.get("ZABBIX_USER", "Admin")
-ZABBIX_PASS      = os.environ.get("ZABBIX_PASS", "zabbix")
 POLL_INTERVAL    = int(os.environ.get("ZABBIX_POLL_INTERVAL", "60"))
+ZABBIX_FETCH_DEADLINE = float(os.environ.get("ZABBIX_FETCH_DEADLINE", "10"))  # budget for the cycle's stats fetch (s)
+ZABBIX_SPOOL_REPLAY_INTERVAL = int(os.environ.get("ZABBIX_SPOOL_REPLAY_INTERVAL", "30"))  # spool drain attempts (s)
+ZABBIX_RECONCILE_INTERVAL = int(os.environ.get("ZABBIX_RECONCILE_INTERVAL", "3600"))  # full host/item re-check (s)
+ZABBIX_SEND_CHUNK = int(os.environ.get("ZABBIX_SEND_CHUNK", "250"))      # metrics per trapper request
+ZABBIX_STOP_TIMEOUT = float(os.environ.get("ZABBIX_STOP_TIMEOUT", "20"))  # wait for a running sync at shutdown (s)
 
 HOST_GROUP_NAME  = "WPEX Relays"
+STATUS_JOB       = "zabbix_sender"      # job_status row shared by all replicas
+JOB_STATUS_PREFIX = "zabbix_sync_job:"  # + job id: per-job progress rows
+ZABBIX_JOBS_KEPT = 20                   # finished jobs remembered in memory
+ZABBIX_JOB_ERRORS_KEPT = 50             # errors reported per job
+ZABBIX_JOB_RETENTION = 86400            # per-job progress rows kept in the DB (s)
+ZABBIX_JOB_EVENT_INTERVAL = 0.5         # SSE progress refresh (s)
+ZABBIX_JOB_HEARTBEAT = 5                # a running job is republished at least this often (s)
+ZABBIX_JOB_LOST_AFTER = 4 * ZABBIX_JOB_HEARTBEAT  # ... and reported lost past this silence (s)
+ZABBIX_JOB_PICKUP_INTERVAL = 2          # the leader starts jobs queued by other replicas (s)
 
 # ── Metric definitions ────────────────────────────────────────────────
+# Zabbix value_type: 0 = numeric float, 3 = numeric unsigned
 ITEM_DEFS = [
-    {"key": "wpex.bytes_rx",          "name": "Bytes Received (total)",       "units": "B", "value_type": 3},
-    {"key": "wpex.bytes_tx",          "name": "Bytes Sent (total)",           "units": "B", "value_type": 3},
-    {"key": "wpex.active_peers",      "name": "Active Peers",                 "units": "",  "value_type": 3},
-    {"key": "wpex.total_peers",       "name": "Total Peers",                  "units": "",  "value_type": 3},
-    {"key": "wpex.handshake_success", "name": "Handshake Success Rate",       "units": "%", "value_type": 0},
-    {"key": "wpex.total_handshakes",  "name": "Total Handshakes",             "units": "",  "value_type": 3},
-    {"key": "wpex.uptime_seconds",    "name": "Relay Uptime",                 "units": "s", "value_type": 0},
+    {"key": m["key"], "name": m["name"], "units": m["units"], "value_type": 0 if m["type"] == "float" else 3}
+    for m in METRIC_DEFS
 ]
 
 # ── State ─────────────────────────────────────────────────────────────
@@ -52,57 +79,35 @@ _last_sync = {
     "time": None,
     "status": "never",
     "hosts_pushed": 0,
+    "relays_polled": 0,
+    "relays_total": 0,
+    "metrics_sent": 0,
+    "metrics_failed": 0,
+    "metrics_spooled": 0,
+    "duration_ms": None,
+    "skipped_cycles": 0,
+    "current_job": None,
+    "last_job": None,
     "errors": [],
 }
+_jobs = OrderedDict()            # job id -> progress dict, oldest first
+_jobs_lock = threading.Lock()
+_cycle_lock = threading.Lock()   # one sync at a time (scheduler or manual trigger)
+_host_map_state = {"reconciled_at": float("-inf"), "reconciles": 0, "provisioned": 0}
 
 router = APIRouter(prefix="/api/zabbix/sender", tags=["zabbix_sender"])
 
 
-# ── Zabbix JSON-RPC client (raw requests, no py-zabbix ZabbixAPI) ────
-_req_id = 0
-
-def _zbx_call(method: str, params: dict, auth: Optional[str] = None) -> dict:
-    """Make a Zabbix API JSON-RPC call, raise on error."""
-    global _req_id
-    _req_id += 1
-    payload = {
-        "jsonrpc": "2.0",
-        "method": method,
-        "params": params,
-        "auth": auth,
-        "id": _req_id,
-    }
-    r = requests.post(
-        f"{ZABBIX_API_URL}/api_jsonrpc.php",
-        json=payload,
-        timeout=10,
-        verify=False,
-    )
-    r.raise_for_status()
-    data = r.json()
-    if "error" in data:
-        raise Exception(data["error"].get("data", data["error"]))
-    return data["result"]
-
-
-def _zbx_login() -> str:
-    """Authenticate and return auth token."""
-    return _zbx_call("user.login", {"user": ZABBIX_USER, "password": ZABBIX_PASS})
-
-
-def _ensure_host_group(auth: str) -> str:
-    groups = _zbx_call("hostgroup.get", {"filter": {"name": [HOST_GROUP_NAME]}, "output": ["groupid"]}, auth)
-    if groups:
-        return groups[0]["groupid"]
-    res = _zbx_call("hostgroup.create", {"name": HOST_GROUP_NAME}, auth)
-    return res["groupids"][0]
+# ── Host / item provisioning ──────────────────────────────────────────
+# relay → Zabbix hostid (and the item keys created on it) is kept in the
+# zabbix_hosts table: a sync cycle only calls the Zabbix API for relays
+# without a complete mapping, plus a full reconcile every
+# ZABBIX_RECONCILE_INTERVAL. Relay deletion drops the row (FK cascade).
+ITEM_KEYS = sorted(item["key"] for item in ITEM_DEFS)
 
 
-def _ensure_host(auth: str, host_name: str, groupid: str) -> str:
-    hosts = _zbx_call("host.get", {"filter": {"host": [host_name]}, "output": ["hostid"]}, auth)
-    if hosts:
-        return hosts[0]["hostid"]
-    res = _zbx_call("host.create", {
+def _host_definition(host_name: str, groupid: str) -> dict:
+    return {
         "host": host_name,
         "name": host_name,
         "groups": [{"groupid": groupid}],
@@ -110,141 +115,377 @@ def _ensure_host(auth: str, host_name: str, groupid: str) -> str:
             "type": 1, "main": 1, "useip": 1,
             "ip": "127.0.0.1", "dns": "", "port": "10050",
         }],
-    }, auth)
-    return res["hostids"][0]
+    }
 
 
-def _ensure_items(auth: str, hostid: str) -> None:
-    """Ensure all metric items exist for this host (Zabbix trapper type=2)."""
-    existing = _zbx_call("item.get", {
-        "hostids": hostid,
+def _item_definition(hostid: str, item: dict) -> dict:
+    """Zabbix trapper item (type=2) for one metric."""
+    return {
+        "hostid": hostid,
+        "name": item["name"],
+        "key_": item["key"],
+        "type": 2,
+        "value_type": item["value_type"],
+        "units": item["units"],
+        "delay": 0,
+    }
+
+
+def _provision(names) -> dict:
+    """Make sure hosts + items exist for *names* (relay names) in a handful
+    of API requests whatever the number of relays. Returns name -> hostid."""
+    host_names = [f"wpex-{n}" for n in names]
+    groups, hosts = batch([
+        ("hostgroup.get", {"filter": {"name": [HOST_GROUP_NAME]}, "output": ["groupid"]}),
+        ("host.get", {"filter": {"host": host_names}, "output": ["hostid", "host"]}),
+    ])
+    for result in (groups, hosts):
+        if isinstance(result, ZabbixError):
+            raise result
+    created = False
+    if groups:
+        groupid = groups[0]["groupid"]
+    else:
+        groupid = call("hostgroup.create", {"name": HOST_GROUP_NAME})["groupids"][0]
+        created = True
+
+    hostids = {h["host"]: h["hostid"] for h in hosts}
+    missing = [h for h in host_names if h not in hostids]
+    if missing:
+        res = call("host.create", [_host_definition(h, groupid) for h in missing])
+        hostids.update(zip(missing, res["hostids"]))
+        created = True
+        logger.info(f"Created {len(missing)} Zabbix hosts")
+
+    existing = call("item.get", {
+        "hostids": list(hostids.values()),
         "search": {"key_": "wpex."},
-        "output": ["itemid", "key_"],
-    }, auth)
-    existing_keys = {i["key_"] for i in existing}
-
-    for item in ITEM_DEFS:
-        if item["key"] not in existing_keys:
-            _zbx_call("item.create", {
-                "hostid": hostid,
-                "name": item["name"],
-                "key_": item["key"],
-                "type": 2,
-                "value_type": item["value_type"],
-                "units": item["units"],
-                "delay": 0,
-            }, auth)
-            logger.debug(f"Created Zabbix item {item['key']} for host {hostid}")
-
-
-# ── Stats fetch helpers ───────────────────────────────────────────────
-def _fetch_relay_stats(container_name: str) -> Optional[dict]:
-    """Fetch /api/v1/stats from a wpex relay container."""
+        "output": ["hostid", "key_"],
+    })
+    have = {(i["hostid"], i["key_"]) for i in existing}
+    new_items = [_item_definition(hostid, item) for hostid in hostids.values()
+                 for item in ITEM_DEFS if (hostid, item["key"]) not in have]
+    if new_items:
+        call("item.create", new_items)
+        created = True
+        logger.info(f"Created {len(new_items)} Zabbix items")
+    if created:
+        invalidate_metadata()
+    return {n: hostids[f"wpex-{n}"] for n in names}
+
+
+def _load_relays(get_db) -> list:
+    """(server id, name, labels, Zabbix item keys or None) of every relay."""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT s.id, s.name, s.tenant_id, t.slug, s.region, z.item_keys FROM servers s
+            LEFT JOIN tenants t ON t.id = s.tenant_id
+            LEFT JOIN zabbix_hosts z ON z.server_id = s.id
+        """)
+        return [(sid, name, {"tenant_id": tenant_id, "tenant": slug, "region": region}, keys)
+                for sid, name, tenant_id, slug, region, keys in cur.fetchall()]
+
+
+def _sync_host_map(relays: list, get_db, errors: list) -> list:
+    """Relay names that are provisioned in Zabbix, provisioning the new ones."""
+    rows = [(sid, name, keys) for sid, name, _, keys in relays]
+    reconcile = time.monotonic() - _host_map_state["reconciled_at"] >= ZABBIX_RECONCILE_INTERVAL
+    server_ids = {name: sid for sid, name, _ in rows}
+    todo = [name for _, name, keys in rows if reconcile or sorted(keys or []) != ITEM_KEYS]
+    ready = [name for name in server_ids if name not in todo]
+    if not todo:
+        return ready
+
     try:
-        r = requests.get(f"http://{container_name}:8080/api/v1/stats", timeout=3)
-        if r.status_code == 200:
-            return r.json()
-    except Exception:
-        pass
-    return None
-
-
-def _extract_metrics(stats: dict) -> dict:
-    """Parse wpex stats JSON into flat metrics dict."""
-    peers = stats.get("peers", [])
-    active_peers = sum(1 for p in peers if p.get("status") == "connected")
-    bytes_rx = sum(p.get("bytes_received", 0) for p in peers)
-    bytes_tx = sum(p.get("bytes_sent", 0) for p in peers)
-    total_hs = stats.get("total_handshakes", 0)
-    success_hs = stats.get("successful_handshakes", 0)
-    success_rate = round((success_hs / total_hs * 100), 2) if total_hs > 0 else 0.0
-    uptime = stats.get("uptime_seconds", 0)
+        hostids = _provision(todo)
+    except ZabbixError as e:
+        msg = f"Zabbix provisioning of {len(todo)} relays failed: {e}"
+        logger.error(msg)
+        errors.append(msg)
+        return ready
+    with get_db() as conn:
+        cur = conn.cursor()
+        execute_values(cur, """
+            INSERT INTO zabbix_hosts (server_id, hostid, item_keys, updated_at) VALUES %s
+            ON CONFLICT (server_id) DO UPDATE SET hostid = EXCLUDED.hostid, item_keys = EXCLUDED.item_keys,
+                                                  updated_at = EXCLUDED.updated_at
+        """, [(server_ids[n], hostid, ITEM_KEYS, datetime.now()) for n, hostid in hostids.items()])
+        conn.commit()
+    _host_map_state["provisioned"] += len(hostids)
+    if reconcile:
+        _host_map_state["reconciled_at"] = time.monotonic()
+        _host_map_state["reconciles"] += 1
+    return ready + list(hostids)
+
 
+# ── Main collection job ───────────────────────────────────────────────
+def _send_chunks(sender: ZabbixSender, zbx_metrics: list, errors: list, on_chunk=None) -> dict:
+    """Send metrics in ZABBIX_SEND_CHUNK sized batches; a failed chunk doesn't
+    stop the others and is spooled to disk for replay. *on_chunk(n)* is told
+    how many metrics have been handled after each batch."""
+    totals = {"processed": 0, "failed": 0, "spooled": 0, "chunks": 0}
+    for i in range(0, len(zbx_metrics), ZABBIX_SEND_CHUNK):
+        chunk = zbx_metrics[i:i + ZABBIX_SEND_CHUNK]
+        try:
+            result = sender.send(chunk)
+            totals["processed"] += result.processed
+            totals["failed"] += result.failed
+            totals["chunks"] += 1
+        except Exception as e:
+            errors.append(f"trapper send of {len(chunk)} metrics failed: {e}")
+            logger.error(f"Zabbix trapper send failed: {e}")
+            if zabbix_spool.append([{"host": m.host, "key": m.key, "value": m.value, "clock": m.clock} for m in chunk]):
+                totals["spooled"] += len(chunk)
+            else:
+                totals["failed"] += len(chunk)
+        if on_chunk is not None:
+            on_chunk(i + len(chunk))
+    return totals
+
+
+def replay_spool():
+    """Drain spooled metrics (original clocks kept) once the trapper port answers again.
+    Runs on every replica: each one replays its own spool subdirectory, plus
+    the ones it adopts from processes that are gone (see zabbix_spool)."""
+    sender = ZabbixSender(zabbix_server=ZABBIX_HOST, zabbix_port=ZABBIX_SENDER_PORT)
+    zabbix_spool.replay(
+        lambda batch: sender.send([ZabbixMetric(m["host"], m["key"], m["value"], m["clock"]) for m in batch]),
+        ZABBIX_SEND_CHUNK,
+    )
+
+
+class ZabbixSink(MetricsSink):
+    """Trapper sink: samples of relays with a Zabbix host, in chunked bulk sends."""
+
+    name = "zabbix"
+
+    def __init__(self):
+        self.provisioned = set()     # relays with a Zabbix host, set by each sync cycle
+
+    def write(self, samples: list, progress=None) -> dict:
+        ready = [s for s in samples if s["relay"] in self.provisioned]
+        waiting = len(samples) - len(ready)
+        zbx_metrics = [
+            ZabbixMetric(sample["host"], key, str(val), sample["clock"])
+            for sample in ready
+            for key, val in sample["metrics"].items() if val is not None
+        ]
+        errors = []
+        sender = ZabbixSender(zabbix_server=ZABBIX_HOST, zabbix_port=ZABBIX_SENDER_PORT)
+        per_host = max(len(zbx_metrics) / len(ready), 1) if ready else 1
+        on_chunk = (lambda n: progress(waiting + int(n / per_host))) if progress else None
+        result = _send_chunks(sender, zbx_metrics, errors, on_chunk=on_chunk)
+        logger.info(f"Pushed {result['processed']}/{len(zbx_metrics)} metrics in {result['chunks']} chunks")
+        return {**result, "hosts": len(ready), "errors": errors}
+
+
+_zabbix_sink = ZabbixSink()
+register_sink(_zabbix_sink)
+
+
+# ── Sync jobs ─────────────────────────────────────────────────────────
+# Every sync — scheduled or manual — is a job with live progress. Jobs run
+# one at a time (_cycle_lock) on the leader; progress is published to
+# job_status so any replica can answer for it. A manual trigger reaching
+# another replica is published there as "queued" for the leader to start.
+def _job_fields(trigger: str, job_id: str = None, status: str = "running") -> dict:
     return {
-        "wpex.bytes_rx":          bytes_rx,
-        "wpex.bytes_tx":          bytes_tx,
-        "wpex.active_peers":      active_peers,
-        "wpex.total_peers":       len(peers),
-        "wpex.handshake_success": success_rate,
-        "wpex.total_handshakes":  total_hs,
-        "wpex.uptime_seconds":    uptime,
+        "job_id": job_id or uuid.uuid4().hex,
+        "trigger": trigger,
+        "status": status,
+        "phase": "queued" if status == "queued" else "provisioning",
+        "relays_total": None,
+        "relays_done": 0,
+        "errors": [],
+        "started_at": datetime.now().isoformat(),
+        "finished_at": None,
+        "duration_ms": None,
     }
 
 
-# ── Main collection job ───────────────────────────────────────────────
+def _new_job(trigger: str, job_id: str = None) -> dict:
+    job = _job_fields(trigger, job_id)
+    with _jobs_lock:
+        _jobs[job["job_id"]] = job
+        while len(_jobs) > ZABBIX_JOBS_KEPT:
+            _jobs.popitem(last=False)
+    _last_sync["current_job"] = job["job_id"]
+    _job_progress(job, force=True)   # visible on every replica as soon as the trigger answers
+    return job
+
+
+def _job_view(job: dict) -> dict:
+    view = {k: v for k, v in job.items() if k != "_published"}
+    view["errors"] = job["errors"][-ZABBIX_JOB_ERRORS_KEPT:]
+    return view
+
+
+def _job_progress(job: dict, force: bool = False, **fields):
+    """Update a job; publish it for other replicas at most once a second."""
+    with _jobs_lock:
+        job.update(fields)
+        view = _job_view(job)
+    now = time.monotonic()
+    if force or now - job.get("_published", 0) >= 1:
+        job["_published"] = now
+        leader.publish_status(f"{JOB_STATUS_PREFIX}{job['job_id']}", view)
+
+
+def _heartbeat():
+    """Republish the running job, and on the leader the queued ones, so
+    readers can tell a slow phase or a wait from a dead leader."""
+    with _jobs_lock:
+        job = _jobs.get(_last_sync["current_job"])
+    if job is not None and job["finished_at"] is None:
+        _job_progress(job, force=True)
+    if leader.is_leader():
+        for queued in _pending_jobs("queued"):
+            leader.publish_status(f"{JOB_STATUS_PREFIX}{queued['job_id']}", queued)
+
+
+def _published_view(job: dict, updated_at: datetime) -> dict:
+    """A job as published by another process; unfinished but silent for
+    ZABBIX_JOB_LOST_AFTER means its process died or stepped down mid-job."""
+    if job["finished_at"] is None and (datetime.now() - updated_at).total_seconds() > ZABBIX_JOB_LOST_AFTER:
+        return {**job, "status": "lost", "phase": "done", "finished_at": updated_at.isoformat()}
+    return job
+
+
+def _get_job(job_id: str):
+    """A job's progress: from this process if it ran here, else as published by the leader."""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            return _job_view(job)
+    try:
+        row = leader.read_status(f"{JOB_STATUS_PREFIX}{job_id}")
+    except Exception as e:
+        logger.error(f"Could not read job {job_id}: {e}")
+        return None
+    if row is None:
+        return None
+    status, _, updated_at = row
+    return _published_view(status, updated_at)
+
+
+def _pending_jobs(status: str = None) -> list:
+    """Published jobs that are neither finished nor lost, oldest first."""
+    try:
+        rows = leader.list_status(JOB_STATUS_PREFIX)
+    except Exception as e:
+        logger.error(f"Could not list sync jobs: {e}")
+        return []
+    jobs = [_published_view(job, updated_at) for _, job, _, updated_at in rows]
+    return [j for j in jobs if j["finished_at"] is None and (status is None or j["status"] == status)]
+
+
+def run_queued_jobs():
+    """Start the oldest job queued by another replica, once no sync is running."""
+    if not leader.is_leader():
+        return
+    queued = _pending_jobs("queued")
+    if not queued or not _cycle_lock.acquire(blocking=False):
+        return
+    _run_job(_new_job(queued[0]["trigger"], job_id=queued[0]["job_id"]))
+
+
 def collect_and_push():
     """
-    For each wpex relay server in the DB:
-      1. Fetch /api/v1/stats
-      2. Register host + items in Zabbix (idempotent)
-      3. Send metrics via ZabbixSender (trapper protocol, port 10051)
+    Scheduled sync cycle for every wpex relay server in the DB:
+      1. Register hosts + items in Zabbix for relays not in zabbix_hosts yet
+      2. Take all relay stats from the relay stats collector at once
+      3. Send every metric in chunked bulk trapper sends (port 10051),
+         stamped with the time each relay was actually polled
     """
+    if not leader.is_leader():
+        return                   # another replica runs the sync
+    if not _cycle_lock.acquire(blocking=False):
+        _last_sync["skipped_cycles"] += 1
+        logger.warning("Zabbix sync still running, cycle skipped")
+        return
+    _run_job(_new_job("scheduled"))
+
+
+def _run_job(job: dict):
+    """Run one sync as *job*; the caller holds _cycle_lock, released here."""
+    started = time.monotonic()
+    try:
+        _collect_and_push(job)
+    except Exception as e:
+        logger.error(f"Zabbix sync job {job['job_id']} failed: {e}")
+        job["errors"].append(str(e))
+        _last_sync.update({"time": datetime.now().isoformat(), "status": "error", "errors": job["errors"]})
+    finally:
+        _last_sync["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+        _last_sync.update(current_job=None, last_job=job["job_id"])
+        _cycle_lock.release()
+        _job_progress(job, force=True, phase="done", status=_last_sync["status"],
+                      finished_at=datetime.now().isoformat(), duration_ms=_last_sync["duration_ms"])
+    leader.publish_status(STATUS_JOB, _local_status())
+    leader.prune_status(JOB_STATUS_PREFIX, ZABBIX_JOB_RETENTION)
+
+
+def _collect_and_push(job: dict):
     from database import get_db
 
-    errors = []
-    pushed = 0
+    errors = job["errors"]
 
-    # Connect to Zabbix API
     try:
-        auth = _zbx_login()
-        groupid = _ensure_host_group(auth)
+        relays = _load_relays(get_db)
     except Exception as e:
-        msg = f"Zabbix API unreachable: {e}"
+        msg = f"DB read failed: {e}"
         logger.error(msg)
-        _last_sync.update({"time": datetime.now().isoformat(), "status": "error", "hosts_pushed": 0, "errors": [msg]})
+        errors.append(msg)
+        _last_sync.update({"time": datetime.now().isoformat(), "status": "error", "hosts_pushed": 0,
+                           "relays_polled": 0, "errors": [msg]})
         return
 
-    # Load servers from DB
+    # Relays with a Zabbix host, provisioning any new ones in one batch
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT name FROM servers")
-        server_names = [row[0] for row in cur.fetchall()]
-        conn.close()
+        _zabbix_sink.provisioned = set(_sync_host_map(relays, get_db, errors))
     except Exception as e:
-        logger.error(f"DB read failed: {e}")
-        _last_sync.update({"time": datetime.now().isoformat(), "status": "error", "hosts_pushed": 0, "errors": [str(e)]})
-        return
-
-    # Prepare ZabbixSender once (connects to port 10051)
-    sender = ZabbixSender(zabbix_server=ZABBIX_HOST, zabbix_port=ZABBIX_SENDER_PORT)
-
-    for name in server_names:
-        container_name = f"wpex-{name}"
-
-        # Fetch stats from relay
-        stats = _fetch_relay_stats(container_name)
-        if stats is None:
-            logger.debug(f"No stats from {container_name}, skipping")
-            continue
-
-        try:
-            # Ensure Zabbix host + items exist
-            hostid = _ensure_host(auth, container_name, groupid)
-            _ensure_items(auth, hostid)
-
-            # Build and send metrics
-            metrics = _extract_metrics(stats)
-            zbx_metrics = [
-                ZabbixMetric(container_name, key, str(val))
-                for key, val in metrics.items()
-            ]
-            result = sender.send(zbx_metrics)
-            logger.info(f"Pushed {len(zbx_metrics)} metrics for {container_name}: {result}")
-            pushed += 1
-
-        except Exception as e:
-            err = f"{container_name}: {e}"
-            logger.error(f"Failed to push metrics for {container_name}: {e}")
-            errors.append(err)
+        msg = f"Zabbix host map sync failed: {e}"
+        logger.error(msg)
+        errors.append(msg)
+        _zabbix_sink.provisioned = set()
+    _job_progress(job, phase="polling", relays_total=len(relays))
+
+    # Latest stats of every relay, fetched concurrently where older than a poll interval
+    names = [name for _, name, _, _ in relays]
+    snapshots = get_snapshots(names, max_age=POLL_INTERVAL, deadline=ZABBIX_FETCH_DEADLINE)
+    samples = [make_sample(name, snapshots[name], labels) for _, name, labels, _ in relays
+               if snapshots[name]["stats"] is not None and not snapshots[name]["stale"]]
+    skipped = len(relays) - len(samples)
+    if skipped:
+        logger.debug(f"No stats from {skipped} relays, skipping them")
+    _job_progress(job, phase="sending", relays_done=skipped)
+
+    # Every sink gets the same samples
+    results = write_samples(samples, errors, progress=lambda n: _job_progress(job, relays_done=skipped + n))
+    _job_progress(job, relays_done=len(relays))
+    zabbix = results.get(ZabbixSink.name, {})
 
     _last_sync.update({
         "time": datetime.now().isoformat(),
         "status": "ok" if not errors else "partial",
-        "hosts_pushed": pushed,
-        "errors": errors,
+        "hosts_pushed": zabbix.get("hosts", 0) if zabbix.get("chunks") else 0,
+        "relays_polled": len(samples),
+        "relays_total": len(relays),
+        "metrics_sent": zabbix.get("processed", 0),
+        "metrics_failed": zabbix.get("failed", 0),
+        "metrics_spooled": zabbix.get("spooled", 0),
+        "sinks": results,
+        "errors": list(errors),
     })
-    logger.info(f"Zabbix sync done — {pushed}/{len(server_names)} hosts pushed")
+    logger.info(f"Sync done — {len(samples)}/{len(relays)} relays polled, written to {', '.join(results)}")
+
+
+def _on_job_skipped(event):
+    if event.job_id != "zabbix_collector":
+        return
+    _last_sync["skipped_cycles"] += 1
+    logger.warning("Scheduled Zabbix sync skipped, previous cycle still running")
 
 
 # ── Scheduler ─────────────────────────────────────────────────────────
@@ -262,19 +503,126 @@ def start_scheduler():
         max_instances=1,
         coalesce=True,
     )
+    _scheduler.add_job(
+        replay_spool,
+        "interval",
+        seconds=ZABBIX_SPOOL_REPLAY_INTERVAL,
+        id="zabbix_spool_replay",
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+    )
+    _scheduler.add_job(
+        run_queued_jobs,
+        "interval",
+        seconds=ZABBIX_JOB_PICKUP_INTERVAL,
+        id="zabbix_queued_jobs",
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+    )
+    _scheduler.add_job(
+        _heartbeat,
+        "interval",
+        seconds=ZABBIX_JOB_HEARTBEAT,
+        id="zabbix_job_heartbeat",
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+    )
+    _scheduler.add_listener(_on_job_skipped, EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED)
     _scheduler.start()
     logger.info(f"Zabbix collector started — polling every {POLL_INTERVAL}s → {ZABBIX_API_URL}")
 
 
+def stop_scheduler():
+    """Stop syncing before stepping down as leader: no new cycles, and wait
+    for a running one so the next leader doesn't send alongside it."""
+    if _scheduler.running:
+        _scheduler.shutdown(wait=False)
+    # Kept held: a manual trigger arriving during shutdown gets a 409
+    if not _cycle_lock.acquire(timeout=ZABBIX_STOP_TIMEOUT):
+        logger.warning(f"Zabbix sync job {_last_sync['current_job']} still running after {ZABBIX_STOP_TIMEOUT}s")
+
+
 # ── REST endpoints ─────────────────────────────────────────────────────
-@router.post("/trigger")
+@router.post("/trigger", status_code=202)
 def manual_trigger():
-    """Manually trigger a Zabbix sync and return the result."""
-    collect_and_push()
-    return _last_sync
+    """Start a Zabbix sync in the background and return its job id
+    (follow it on /jobs/{job_id} or /jobs/{job_id}/events). On a replica
+    that isn't the leader the job is queued for the leader to start."""
+    if leader.is_leader():
+        if not _cycle_lock.acquire(blocking=False):
+            raise HTTPException(status_code=409,
+                                detail=f"Sincronizzazione Zabbix già in corso (job {_last_sync['current_job']})")
+        job = _new_job("manual")
+        threading.Thread(target=_run_job, args=(job,), name="zabbix-sync-job", daemon=True).start()
+        return {"job_id": job["job_id"], "status": job["status"]}
+
+    pending = _pending_jobs()
+    running = [j for j in pending if j["status"] == "running"]
+    if running:
+        raise HTTPException(status_code=409,
+                            detail=f"Sincronizzazione Zabbix già in corso (job {running[0]['job_id']})")
+    if pending:                  # already queued: follow that one
+        return {"job_id": pending[0]["job_id"], "status": pending[0]["status"]}
+    job = _job_fields("manual", status="queued")
+    leader.publish_status(f"{JOB_STATUS_PREFIX}{job['job_id']}", job)
+    if _get_job(job["job_id"]) is None:
+        raise HTTPException(status_code=503, detail="Impossibile accodare la sincronizzazione Zabbix")
+    return {"job_id": job["job_id"], "status": job["status"]}
+
+
+@router.get("/jobs/{job_id}")
+def job_progress(job_id: str):
+    """Progress of a sync job: phase, relays done / total, errors so far."""
+    job = _get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job non trovato")
+    return job
+
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent events with the job's progress until it finishes."""
+    if await run_in_threadpool(_get_job, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job non trovato")
+
+    async def stream():
+        last = None
+        while True:
+            job = await run_in_threadpool(_get_job, job_id)
+            if job is None:
+                return
+            if job != last:
+                yield f"data: {json.dumps(job)}\n\n"
+                last = job
+            if job["finished_at"] is not None:
+                return
+            await asyncio.sleep(ZABBIX_JOB_EVENT_INTERVAL)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @router.get("/status")
 def sync_status():
-    """Return the last sync status."""
-    return _last_sync
+    """Return the last sync status, as published by the leader replica."""
+    try:
+        row = leader.read_status(STATUS_JOB)
+    except Exception as e:
+        logger.error(f"Could not read shared sync status: {e}")
+        row = None
+    if row is None:
+        return {**_local_status(), "leader": None, "served_by": leader.REPLICA_ID}
+    status, replica, updated_at = row
+    return {**status, "leader": replica, "published_at": updated_at.isoformat(), "served_by": leader.REPLICA_ID}
+
+
+def _local_status() -> dict:
+    last = _host_map_state["reconciled_at"]
+    return {**_last_sync, "spool": zabbix_spool.spool_stats(), "host_map": {
+        "provisioned": _host_map_state["provisioned"],
+        "reconciles": _host_map_state["reconciles"],
+        "last_reconcile_age_s": round(time.monotonic() - last, 1) if last != float("-inf") else None,
+    }}
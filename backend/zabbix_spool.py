@@ -0,0 +1,294 @@
+"""
+WPEX Orchestrator — Zabbix Metrics Spool
+Append-only on-disk buffer for trapper metrics that could not be sent.
+Metrics are written as JSON lines into segment files with their original
+clock. A segment is sealed once it reaches ZABBIX_SPOOL_SEGMENT_BYTES or
+ZABBIX_SPOOL_SEGMENT_AGE, and replay() drains sealed segments oldest first
+once Zabbix accepts data again. The oldest segments are dropped when the
+spool exceeds ZABBIX_SPOOL_MAX_BYTES or ZABBIX_SPOOL_MAX_AGE.
+
+Processes sharing ZABBIX_SPOOL_DIR (replicas on one node, uvicorn workers)
+each write to their own subdirectory, named after the replica id and held
+with a flock for the life of the process. Segments of a subdirectory whose
+lock is free belong to a process that is gone, and the next replay adopts
+them.
+"""
+
+import os
+import re
+import json
+import time
+import fcntl
+import logging
+import threading
+
+import leader
+
+logger = logging.getLogger("zabbix_spool")
+
+ZABBIX_SPOOL_DIR           = os.environ.get("ZABBIX_SPOOL_DIR", "/var/lib/wpex/zabbix-spool")
+ZABBIX_SPOOL_SEGMENT_BYTES = int(os.environ.get("ZABBIX_SPOOL_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+ZABBIX_SPOOL_SEGMENT_AGE   = int(os.environ.get("ZABBIX_SPOOL_SEGMENT_AGE", "300"))       # seal the open segment after (s)
+ZABBIX_SPOOL_MAX_BYTES     = int(os.environ.get("ZABBIX_SPOOL_MAX_BYTES", str(256 * 1024 * 1024)))
+ZABBIX_SPOOL_MAX_AGE       = int(os.environ.get("ZABBIX_SPOOL_MAX_AGE", str(7 * 86400)))  # drop older segments (s)
+
+_SUFFIX = ".jsonl"
+_SEGMENT_NAME = re.compile(r"seg-\d+-(\d+)\.jsonl")
+_LOCK_NAME = ".owner.lock"
+_ADOPT_GRACE = 60                # leave subdirectories this fresh alone: their owner may be starting (s)
+
+_lock = threading.Lock()         # segment list + open segment
+_replay_lock = threading.Lock()  # one replay at a time
+_segments = []                   # [{"path", "bytes", "metrics", "created"}] oldest first; the last may be open
+_open = {"segment": None}
+_state = {"ready": False, "seq": 0, "error": None, "dir": None, "lock": None}
+_stats = {"spooled": 0, "replayed": 0, "dropped": 0, "adopted": 0, "replays": 0, "last_replay_at": None,
+          "last_replay_metrics": 0, "last_replay_per_s": None, "last_replay_error": None}
+
+
+def _load():
+    """Claim this process's subdirectory and pick up segments a previous
+    run with the same replica id left there (called under _lock)."""
+    if _state["ready"]:
+        return True
+    own = os.path.join(ZABBIX_SPOOL_DIR, leader.REPLICA_ID.replace("/", "_"))
+    lock = None
+    try:
+        os.makedirs(own, exist_ok=True)
+        lock = open(os.path.join(own, _LOCK_NAME), "a")
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        names = sorted(n for n in os.listdir(own) if _SEGMENT_NAME.fullmatch(n))
+    except OSError as e:
+        if lock is not None:
+            lock.close()
+        if _state["error"] != str(e):        # retried every replay tick: log once
+            logger.error(f"Zabbix spool unavailable at {own}: {e}")
+        _state["error"] = str(e)
+        return False
+    _state.update(dir=own, lock=lock)
+    for name in names:
+        path = os.path.join(own, name)
+        with open(path, "rb") as f:
+            data = f.read()
+        _segments.append({"path": path, "bytes": len(data), "metrics": data.count(b"\n"),
+                          "created": os.path.getmtime(path)})
+        _state["seq"] = max(_state["seq"], int(_SEGMENT_NAME.fullmatch(name).group(1)))
+    _state.update(ready=True, error=None)
+    if names:
+        logger.info(f"Zabbix spool: {len(names)} segments pending from a previous run")
+    return True
+
+
+def _segment_path(created: float) -> str:
+    _state["seq"] += 1
+    return os.path.join(_state["dir"], f"seg-{int(created)}-{_state['seq']:08d}{_SUFFIX}")
+
+
+def _new_segment() -> dict:
+    segment = {"path": _segment_path(time.time()), "bytes": 0, "metrics": 0, "created": time.time()}
+    _segments.append(segment)
+    _open["segment"] = segment
+    return segment
+
+
+def _take(src: str) -> int:
+    """Move an orphaned segment into this process's subdirectory; returns its metric count."""
+    try:
+        created = os.path.getmtime(src)
+        path = _segment_path(created)
+        os.rename(src, path)             # atomic: a concurrent adopter gets FileNotFoundError
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return 0
+    metrics = data.count(b"\n")
+    _segments.append({"path": path, "bytes": len(data), "metrics": metrics, "created": created})
+    return metrics
+
+
+def _adopt():
+    """Take over segments of processes that are gone (called under _lock)."""
+    try:
+        entries = os.listdir(ZABBIX_SPOOL_DIR)
+    except OSError:
+        return
+    adopted = 0
+    for entry in entries:
+        path = os.path.join(ZABBIX_SPOOL_DIR, entry)
+        if path == _state["dir"]:
+            continue
+        if _SEGMENT_NAME.fullmatch(entry):           # top-level segment of a pre-subdirectory version
+            adopted += _take(path)
+            continue
+        try:
+            if not os.path.isdir(path) or time.time() - os.path.getmtime(path) < _ADOPT_GRACE:
+                continue
+            lock = open(os.path.join(path, _LOCK_NAME), "a")
+        except OSError:
+            continue
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()                             # owner still running
+            continue
+        try:
+            for name in sorted(os.listdir(path)):
+                if _SEGMENT_NAME.fullmatch(name):
+                    adopted += _take(os.path.join(path, name))
+                elif name != _LOCK_NAME:
+                    os.remove(os.path.join(path, name))  # interrupted rewrite (.tmp)
+            os.remove(os.path.join(path, _LOCK_NAME))
+            os.rmdir(path)
+        except OSError as e:
+            logger.warning(f"Zabbix spool: could not fully adopt {path}: {e}")
+        finally:
+            lock.close()
+    if adopted:
+        _segments.sort(key=lambda s: s["created"])
+        _stats["adopted"] += adopted
+        logger.info(f"Zabbix spool: adopted {adopted} metrics left by other processes")
+
+
+def _seal_if_due():
+    segment = _open["segment"]
+    if segment is not None and (segment["bytes"] >= ZABBIX_SPOOL_SEGMENT_BYTES
+                                or time.time() - segment["created"] >= ZABBIX_SPOOL_SEGMENT_AGE):
+        _open["segment"] = None
+
+
+def _enforce_caps():
+    """Drop the oldest segments beyond the size/age caps (called under _lock)."""
+    now = time.time()
+    while _segments:
+        oldest = _segments[0]
+        too_big = sum(s["bytes"] for s in _segments) > ZABBIX_SPOOL_MAX_BYTES
+        too_old = now - oldest["created"] > ZABBIX_SPOOL_MAX_AGE
+        if not (too_big or too_old):
+            return
+        _segments.pop(0)
+        if oldest is _open["segment"]:
+            _open["segment"] = None
+        _stats["dropped"] += oldest["metrics"]
+        logger.warning(f"Zabbix spool over {'age' if too_old else 'size'} cap, dropped {oldest['metrics']} metrics")
+        try:
+            os.remove(oldest["path"])
+        except OSError:
+            pass
+
+
+def append(metrics: list) -> bool:
+    """Spool metric dicts ({"host", "key", "value", "clock"}). False if the spool is unusable."""
+    if not metrics:
+        return True
+    data = "".join(json.dumps(m, separators=(",", ":")) + "\n" for m in metrics).encode()
+    with _lock:
+        if not _load():
+            return False
+        _seal_if_due()
+        segment = _open["segment"] or _new_segment()
+        try:
+            with open(segment["path"], "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            _state["error"] = str(e)
+            logger.error(f"Zabbix spool write failed: {e}")
+            return False
+        segment["bytes"] += len(data)
+        segment["metrics"] += len(metrics)
+        _stats["spooled"] += len(metrics)
+        _enforce_caps()
+    return True
+
+
+def _rewrite(segment: dict, lines: list):
+    tmp = segment["path"] + ".tmp"
+    with open(tmp, "wb") as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, segment["path"])
+    segment["bytes"] = sum(len(line) for line in lines)
+    segment["metrics"] = len(lines)
+
+
+def replay(send, chunk_size: int) -> int:
+    """Drain the spool oldest first through *send(list_of_metric_dicts)*.
+
+    Stops at the first failed chunk and keeps what is left for the next
+    run. Returns the number of metrics replayed.
+    """
+    if not _replay_lock.acquire(blocking=False):
+        return 0
+    started, replayed, error = time.monotonic(), 0, None
+    try:
+        with _lock:
+            if not _load():
+                return 0
+            _adopt()
+            if not _segments:
+                return 0
+            _open["segment"] = None              # seal: new failures go to a fresh segment
+            _enforce_caps()
+            pending = list(_segments)
+
+        for segment in pending:
+            try:
+                with open(segment["path"], "rb") as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                lines = []                       # dropped by the caps meanwhile
+            sent = 0
+            try:
+                for i in range(0, len(lines), chunk_size):
+                    chunk = lines[i:i + chunk_size]
+                    send([json.loads(line) for line in chunk])
+                    sent += len(chunk)
+            except Exception as e:
+                error = str(e)
+            replayed += sent
+            with _lock:
+                if error is None:
+                    if segment in _segments:
+                        _segments.remove(segment)
+                    try:
+                        os.remove(segment["path"])
+                    except OSError:
+                        pass
+                elif sent and segment in _segments:
+                    _rewrite(segment, lines[sent:])
+            if error is not None:
+                logger.warning(f"Zabbix spool replay paused after {replayed} metrics: {error}")
+                break
+    finally:
+        elapsed = time.monotonic() - started
+        if replayed or error:
+            _stats.update({
+                "replayed": _stats["replayed"] + replayed,
+                "replays": _stats["replays"] + 1,
+                "last_replay_at": time.time(),
+                "last_replay_metrics": replayed,
+                "last_replay_per_s": round(replayed / elapsed, 1) if elapsed > 0 else None,
+                "last_replay_error": error,
+            })
+        _replay_lock.release()
+    if replayed:
+        logger.info(f"Replayed {replayed} spooled metrics to Zabbix")
+    return replayed
+
+
+def spool_stats() -> dict:
+    with _lock:
+        segments = [dict(s) for s in _segments]
+    last = _stats["last_replay_at"]
+    return {
+        **{k: v for k, v in _stats.items() if k != "last_replay_at"},
+        "dir": _state["dir"] or ZABBIX_SPOOL_DIR,
+        "error": _state["error"],
+        "segments": len(segments),
+        "pending_metrics": sum(s["metrics"] for s in segments),
+        "bytes": sum(s["bytes"] for s in segments),
+        "oldest_segment_age_s": round(time.time() - segments[0]["created"], 1) if segments else None,
+        "last_replay_age_s": round(time.time() - last, 1) if last is not None else None,
+    }
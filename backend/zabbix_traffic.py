@@ -1,72 +1,101 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
-import requests
 import os
 from datetime import datetime, timedelta
 
-ZABBIX_URL = os.environ.get("ZABBIX_URL", "http://localhost/zabbix/api_jsonrpc.php")
-ZABBIX_USER = os.environ.get("ZABBIX_USER", "apiuser")
-ZABBIX_PASS = os.environ.get("ZABBIX_PASS", "apipass")
+from database import get_request_db
+from auth import get_current_user
+from zabbix_client import ZabbixError, call, cached
+
+ZABBIX_TREND_THRESHOLD = int(os.environ.get("ZABBIX_TREND_THRESHOLD", str(6 * 3600)))  # longer ranges read trend.get (s)
+ZABBIX_MAX_PERIOD = 31 * 86400
 
 router = APIRouter(prefix="/api/zabbix", tags=["zabbix"])
 
-# --- Helper for Zabbix API auth ---
-def zabbix_login():
-    payload = {
-        "jsonrpc": "2.0",
-        "method": "user.login",
-        "params": {"user": ZABBIX_USER, "password": ZABBIX_PASS},
-        "id": 1
-    }
-    r = requests.post(ZABBIX_URL, json=payload)
-    if not r.ok or "result" not in r.json():
-        raise HTTPException(status_code=502, detail="Zabbix auth failed")
-    return r.json()["result"]
+def _zbx(method: str, params: dict, error: str, meta: bool = False):
+    try:
+        return cached(method, params) if meta else call(method, params)
+    except ZabbixError:
+        raise HTTPException(status_code=502, detail=error)
+
+
+def _item_histories(items: list, time_from: int, time_till: int) -> dict:
+    """Values of every item in [time_from, time_till], keyed by item name.
+
+    One history.get per value type (Zabbix only returns a single type per
+    call) instead of one per item; ranges longer than ZABBIX_TREND_THRESHOLD
+    read the hourly trend.get averages instead of raw history.
+    """
+    names = {item["itemid"]: item["name"] for item in items}
+    series = {item["name"]: [] for item in items}
+    if not items:
+        return series
+
+    if time_till - time_from > ZABBIX_TREND_THRESHOLD:
+        rows = _zbx("trend.get", {
+            "itemids": list(names),
+            "time_from": time_from,
+            "time_till": time_till,
+            "output": ["itemid", "clock", "value_avg"],
+        }, "Zabbix trend fetch failed")
+        for row in sorted(rows, key=lambda r: int(r["clock"])):
+            series[names[row["itemid"]]].append({"clock": int(row["clock"]), "value": float(row["value_avg"])})
+        return series
+
+    by_type = {}
+    for item in items:
+        by_type.setdefault(int(item.get("value_type", 3)), []).append(item["itemid"])
+    for value_type, itemids in by_type.items():
+        rows = _zbx("history.get", {
+            "history": value_type,
+            "itemids": itemids,
+            "time_from": time_from,
+            "time_till": time_till,
+            "output": "extend",
+            "sortfield": "clock",
+            "sortorder": "ASC",
+        }, "Zabbix history fetch failed")
+        for row in rows:
+            series[names[row["itemid"]]].append({"clock": int(row["clock"]), "value": float(row["value"])})
+    return series
+
+
+def _period_bounds(period: int):
+    now = int(datetime.now().timestamp())
+    return now - max(60, min(period, ZABBIX_MAX_PERIOD)), now
+
 
 # --- API: Get traffic data for a host (example: net.if.in/if.out) ---
 @router.get("/traffic/{hostid}")
-def get_host_traffic(hostid: str):
-    token = zabbix_login()
+def get_host_traffic(hostid: str, period: int = 3600):
     # Get items for network interfaces (in/out)
-    item_payload = {
-        "jsonrpc": "2.0",
-        "method": "item.get",
-        "params": {
-            "hostids": hostid,
-            "search": {"key_": "net.if."},
-            "output": ["itemid", "name", "key_", "lastvalue"]
-        },
-        "auth": token,
-        "id": 2
-    }
-    r = requests.post(ZABBIX_URL, json=item_payload)
-    if not r.ok or "result" not in r.json():
-        raise HTTPException(status_code=502, detail="Zabbix item fetch failed")
-    items = r.json()["result"]
-    # For each item, get history (last hour)
-    now = int(datetime.now().timestamp())
-    hour_ago = now - 3600
-    traffic_data = {}
-    for item in items:
-        hist_payload = {
-            "jsonrpc": "2.0",
-            "method": "history.get",
-            "params": {
-                "itemids": item["itemid"],
-                "time_from": hour_ago,
-                "time_till": now,
-                "output": "extend",
-                "sortfield": "clock",
-                "sortorder": "ASC",
-                "limit": 60
-            },
-            "auth": token,
-            "id": 3
-        }
-        r2 = requests.post(ZABBIX_URL, json=hist_payload)
-        if not r2.ok or "result" not in r2.json():
-            continue
-        traffic_data[item["name"]] = [
-            {"clock": int(h["clock"]), "value": float(h["value"])} for h in r2.json()["result"]
-        ]
-    return traffic_data
+    items = _zbx("item.get", {
+        "hostids": hostid,
+        "search": {"key_": "net.if."},
+        "output": ["itemid", "name", "key_", "value_type"]
+    }, "Zabbix item fetch failed", meta=True)
+    time_from, time_till = _period_bounds(period)
+    return _item_histories(items, time_from, time_till)
+
+
+# --- API: Same, addressed by relay id (wpex-<name> host and its wpex.* trapper items) ---
+@router.get("/traffic/relay/{relay_id}")
+def get_relay_traffic(relay_id: int, period: int = 3600, user=Depends(get_current_user), db=Depends(get_request_db)):
+    cur = db.cursor()
+    cur.execute("SELECT name, tenant_id FROM servers WHERE id = %s", (relay_id,))
+    row = cur.fetchone()
+    db.release()
+    if not row or (user.get("role") in ("engineer", "viewer") and row[1] != user.get("tenant_id")):
+        raise HTTPException(status_code=404, detail="Relay non trovato")
+
+    hosts = _zbx("host.get", {"filter": {"host": [f"wpex-{row[0]}"]}, "output": ["hostid"]},
+                 "Zabbix host fetch failed", meta=True)
+    if not hosts:
+        raise HTTPException(status_code=404, detail="Host Zabbix non trovato per questo relay")
+    items = _zbx("item.get", {
+        "hostids": hosts[0]["hostid"],
+        "search": {"key_": "wpex."},
+        "output": ["itemid", "name", "key_", "value_type"]
+    }, "Zabbix item fetch failed", meta=True)
+    time_from, time_till = _period_bounds(period)
+    return _item_histories(items, time_from, time_till)
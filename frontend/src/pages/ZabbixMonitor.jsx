@@ -1,5 +1,5 @@
 
-import React, { useEffect, useState } from "react";
+import React, { useEffect, useRef, useState } from "react";
 import { LineChart, Line, XAxis, YAxis, Tooltip, Legend, ResponsiveContainer, CartesianGrid } from "recharts";
 
 const ZabbixMonitor = () => {
@@ -54,9 +54,89 @@ const ZabbixMonitor = () => {
       });
   };
 
+  // Sincronizzazione manuale (job asincrono con avanzamento via SSE)
+  const [syncJob, setSyncJob] = useState(null);
+  const [syncError, setSyncError] = useState(null);
+  const eventsRef = useRef(null);
+  const pollRef = useRef(null);
+
+  useEffect(() => () => {
+    if (eventsRef.current) eventsRef.current.close();
+    clearInterval(pollRef.current);
+  }, []);
+
+  // Se lo stream SSE cade, l'avanzamento prosegue interrogando /jobs/{id}
+  const pollJob = (job_id) => {
+    clearInterval(pollRef.current);
+    pollRef.current = setInterval(() => {
+      fetch(`/api/zabbix/sender/jobs/${job_id}`)
+        .then(async (res) => {
+          const data = await res.json();
+          if (!res.ok) throw new Error(data.detail || "Errore lettura avanzamento");
+          return data;
+        })
+        .then((job) => {
+          setSyncJob(job);
+          if (job.finished_at) clearInterval(pollRef.current);
+        })
+        .catch((err) => {
+          clearInterval(pollRef.current);
+          setSyncError(`Avanzamento non disponibile: ${err.message}`);
+        });
+    }, 2000);
+  };
+
+  const startSync = () => {
+    setSyncError(null);
+    clearInterval(pollRef.current);
+    fetch("/api/zabbix/sender/trigger", { method: "POST" })
+      .then(async (res) => {
+        const data = await res.json();
+        if (!res.ok) throw new Error(data.detail || "Errore avvio sincronizzazione");
+        return data;
+      })
+      .then(({ job_id, status }) => {
+        setSyncJob({ job_id, status, phase: status === "queued" ? "queued" : "provisioning",
+                     relays_done: 0, relays_total: null, errors: [] });
+        const events = new EventSource(`/api/zabbix/sender/jobs/${job_id}/events`);
+        eventsRef.current = events;
+        events.onmessage = (e) => {
+          const job = JSON.parse(e.data);
+          setSyncJob(job);
+          if (job.finished_at) events.close();
+        };
+        events.onerror = () => {
+          events.close();
+          pollJob(job_id);
+        };
+      })
+      .catch((err) => setSyncError(err.message));
+  };
+
+  const syncRunning = syncJob && !syncJob.finished_at;
+
   return (
     <div style={{ padding: 24 }}>
       <h2>Monitoraggio dispositivi Zabbix</h2>
+      <div style={{ margin: "12px 0" }}>
+        <button onClick={startSync} disabled={syncRunning}>
+          {syncRunning ? "Sincronizzazione in corso..." : "Sincronizza ora"}
+        </button>
+        {syncJob && (
+          <span style={{ marginLeft: 12 }}>
+            {syncJob.status === "queued"
+              ? "In coda..."
+              : syncJob.relays_total === null
+              ? "Preparazione..."
+              : `Relay ${syncJob.relays_done} / ${syncJob.relays_total}`}
+            {syncJob.errors.length > 0 && ` - ${syncJob.errors.length} errori`}
+            {syncJob.finished_at && (syncJob.status === "lost"
+              ? " - interrotta (la replica che la eseguiva non risponde)"
+              : ` - completata (${syncJob.status})`)}
+          </span>
+        )}
+        {syncError && <div style={{ color: "red" }}>{syncError}</div>}
+      </div>
       {loading && <div>Caricamento...</div>}
       {error && <div style={{ color: "red" }}>{error}</div>}
       {!loading && !error && (